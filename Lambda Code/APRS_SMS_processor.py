@@ -1,15 +1,19 @@
 import os
 import json
-import urllib
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
 import logging
 import base64
 import hmac
-import boto3
-import time
-import calendar
-from datetime import datetime, timezone, timedelta
 from hashlib import sha1
-from twilio.rest import Client
+
+from APRS_clients import with_client_stats
+from APRS_metrics import with_metrics, timer, set_property
+from APRS_status import get_status, format_status
+from APRS_outbox import enqueue_sms, deliver_pending
+from APRS_subscriptions import start_subscription, stop_subscription
+from APRS_cache import MISSING
+from APRS_dedupe import local_reply, claim_message, record_reply
+from APRS_ratelimit import allow_command, allow_command_locally
 
 
 #setup logger
@@ -22,25 +26,41 @@ TWILIO_ACCOUNT_SID = os.environ['TWILIO_ACCOUNT_SID']
 TWILIO_AUTH_TOKEN = os.environ['TWILIO_AUTH_TOKEN']
 MESSAGING_SERVICE_SID = os.environ['TWILIO_MSG_SERVICE_SID']
 
-#set application defaults
-default_schedule_expiration_hours = 4
-default_maximum_schedule_hours = 24
+#signature validation state, built once per container
+#the HMAC is keyed once here. Each request hashes a copy, so the auth token is not rehashed per request
+SIGNING_KEY = hmac.new(TWILIO_AUTH_TOKEN.encode("utf-8"), digestmod=sha1)
+
+#Twilio may sign the webhook URL with or without the explicit https port, both are accepted
+def signing_urls(url):
+    url = url.strip()
+    parts = urlsplit(url)
+    if parts.port is None and parts.scheme == 'https':
+        with_port = urlunsplit((parts.scheme, parts.netloc + ":443", parts.path, parts.query, parts.fragment))
+    else:
+        with_port = url
+    #endif
+    return (url.encode("utf-8"), with_port.encode("utf-8"))
+#end signing_urls
+
+SIGNING_URLS = signing_urls(INBOUND_WEBHOOK_URL)
 
+@with_client_stats
+@with_metrics
 def lambda_handler(event, context):
     #setup return object
     lambda_return = {'Status': '200', 'Message': '', 'Code':''}
   
-    logger.info("received: " + str(event))
+    #debug logging is formatted lazily, so it costs nothing when the level is INFO
+    logger.debug("received: %s", event)
   
     #First, collect and decode the headers to extract the signature and url
     #if we don't have a twilio signature header, throw exception and exit
     try:
         twilio_signature = event["headers"]["x-twilio-signature"]
-        logger.info("inbound SMS signature: " +twilio_signature)
         #body is in base64, decode
         request_body = base64.b64decode(event["body"])
         payload = request_body.decode('utf8')
-        logger.info("inbound SMS body: " +payload)
+        logger.debug("inbound SMS body: %s", payload)
     except Exception as err:
         logger.error("Exception in Webhook parsing: " + (f"{type(err).__name__} was raised: {err}"))
         lambda_return =  {'Status': '400', 'Message': 'Invalid SMS received', 'Code':'iSMS'}
@@ -52,21 +72,56 @@ def lambda_handler(event, context):
 
     #at this point, we should have a valid twilio webhook and have decoded the body
     #split the body payload into dictionary of parameters
-    res = dict()
-    x=payload.split("&")
-    for i in x:
-        a,b=i.split("=")
-        res[a]=[urllib.parse.unquote_plus(b)]
-    #endfor  
-    # printing result
-    print("The parsed URL Params : " + str(res))
+    with timer('validate'):
+        res = parse_form(payload)
+        logger.debug("The parsed URL Params : %s", res)
 
-    #feed headers and parameters into the validator function
-    request_valid = twilio_validator(twilio_signature, res)
+        #feed headers and parameters into the validator function
+        request_valid = twilio_validator(twilio_signature, res)
+    #endwith
 
     #if request is valid, process.  Otherwise, exit
     if request_valid:
         logger.info("Received Valid SMS")
+        #the inbound MessageSid keys the reply, so a retried webhook cannot queue a second reply
+        reply_key = res.get('MessageSid', [None])[0]
+        inbound_words = res.get('Body', [''])[0].split()
+        command_number = res.get('From', [''])[0]
+        command_callsign = inbound_words[1].upper() if len(inbound_words) > 1 else None
+        #a retry this container already answered gets the same reply, with no network call
+        cached_reply = local_reply(reply_key) if reply_key else MISSING
+        if cached_reply is not MISSING:
+            logger.info("Duplicate webhook for: " +reply_key)
+            lambda_return['Message'] = cached_reply or ""
+            return {
+                'statusCode': lambda_return['Status'],
+                'body': json.dumps(lambda_return)
+            }
+        #endif
+        #a flood is turned away on this container's own buckets before anything reaches AWS or Twilio
+        #the shared buckets are only charged after the claim below, so Twilio retries are never charged
+        if not allow_command_locally(command_number, command_callsign):
+            return rate_limited()
+        #endif
+        #a Twilio retry of a message already handled gets the earlier reply, and nothing is run or sent again
+        if reply_key:
+            claimed, cached_reply = claim_message(reply_key)
+            if not claimed:
+                logger.info("Duplicate webhook for: " +reply_key)
+                lambda_return['Message'] = cached_reply or ""
+                return {
+                    'statusCode': lambda_return['Status'],
+                    'body': json.dumps(lambda_return)
+                }
+            #endif
+        #endif
+        #a command rejected by the shared buckets gets no reply, and its retries are answered with none
+        if not allow_command(command_number, command_callsign):
+            if reply_key:
+                record_reply(reply_key, "")
+            #endif
+            return rate_limited()
+        #endif
         #Split required fields - phone number, SMS body, and callsign into strings
         try:
             inbound_number = res['From'][0]
@@ -74,10 +129,15 @@ def lambda_handler(event, context):
             text_body = raw_text_body[0].split()
             action_req = text_body[0].upper()
             callsign = text_body[1].upper()
+            set_property('Command', action_req)
         except Exception as err:
             logger.info("Exception in SMS parsing: " + (f"{type(err).__name__} was raised: {err}"))
             outbound_status_message = "Invalid Command: Use START, STOP, or STATUS followed by callsign. ex. START AB1CDE"
-            send_sms(inbound_number, outbound_status_message)
+            send_sms(inbound_number, outbound_status_message, reply_key)
+            if reply_key:
+                record_reply(reply_key, outbound_status_message)
+            #endif
+            deliver_pending()
             return {
                 'statusCode': lambda_return['Status'],
                 'body': json.dumps(lambda_return)
@@ -91,23 +151,29 @@ def lambda_handler(event, context):
             #if body is START: Identify callsign, Store number in DB, along with callsign, timestamp, and active flag. Return SMS opt-in message
             logger.info("Start message received from: " +callsign)
             outbound_status_message = configure_cron_job(callsign, inbound_number, True)
-            send_sms(inbound_number, outbound_status_message)
+            send_sms(inbound_number, outbound_status_message, reply_key)
         elif(action_req == "STOP"):
             #if body is STOP: Identify callsign, remove callsign from DB. Return SMS message monitoring stopped
             logger.info("Stop message received from: " +callsign)
             outbound_status_message = configure_cron_job(callsign, inbound_number, False)
-            send_sms(inbound_number, outbound_status_message)
+            send_sms(inbound_number, outbound_status_message, reply_key)
         elif(action_req == "STATUS"):
             #if body is STATUS: Identify callsign, return status from DB
             logger.info("Status message received from: " +callsign)
             outbound_status_message = monitor_status(callsign)
             logger.info("Monitor status for " +callsign +"is: " +outbound_status_message)
-            send_sms(inbound_number, outbound_status_message)
+            send_sms(inbound_number, outbound_status_message, reply_key)
         else:
             #else: return help message or nothing
             logger.info("invalid command received")
-            send_sms(inbound_number,"Invalid Command: Use START, STOP, or STATUS followed by callsign. ex. START AB1CDE")
+            outbound_status_message = "Invalid Command: Use START, STOP, or STATUS followed by callsign. ex. START AB1CDE"
+            send_sms(inbound_number, outbound_status_message, reply_key)
+        #endif
+        if reply_key:
+            record_reply(reply_key, outbound_status_message)
         #endif
+        #send the reply queued above
+        deliver_pending()
     # if request is not from twilio, give appropriate response
     else:
         logger.error("ERROR: SMS Signature Failed")
@@ -119,52 +185,64 @@ def lambda_handler(event, context):
         }
 #end handler
 
+#decodes an application/x-www-form-urlencoded body in one pass
+#returns name -> list of values. Empty values and values containing '=' are kept
+def parse_form(payload):
+    res = {}
+    for field in payload.split("&"):
+        if not field:
+            continue
+        #endif
+        name, separator, value = field.partition("=")
+        name = unquote_plus(name) if ("%" in name or "+" in name) else name
+        value = unquote_plus(value) if ("%" in value or "+" in value) else value
+        values = res.get(name)
+        if values is None:
+            res[name] = [value]
+        else:
+            values.append(value)
+        #endif
+    #endfor
+    return res
+#end parse_form
+
+#validates the Twilio signature over the webhook URL plus the sorted parameters
+#both URL variants are always computed and compared in constant time, so the timing does not
+#reveal which variant matched or how much of the signature was right
 def twilio_validator(signature, res):
-# if twilioSignature exists and message from authorized number, create a validator & a dictionary of received data
+    t = "/" + "".join([param_name + "".join(res[param_name]) for param_name in sorted(res)])
+    data = t.encode("utf-8")
+    provided = signature.strip().encode("utf-8")
     return_value = False
-    s = INBOUND_WEBHOOK_URL.strip()
-    t = "/"
-    if res:
-        for param_name in sorted(set(res)):
-            value = res[param_name]
-            temp_out = ''.join(map(str, value))
-            t += param_name + temp_out
-        #endfor
-    #endif
-    test_string = s+t
-    logger.info("Validator test String: " +test_string)
-    # compute signature and compare signatures
-    mac = hmac.new((TWILIO_AUTH_TOKEN).encode("utf-8"), test_string.encode("utf-8"), sha1)
-    computed = base64.b64encode(mac.digest())
-    computed = computed.decode("utf-8").strip()
-    logger.info("Validator Computed signature: " +computed +" Provided signature: " +signature)
-    
-    if(computed == signature):
-        return_value = True
-    else:
-        test_string = s +":443" +t
-        mac = hmac.new((TWILIO_AUTH_TOKEN).encode("utf-8"), test_string.encode("utf-8"), sha1)
+    for url in SIGNING_URLS:
+        mac = SIGNING_KEY.copy()
+        mac.update(url)
+        mac.update(data)
         computed = base64.b64encode(mac.digest())
-        computed = computed.decode("utf-8").strip()
-        logger.info("Validator Computed signature: " +computed +" Provided signature: " +signature)
-        if(computed == signature):
-            return_value = True
-        #endif
+        return_value = hmac.compare_digest(computed, provided) | return_value
+    #endfor
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Validator test string: %s Result: %s", SIGNING_URLS[0].decode("utf-8") + t, return_value)
     #endif
     return return_value
 #end twilio_validator
 
-#function sends sms message. Does not return a value, will throw exception if fails
-def send_sms(sms_to_number, message_body):
-    #code to send a response SMS
+#returns the response for a command turned away by the rate limits. It gets no reply
+def rate_limited():
+    lambda_return = {'Status': '429', 'Message': 'Rate limit exceeded', 'Code':'RATE'}
+    return {
+        'statusCode': lambda_return['Status'],
+        'body': json.dumps(lambda_return)
+    }
+#end rate_limited
+
+#function queues a sms message on the outbox. Does not return a value, logs an exception if it fails
+#the handler sends the queued reply with deliver_pending once it is done
+def send_sms(sms_to_number, message_body, key=None):
+    #code to queue a response SMS
     try:
         logger.info("SMS message send request: " +sms_to_number +", " +message_body)
-        client = Client(TWILIO_ACCOUNT_SID,TWILIO_AUTH_TOKEN)
-        message = client.messages.create(
-            messaging_service_sid= MESSAGING_SERVICE_SID,
-            to= sms_to_number,
-            body= message_body
-            )
+        enqueue_sms(sms_to_number, message_body, key)
     except Exception as err:
         logger.exception("Exception in SMS: " + (f"{type(err).__name__} was raised: {err}"))
     #endtry
@@ -175,37 +253,11 @@ def monitor_status(callsign):
     #set the return value
     return_value = "not found"
     try:
-        #create a database connection to find most recent status
-        simpleDBclient = boto3.client('sdb')
-        getDB_response = simpleDBclient.get_attributes(
-            DomainName='APRS_tracker',
-            ItemName= callsign
-            )
-        #look for record for the callsign and extract last report
+        #read the precomputed summary, from the warm container's cache when it has one
+        summary = get_status(callsign)
         logger.info("DB Response obtained")
-        if "Attributes" in getDB_response:
-            for attribute in getDB_response["Attributes"]:
-                if attribute["Name"] == "comment":
-                    previous_comment = attribute["Value"]
-                    previous_recorded_temp = float(previous_comment[2:7])
-                elif attribute["Name"] == "report_time":
-                    previous_reported_time = attribute["Value"]
-                elif attribute["Name"] == "alert_sent":
-                    alert_sent = attribute["Value"]
-                #endif
-            #endfor
-            #TODO: find if cron job is still active, and for how long
-            current_epoch_time = time.time()
-            test_epoch_time = calendar.timegm(time.strptime(previous_reported_time,"%Y-%m-%dT%H:%M:%SZ%z"))
-            test_delta_in_min = (current_epoch_time - test_epoch_time) / 60
-            
-            return_value = ("Most recent report was: %.2f F at: %.0f minutes ago. Alert Status is: " %(previous_recorded_temp, test_delta_in_min)) + alert_sent
-            
-        else:
-            #we don't have a record
-            #TODO: should we look for the cron job?
-            return_value = "No record found for this callsign"
-        #endif
+        #the summary carries the monitor expiry, so the remaining time needs no scheduler call
+        return_value = format_status(summary)
     except Exception as err:
         lambda_return['Status'] = "500"
         lambda_return['Message'] = "Exception in Monitor: " +(f"{type(err).__name__} was raised: {err}")
@@ -214,129 +266,29 @@ def monitor_status(callsign):
         logger.exception(lambda_return['Message'])
         return_value = "database error"
     finally:
-        simpleDBclient.close()
         return return_value 
     #endtry
 #end monitor_status
 
-#manages the monitoring cron job. Requires a callsign, sms number, and boolean active flag
+#manages the monitoring subscription. Requires a callsign, sms number, and boolean active flag
+#START and extensions are a single write to the subscription table, STOP a single delete
+#the scheduler tick in APRS_notify picks subscriptions up and enforces their expiry
+#inbound commands are rate limited per number and per callsign by the handler before this is called
 #returns a human-readable status string
-#TODO: add some kind of abuse rate-limiting here
 def configure_cron_job(callsign, inbound_sms_number, monitor_active):
     try:
-        #set up the EventBridge scheduler object
-        EB_client = boto3.client('scheduler')
-        #parse the request
         if(monitor_active):
-            #request is to create a new monitor, or edit an existing one
-            #see: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/scheduler/client/create_schedule.html
-            
-            #calculate x hours from now to set expiration window
-            monitor_expiration_time = datetime.now(timezone.utc) + timedelta(hours=default_schedule_expiration_hours)
-            #set up event input string
-            lambda_event_input_string ="{\"APRS_name\":\"" +callsign +"\",\"SMS_to\":\"" +inbound_sms_number +"\"}"
-            #create schedule entry
-            try:
-                EB_client.create_schedule(
-                    ActionAfterCompletion='DELETE',
-                    Description='Runs the APRS notify lambda every 5 minutes to test for temperature change',
-                    EndDate=monitor_expiration_time,
-                    FlexibleTimeWindow={
-                        "Mode": "OFF"
-                    },
-                    GroupName="APRS_monitor_schedules",
-                    Name=callsign,
-                    ScheduleExpression="rate(5 minutes)",
-                    Target={
-                        "Arn": "<arn>",
-                        "Input": lambda_event_input_string,
-                        "RetryPolicy": {
-                            "MaximumEventAgeInSeconds": 86400,
-                            "MaximumRetryAttempts": 0
-                        },
-                        "RoleArn": "<role_arn>"
-                    }
-                )
-                return_value = "APRS Monitor: Session started for site "+callsign +". Monitoring automatically stops in " +str(default_schedule_expiration_hours) +" hours. Text STOP to end. Text STATUS for status. Message & Data rates may apply."
-            except EB_client.exceptions.ConflictException:
-                #there is a conflict. Check the creation time. If greater than max allowed time, do not allow extension
-                logger.info("Creation Requested for already running monitor in: " +callsign)
-                #get the current schedule
-                current_schedule = EB_client.get_schedule(
-                    GroupName="APRS_monitor_schedules",
-                    Name=callsign
-                )
-                schedule_creation_time = current_schedule["CreationDate"]
-                current_utc_time = datetime.now(timezone.utc)
-                maximum_schedule_time = schedule_creation_time + timedelta(hours=default_maximum_schedule_hours)
-                if(current_utc_time < maximum_schedule_time):
-                    #allow update of schedule
-                    #calculate x hours from now to set expiration window
-                    monitor_expiration_time = datetime.now(timezone.utc) + timedelta(hours=default_schedule_expiration_hours)
-                    #set up event input string
-                    lambda_event_input_string ="{\"APRS_name\":\"" +callsign +"\",\"SMS_to\":\"" +inbound_sms_number +"\"}"
-                    EB_client.update_schedule(
-                        ActionAfterCompletion='DELETE',
-                        Description='Runs the APRS notify lambda every 5 minutes to test for temperature change',
-                        EndDate=monitor_expiration_time,
-                        FlexibleTimeWindow={
-                            "Mode": "OFF"
-                        },
-                        GroupName="APRS_monitor_schedules",
-                        Name=callsign,
-                        ScheduleExpression="rate(5 minutes)",
-                        Target={
-                            "Arn": "<arn>",
-                            "Input": lambda_event_input_string,
-                            "RetryPolicy": {
-                                "MaximumEventAgeInSeconds": 86400,
-                                "MaximumRetryAttempts": 0
-                            },
-                            "RoleArn": "<role_arn>"
-                        }
-                    )
-                    return_value = "Monitoring active for: " +callsign +". Monitoring automatically stops in " +str(default_schedule_expiration_hours) +" hours. Data and Msg charges may apply. STOP to end."
-                else:
-                    return_value = "Extension Limit Reached. STOP to end."
-                #endif
-            #end conflictexception handling
-            #endtry (note: general exceptions will be caught by the previous handler)
+            #request is to create a new monitor, or extend an existing one
+            return_value = start_subscription(callsign, inbound_sms_number)
         else:
-            #request is to delete monitor
-            #need to check that the request to delete is coming from the originating number
-            requested_schedule_list = EB_client.list_schedules(
-                GroupName='APRS_monitor_schedules',
-                NamePrefix=callsign
-                )
-
-            #get schedule from list
-            requested_schedule = EB_client.get_schedule(
-                GroupName='APRS_monitor_schedules',
-                Name=requested_schedule_list['Schedules'][0]['Name']
-                )
-            #should have the correct schedule in the requested_schedule object. Check for phone number match
-            #in the input JSON
-            lambda_arguments = json.loads(requested_schedule['Target']['Input'])
-            print(lambda_arguments['SMS_to'])
-            if (lambda_arguments['SMS_to'] == str(inbound_sms_number)):
-            #parse the request and delete monitor
-                response = EB_client.delete_schedule(
-                    GroupName='APRS_monitor_schedules',
-                    Name=requested_schedule['Name']
-                    )
-                return_value = "Monitoring stopped for: " +callsign
-            else:
-                return_value = "You do not have permission to stop monitoring for: " +callsign
-            #endif
+            #request is to delete monitor. Only the originating number may do so
+            return_value = stop_subscription(callsign, inbound_sms_number)
         #endif
-
     except Exception as err:
         logger.exception("Exception in SCH: " +(f"{type(err).__name__} was raised: {err}"))
         return_value = "Exception occured. Monitoring not changed"
-    finally:
-        EB_client.close()
-        return return_value
     #endtry
+    return return_value
 #end configure_cron_job
 
 #This calls the handler. Use only when testing.
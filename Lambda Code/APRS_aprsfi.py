@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+import urllib.parse
+
+from APRS_cache import TTLCache, MISSING
+from APRS_clients import call_with_client
+from APRS_concurrency import dependency_slot
+from APRS_metrics import timer, count
+
+#orjson decodes the aprs.fi payload several times faster when it is installed. json otherwise
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+#endtry
+
+#setup logger
+logger = logging.getLogger()
+#urllib3 logs every request URL at debug level, and aprs.fi takes the key in the URL
+logging.getLogger('urllib3').setLevel(logging.INFO)
+
+#aprs.fi location client
+#entries are cached per callsign for the life of a warm container. A callsign whose packet was heard
+#at lasttime cannot have a newer one before lasttime + APRSFI_MIN_BEACON_SECONDS, so its entry is
+#served from the cache until then, and for APRSFI_CACHE_SECONDS at least. A cached entry is never
+#replaced by an older one. Callsigns another thread is already fetching are not asked for again,
+#the caller waits for that request instead. Responses are gzipped, and a rate limited response makes
+#every thread in the container back off. The key never appears in a logged URL or error message
+
+#pick up environment variables
+APRSFI_KEY = os.environ['APRSFI_KEY']
+#aprs.fi endpoint. APRS_replay points this at its local stand-in
+APRSFI_URL = os.environ.get('APRSFI_URL', 'https://api.aprs.fi/api/get')
+#aprs.fi accepts up to 20 comma separated names in a single query
+APRSFI_MAX_NAMES = 20
+#aprs.fi asks clients to identify themselves
+APRSFI_HEADERS = {'Accept-Encoding': 'gzip', 'User-Agent': 'APRS-Monitor/1.0'}
+
+#shortest time between two beacons of one tracker, and the least time an entry is cached
+APRSFI_MIN_BEACON_SECONDS = int(os.environ.get('APRSFI_MIN_BEACON_SECONDS', '60'))
+APRSFI_CACHE_SECONDS = int(os.environ.get('APRSFI_CACHE_SECONDS', '10'))
+APRSFI_CACHE_SIZE = 4096
+
+#retries of a rate limited query, and the backoff between them, doubled each time and jittered
+#a Retry-After header from the server is used instead when there is one
+APRSFI_RETRIES = 2
+APRSFI_BACKOFF_SECONDS = 1.0
+#a query that would have to wait longer than this for the rate limit fails instead
+APRSFI_MAX_BACKOFF_SECONDS = 10.0
+#http statuses that mean slow down
+RATE_LIMIT_STATUSES = {429, 503}
+
+#raised when aprs.fi cannot answer a query. The message is safe to log
+class APRSFIError(Exception):
+    pass
+#end APRSFIError
+
+#one query in progress. Threads asking for the same callsigns wait on it
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.entries = {}
+        self.error = None
+    #end __init__
+#end _Flight
+
+#callsign -> aprs.fi entry
+_entries = TTLCache(maxsize=APRSFI_CACHE_SIZE, ttl=APRSFI_CACHE_SECONDS)
+#callsign -> flight fetching it
+_flights = {}
+_flights_lock = threading.Lock()
+#monotonic time until which the container holds off after a rate limited response
+_blocked_until = 0.0
+
+#removes the API key from text
+def redact(text):
+    text = str(text)
+    if not APRSFI_KEY:
+        return text
+    #endif
+    return text.replace(APRSFI_KEY, "REDACTED").replace(urllib.parse.quote_plus(APRSFI_KEY), "REDACTED")
+#end redact
+
+#returns the query URL for a list of names
+def location_url(names):
+    return APRSFI_URL +"?" +urllib.parse.urlencode({'name': ",".join(names), 'what': 'loc', 'apikey': APRSFI_KEY, 'format': 'json'}, safe=",")
+#end location_url
+
+#returns callsign -> entry for the callsigns aprs.fi has a location for, upper cased
+#cached entries are returned as they are, and callsigns in another thread's query wait for it
+#raises APRSFIError if a query fails
+def get_locations(names):
+    names = list(dict.fromkeys(name.upper() for name in names))
+    found = {}
+    waiting = {}
+    fetching = []
+    flight = _Flight()
+    with _flights_lock:
+        for name in names:
+            entry = _entries.get(name, MISSING)
+            if entry is not MISSING:
+                found[name] = entry
+            elif name in _flights:
+                waiting[name] = _flights[name]
+            else:
+                _flights[name] = flight
+                fetching.append(name)
+            #endif
+        #endfor
+    #endwith
+    count('aprs_cached', len(found))
+    count('aprs_collapsed', len(waiting))
+    if fetching:
+        try:
+            for i in range(0, len(fetching), APRSFI_MAX_NAMES):
+                flight.entries.update(_query(fetching[i:i + APRSFI_MAX_NAMES]))
+            #endfor
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with _flights_lock:
+                for name in fetching:
+                    _flights.pop(name, None)
+                #endfor
+            #endwith
+            flight.done.set()
+        #endtry
+        found.update(flight.entries)
+    #endif
+    for name, other in waiting.items():
+        other.done.wait()
+        if other.error is not None:
+            error = other.error
+            raise APRSFIError(str(error) if isinstance(error, APRSFIError) else "Exception in APRS Query: " +redact(f"{type(error).__name__} was raised: {error}"))
+        #endif
+        if name in other.entries:
+            found[name] = other.entries[name]
+        #endif
+    #endfor
+    return found
+#end get_locations
+
+#queries aprs.fi for up to APRSFI_MAX_NAMES names, retrying rate limited responses
+#caches and returns callsign -> entry
+def _query(names):
+    url = location_url(names)
+    for attempt in range(APRSFI_RETRIES + 1):
+        _wait_for_rate_limit()
+        try:
+            with dependency_slot('aprs'), timer('aprs'):
+                response = call_with_client('http', lambda http: http.request('GET', url, headers=APRSFI_HEADERS))
+            #endwith
+            body_data = response.data
+            count('aprs_bytes', len(body_data))
+            payload = None if response.status in RATE_LIMIT_STATUSES else json_loads(body_data)
+        except Exception as err:
+            raise APRSFIError("Exception in APRS Query: " +redact(f"{type(err).__name__} was raised: {err}")) from None
+        #endtry
+        if payload is not None and not (payload.get('result') == 'fail' and 'limit' in str(payload.get('description', '')).lower()):
+            break
+        #endif
+        delay = _retry_after(response, attempt)
+        _block(delay)
+        count('aprs_rate_limited', 1)
+        logger.warning("APRS:rate limited by aprs.fi, backing off %.1f s" %delay)
+        if attempt == APRSFI_RETRIES:
+            raise APRSFIError("Rate limited by aprs.fi")
+        #endif
+    #endfor
+    if payload.get('result') == 'fail':
+        raise APRSFIError("Response payload was failure")
+    elif not(200 <= response.status <= 299):
+        raise APRSFIError("Response not 200: " +str(response.status))
+    #endif
+    now = time.time()
+    entries = {}
+    for entry in payload.get('entries', []):
+        name = entry['name'].upper()
+        cached = _entries.get(name)
+        if cached is not None and int(cached.get('lasttime', 0)) > int(entry.get('lasttime', 0)):
+            entry = cached
+        #endif
+        entries[name] = entry
+        _entries.put(name, entry, max(APRSFI_CACHE_SECONDS, int(entry.get('lasttime', 0)) + APRSFI_MIN_BEACON_SECONDS - now))
+    #endfor
+    return entries
+#end _query
+
+#returns the seconds to wait before retrying a rate limited response
+def _retry_after(response, attempt):
+    try:
+        return min(float(response.headers.get('Retry-After')), APRSFI_MAX_BACKOFF_SECONDS)
+    except (TypeError, ValueError):
+        delay = APRSFI_BACKOFF_SECONDS * (2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+    #endtry
+#end _retry_after
+
+#holds every thread in the container off aprs.fi for delay seconds
+def _block(delay):
+    global _blocked_until
+    with _flights_lock:
+        _blocked_until = max(_blocked_until, time.monotonic() + delay)
+    #endwith
+#end _block
+
+#waits out a rate limit another query ran into. Raises APRSFIError if that would take too long
+def _wait_for_rate_limit():
+    delay = _blocked_until - time.monotonic()
+    if delay > APRSFI_MAX_BACKOFF_SECONDS:
+        raise APRSFIError("Rate limited by aprs.fi for another %.0f s" %delay)
+    #endif
+    if delay > 0:
+        time.sleep(delay)
+    #endif
+#end _wait_for_rate_limit
+
+#eof
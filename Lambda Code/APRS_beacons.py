@@ -0,0 +1,50 @@
+import os
+import time
+import heapq
+
+#beacon timestamps and staleness
+#timestamps are epoch seconds everywhere. They are formatted only for messages and logs.
+#aprs.fi stamps packets with its own clock, which may be ahead of or behind ours, so a beacon is
+#only counted as late once it is older than the limit plus the skew tolerance
+
+#seconds of disagreement between aprs.fi's clock and ours that are not counted as beacon age
+BEACON_CLOCK_SKEW_SECONDS = int(os.environ.get('BEACON_CLOCK_SKEW_SECONDS', '60'))
+
+#returns how old a beacon is in seconds, after the skew tolerance. Never negative
+def beacon_age(lasttime, now):
+    return max(0, now - lasttime - BEACON_CLOCK_SKEW_SECONDS)
+#end beacon_age
+
+#formats an epoch time as UTC ISO 8601, for messages and logs
+def format_time(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+#end format_time
+
+#the sites of one poll cycle, ordered by last beacon time
+#stale() pops every site older than a limit, oldest first, in O(k log n) for k stale sites
+class BeaconIndex:
+    def __init__(self, beacons=()):
+        self._heap = [(int(lasttime), name) for name, lasttime in beacons]
+        heapq.heapify(self._heap)
+    #end __init__
+
+    def push(self, name, lasttime):
+        heapq.heappush(self._heap, (int(lasttime), name))
+    #end push
+
+    #returns the names whose beacon age is over max_age seconds and removes them from the index
+    def stale(self, now, max_age):
+        stale = []
+        heap = self._heap
+        while heap and beacon_age(heap[0][0], now) > max_age:
+            stale.append(heapq.heappop(heap)[1])
+        #endwhile
+        return stale
+    #end stale
+
+    def __len__(self):
+        return len(self._heap)
+    #end __len__
+#end BeaconIndex
+
+#eof
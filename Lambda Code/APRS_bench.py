@@ -0,0 +1,596 @@
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import subprocess
+
+#benchmarks for the Lambda code. Run from this directory:
+#   python APRS_bench.py imports
+#exits non zero if a benchmark breaks its budget
+
+#cold start budget per handler module, in milliseconds
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', '150'))
+IMPORT_RUNS = 5
+
+#telemetry decode budget, in microseconds per comment
+TELEMETRY_BUDGET_US = float(os.environ.get('TELEMETRY_BUDGET_US', '10'))
+TELEMETRY_COMMENTS = 10000
+
+#simulated sites for the state backend load test
+STATE_BENCH_SITES = int(os.environ.get('STATE_BENCH_SITES', '10000'))
+STATE_BENCH_BACKENDS = ['memory', 'sqlite']
+
+#inbound webhook requests timed through the form decoder and signature validator
+WEBHOOK_REQUESTS = 20000
+
+#days of 5 minute samples written and read back by the history benchmark
+HISTORY_BENCH_DAYS = int(os.environ.get('HISTORY_BENCH_DAYS', '30'))
+
+#sites and days of 5 minute readings replayed by the trend backtest
+TREND_BENCH_SITES = int(os.environ.get('TREND_BENCH_SITES', '200'))
+TREND_BENCH_DAYS = int(os.environ.get('TREND_BENCH_DAYS', '30'))
+
+#rule evaluation budget, in microseconds per site
+RULES_BUDGET_US = float(os.environ.get('RULES_BUDGET_US', '20'))
+RULES_BENCH_SITES = 10000
+
+#KISS frame decode budget, in microseconds per frame
+KISS_BUDGET_US = float(os.environ.get('KISS_BUDGET_US', '10'))
+KISS_BENCH_FRAMES = 20000
+#bytes handed to the decoder per read, as a TNC socket would return them
+KISS_BENCH_READ = 4096
+
+#sites and hours simulated by the polling cadence benchmark, and the tick it runs at
+CADENCE_BENCH_SITES = int(os.environ.get('CADENCE_BENCH_SITES', '400'))
+CADENCE_BENCH_HOURS = int(os.environ.get('CADENCE_BENCH_HOURS', '24'))
+CADENCE_BENCH_TICK = 60
+#the fixed schedule it is compared with, and the seconds aprs.fi takes to publish a beacon
+CADENCE_BENCH_FIXED = 300
+CADENCE_BENCH_PUBLISH = 10
+
+#concurrent commands from one number, as from many containers at once, against a bucket of this burst
+RATELIMIT_BENCH_THREADS = 32
+RATELIMIT_BENCH_BURST = 5
+RATELIMIT_BENCH_ROUNDS = 10
+#seconds each shared store call takes, so the compare and swaps really race
+RATELIMIT_BENCH_LATENCY = 0.002
+
+#handler modules measured for cold start
+HANDLER_MODULES = ['APRS_notify', 'APRS_SMS_processor', 'APRS_watchdog']
+
+#heavy libraries no handler should pull in at import time
+DEFERRED_MODULES = ['boto3', 'botocore', 'twilio', 'urllib3', 'numpy']
+
+#placeholder configuration so the handlers import outside of Lambda
+BENCH_ENVIRONMENT = {
+    'APRSFI_KEY': 'bench',
+    'TWILIO_ACCOUNT_SID': 'ACbench',
+    'TWILIO_AUTH_TOKEN': 'bench',
+    'TWILIO_MSG_SERVICE_SID': 'MGbench',
+    'REQUEST_URL': 'https://bench.invalid',
+}
+
+#run inside a fresh interpreter. Prints import time and any heavy modules that got loaded
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+loaded = [name for name in {deferred!r} if name in sys.modules]
+print(json.dumps({{'ms': elapsed, 'loaded': loaded}}))
+"""
+
+#measures the import time of each handler in a fresh interpreter, best of IMPORT_RUNS
+#returns True if every handler is inside the budget and defers its heavy dependencies
+def bench_imports():
+    environment = dict(os.environ)
+    environment.update(BENCH_ENVIRONMENT)
+    here = os.path.dirname(os.path.abspath(__file__))
+    passed = True
+    for module in HANDLER_MODULES:
+        probe = IMPORT_PROBE.format(module=module, deferred=DEFERRED_MODULES)
+        timings = []
+        loaded = []
+        for run in range(IMPORT_RUNS):
+            output = subprocess.run([sys.executable, '-c', probe], cwd=here, env=environment, capture_output=True, text=True, check=True)
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            timings.append(result['ms'])
+            loaded = result['loaded']
+        #endfor
+        best = min(timings)
+        status = "ok"
+        if best > IMPORT_BUDGET_MS:
+            status = "OVER BUDGET"
+            passed = False
+        #endif
+        if loaded:
+            status = "LOADED " +",".join(loaded)
+            passed = False
+        #endif
+        print(f"import {module:<20} {best:8.2f} ms (budget {IMPORT_BUDGET_MS:.0f} ms) {status}")
+    #endfor
+    return passed
+#end bench_imports
+
+#builds comments in the tracker's dtostrf layout
+def synthetic_comments(count, seed=1):
+    generator = random.Random(seed)
+    comments = []
+    for tx_count in range(count):
+        comments.append("TI%6.2f TB%6.2f hPa%7.2f V%5.2f Tx%03d LightAPRS 2.0" %(
+            generator.uniform(-20, 110), generator.uniform(-20, 110), generator.uniform(800, 1050), generator.uniform(3.3, 5.5), tx_count % 1000))
+    #endfor
+    return comments
+#end synthetic_comments
+
+#batch decodes TELEMETRY_COMMENTS comments with the shared parser
+def bench_telemetry():
+    from APRS_telemetry import parse_many
+    comments = synthetic_comments(TELEMETRY_COMMENTS)
+    best = None
+    for run in range(5):
+        start = time.perf_counter()
+        records = parse_many(comments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    #endfor
+    per_comment = best / len(comments) * 1e6
+    failed = records.count(None)
+    passed = per_comment <= TELEMETRY_BUDGET_US and failed == 0
+    print(f"telemetry parse_many {len(comments)} comments: {per_comment:.2f} us/comment, {len(comments) / best:,.0f} comments/s, {failed} malformed (budget {TELEMETRY_BUDGET_US:.0f} us) {'ok' if passed else 'FAIL'}")
+    return passed
+#end bench_telemetry
+
+#runs the notify evaluation loop over simulated sites on each local state backend
+#two cycles: the first creates every site, the second is a fresh beacon for every site
+#readings stay inside every threshold, so no SMS is attempted
+def bench_state():
+    os.environ.update({key: value for key, value in BENCH_ENVIRONMENT.items() if key not in os.environ})
+    import APRS_state
+    import APRS_notify
+    generator = random.Random(2)
+    now = int(time.time())
+    names = ["SIM%05d" %site for site in range(STATE_BENCH_SITES)]
+    base_temps = {name: generator.uniform(50, 75) for name in names}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in STATE_BENCH_BACKENDS:
+            APRS_state.STATE_SQLITE_PATH = os.path.join(directory, backend +".sqlite3")
+            for cycle in range(2):
+                lasttime_int = now - 60 + cycle
+                start = time.perf_counter()
+                state_store = APRS_state.get_state_store(backend=backend)
+                state_store.load(names)
+                load_done = time.perf_counter()
+                failed = 0
+                for name in names:
+                    internal_temp = base_temps[name] + cycle
+                    comment = "TI%6.2f TB%6.2f hPa%7.2f V%5.2f Tx%03d" %(internal_temp, internal_temp - 1, 1013.25, 4.2, cycle)
+                    site_return = APRS_notify.evaluate_site(name, "+10000000000", comment, lasttime_int, state_store)
+                    failed += site_return['Status'] != '200'
+                #endfor
+                evaluate_done = time.perf_counter()
+                failed += len(state_store.flush())
+                elapsed = time.perf_counter() - start
+                print(f"state {backend:<7} cycle {cycle + 1}: {len(names)} sites in {elapsed:.3f} s, {len(names) / elapsed:,.0f} sites/s, "
+                      f"{elapsed / len(names) * 1e6:.1f} us/site (load {load_done - start:.3f} s, evaluate {evaluate_done - load_done:.3f} s, flush {start + elapsed - evaluate_done:.3f} s), "
+                      f"{state_store.round_trips} round trips, {failed} failed")
+            #endfor
+        #endfor
+    #endwith
+    return True
+#end bench_state
+
+#builds signed Twilio webhook bodies the way Twilio would send them
+#commands are used in turn, each followed by one of ten callsigns
+def synthetic_webhooks(count, url, auth_token, commands=('STATUS',)):
+    import base64
+    import hmac
+    import urllib.parse
+    from hashlib import sha1
+    webhooks = []
+    for message in range(count):
+        params = {
+            'ToCountry': 'US', 'ToState': 'CO', 'SmsMessageSid': 'SM%032x' %message, 'NumMedia': '0',
+            'ToCity': '', 'FromZip': '80517', 'SmsSid': 'SM%032x' %message, 'FromState': 'CO',
+            'SmsStatus': 'received', 'FromCity': 'ESTES PARK', 'Body': '%s AB%dCDE' %(commands[message % len(commands)], message % 10),
+            'FromCountry': 'US', 'To': '+18005551212', 'ToZip': '', 'NumSegments': '1',
+            'MessageSid': 'SM%032x' %message, 'AccountSid': 'ACbench', 'From': '+1970555%04d' %(message % 10000),
+            'ApiVersion': '2010-04-01',
+        }
+        signing_string = url + "/" + "".join(name + params[name] for name in sorted(params))
+        signature = base64.b64encode(hmac.new(auth_token.encode("utf-8"), signing_string.encode("utf-8"), sha1).digest()).decode("ascii")
+        webhooks.append((signature, urllib.parse.urlencode(params)))
+    #endfor
+    return webhooks
+#end synthetic_webhooks
+
+#times the inbound fast path: form decode plus signature validation
+def bench_webhook():
+    os.environ.update({key: value for key, value in BENCH_ENVIRONMENT.items() if key not in os.environ})
+    import APRS_SMS_processor
+    webhooks = synthetic_webhooks(WEBHOOK_REQUESTS, os.environ['REQUEST_URL'], os.environ['TWILIO_AUTH_TOKEN'])
+    parse_form = APRS_SMS_processor.parse_form
+    twilio_validator = APRS_SMS_processor.twilio_validator
+    best = None
+    for run in range(3):
+        valid = 0
+        start = time.perf_counter()
+        for signature, payload in webhooks:
+            valid += twilio_validator(signature, parse_form(payload))
+        #endfor
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    #endfor
+    passed = valid == len(webhooks)
+    print(f"webhook parse+validate {len(webhooks)} requests: {len(webhooks) / best:,.0f} requests/s, {best / len(webhooks) * 1e6:.2f} us/request, {valid} valid {'ok' if passed else 'FAIL'}")
+    return passed
+#end bench_webhook
+
+#writes HISTORY_BENCH_DAYS of 5 minute readings for one site, then times range queries and downsampling
+def bench_history():
+    import APRS_history
+    generator = random.Random(3)
+    end = int(time.time())
+    start = end - HISTORY_BENCH_DAYS * 86400
+    records = [APRS_history.HistoryRecord(timestamp, generator.uniform(60, 75), generator.uniform(60, 75), generator.uniform(1000, 1020), generator.uniform(3.8, 4.2))
+               for timestamp in range(start, end, 300)]
+    with tempfile.TemporaryDirectory() as directory:
+        for delta in (True, False):
+            APRS_history.HISTORY_DELTA = delta
+            history_store = APRS_history.FileHistoryStore(os.path.join(directory, str(delta)))
+            write_start = time.perf_counter()
+            for record in records:
+                history_store.stage('SIM00000', record)
+            #endfor
+            history_store.flush()
+            write_elapsed = time.perf_counter() - write_start
+            size = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(history_store.path) for name in names)
+            best_query = best_downsample = None
+            for run in range(5):
+                query_start = time.perf_counter()
+                found = history_store.query('SIM00000', start, end)
+                query_done = time.perf_counter()
+                hourly = APRS_history.downsample(found, 3600)
+                downsample_done = time.perf_counter()
+                best_query = query_done - query_start if best_query is None else min(best_query, query_done - query_start)
+                best_downsample = downsample_done - query_done if best_downsample is None else min(best_downsample, downsample_done - query_done)
+            #endfor
+            print(f"history {'delta' if delta else 'raw':<5} {len(records)} readings over {HISTORY_BENCH_DAYS} days: {size / len(records):.1f} bytes/reading, write {write_elapsed:.3f} s, "
+                  f"query {best_query * 1000:.2f} ms ({len(found) / best_query:,.0f} readings/s), hourly downsample {best_downsample * 1000:.2f} ms to {len(hourly)} points")
+        #endfor
+    #endwith
+    APRS_history.HISTORY_DELTA = os.environ.get('HISTORY_DELTA', '1') == '1'
+    return len(found) == len(records)
+#end bench_history
+
+#times the per packet trend update, then the vectorized backtest over many sites of synthetic history
+#sites drift through a daily cycle, and every fourth one cools through the minimum once
+def bench_trend():
+    import math
+    import APRS_trend
+    generator = random.Random(4)
+    start = int(time.time()) - TREND_BENCH_DAYS * 86400
+    samples = TREND_BENCH_DAYS * 288
+    readings = {}
+    for site in range(TREND_BENCH_SITES):
+        cooling = samples // 2 if site % 4 == 0 else None
+        readings["SIM%05d" %site] = [
+            (start + sample * 300, 60 + 8 * math.sin(sample / 45.8 + site) + generator.gauss(0, 0.3) - (0.1 * (sample - cooling) if cooling and sample > cooling else 0))
+            for sample in range(samples)
+        ]
+    #endfor
+    site_readings = readings["SIM00000"]
+    update_start = time.perf_counter()
+    state = None
+    for timestamp, value in site_readings:
+        state = APRS_trend.update_trend(state, timestamp, value)
+        APRS_trend.minutes_until(state, 40)
+    #endfor
+    update_elapsed = time.perf_counter() - update_start
+    try:
+        backtest_start = time.perf_counter()
+        results = APRS_trend.backtest(readings, 40)
+        backtest_elapsed = time.perf_counter() - backtest_start
+    except ImportError:
+        print(f"trend update {update_elapsed / len(site_readings) * 1e6:.2f} us/reading, backtest skipped (numpy not installed)")
+        return True
+    #endtry
+    freezes = sum(result['freezes'] for result in results.values())
+    warned = sum(result['warned'] for result in results.values())
+    alerts = sum(result['alerts'] for result in results.values())
+    print(f"trend update {update_elapsed / len(site_readings) * 1e6:.2f} us/reading, backtest {TREND_BENCH_SITES} sites x {TREND_BENCH_DAYS} days in {backtest_elapsed:.2f} s "
+          f"({TREND_BENCH_SITES * samples / backtest_elapsed:,.0f} readings/s): {alerts} alerts, {warned}/{freezes} freezes warned")
+    return True
+#end bench_trend
+
+#runs the default rule set over RULES_BENCH_SITES sites the way evaluate_site does, a tenth of them alerting
+def bench_rules():
+    import APRS_rules
+    generator = random.Random(5)
+    now = int(time.time())
+    compile_start = time.perf_counter()
+    plan = APRS_rules.RulePlan('bench', APRS_rules.RULE_SETS['default'])
+    compile_elapsed = time.perf_counter() - compile_start
+    rows = []
+    for site in range(RULES_BENCH_SITES):
+        internal_temp = generator.uniform(86, 95) if site % 10 == 0 else generator.uniform(50, 75)
+        bmp_temp = internal_temp + generator.uniform(-2, 2)
+        metrics = {
+            'internal_temp': internal_temp, 'bmp_temp': bmp_temp, 'sensor_gap': abs(internal_temp - bmp_temp),
+            'age_minutes': generator.uniform(0, 4), 'report_time': '', 'temperature_jump': 0,
+            'reference_temp': internal_temp, 'freeze_minutes': float('inf'), 'trend_per_hour': 0.0,
+        }
+        rules = "maximum=1@" +str(now - 600) if site % 20 == 0 else ""
+        rows.append((metrics, rules))
+    #endfor
+    #the same steps evaluate_site takes for each site: plan lookup, stored states in, rules, message, states out
+    best = None
+    for run in range(5):
+        fired = active = 0
+        start = time.perf_counter()
+        for metrics, rules in rows:
+            site_plan = APRS_rules.get_plan(None)
+            states = APRS_rules.parse_rule_states(rules, 'False', now)
+            states, active_rule, fired_rule = site_plan.evaluate(metrics, states, now)
+            if fired_rule is not None:
+                site_plan.message(fired_rule, metrics)
+                fired += 1
+            #endif
+            if active_rule is not None:
+                site_plan.message(active_rule, metrics)
+                active += 1
+            #endif
+            APRS_rules.format_rule_states(states)
+        #endfor
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    #endfor
+    per_site = best / len(rows) * 1e6
+    passed = per_site <= RULES_BUDGET_US
+    print(f"rules {len(plan.rules)} rules over {len(rows)} sites: {per_site:.2f} us/site, {len(rows) / best:,.0f} sites/s, compile {compile_elapsed * 1e6:.0f} us, "
+          f"{active} active, {fired} SMS (budget {RULES_BUDGET_US:.0f} us) {'ok' if passed else 'FAIL'}")
+    return passed
+#end bench_rules
+
+#decodes KISS_BENCH_FRAMES position reports from a byte stream cut into socket sized reads
+#one frame in eight carries an escaped byte, and one in ten is from a station nobody watches
+def bench_kiss():
+    os.environ.update({key: value for key, value in BENCH_ENVIRONMENT.items() if key not in os.environ})
+    from APRS_packet import Packet, position_comment
+    from APRS_kiss import KISSStream, encode_kiss
+    frames = []
+    for index, comment in enumerate(synthetic_comments(KISS_BENCH_FRAMES, seed=6)):
+        source = "OTHER" if index % 10 == 0 else "KD0%03d-11" %(index % 500)
+        frame = encode_kiss(Packet(source, "APLIGA", ("WIDE1-1*", "WIDE2-1"), "!4903.50N/07201.75WO" +comment))
+        if index % 8 == 0:
+            frame = frame[:-1] + b"\xdb\xdc" + frame[-1:]
+        #endif
+        frames.append(frame)
+    #endfor
+    data = b"".join(frames)
+    reads = [data[i:i + KISS_BENCH_READ] for i in range(0, len(data), KISS_BENCH_READ)]
+    best = None
+    for run in range(5):
+        stream = KISSStream()
+        start = time.perf_counter()
+        packets = []
+        for read in reads:
+            packets += stream.feed(read)
+        #endfor
+        comments = [position_comment(packet) for packet in packets]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    #endfor
+    per_frame = best / len(frames) * 1e6
+    passed = per_frame <= KISS_BUDGET_US and len(packets) == len(frames) and None not in comments
+    print(f"kiss {len(frames)} frames in {len(reads)} reads: {per_frame:.2f} us/frame, {len(frames) / best:,.0f} frames/s, {len(data) / best / 1e6:.1f} MB/s, "
+          f"{stream.dropped} dropped (budget {KISS_BUDGET_US:.0f} us) {'ok' if passed else 'FAIL'}")
+    return passed
+#end bench_kiss
+
+#returns the 95th percentile of a list, or 0 for an empty one
+def percentile_95(values):
+    values = sorted(values)
+    return values[int(len(values) * 0.95)] if values else 0
+#end percentile_95
+
+#simulates CADENCE_BENCH_SITES trackers for CADENCE_BENCH_HOURS, polled on the fixed 5 minute schedule
+#and by APRS_cadence on a 1 minute tick. Trackers beacon every 2 to 15 minutes, with a beacon age
+#limit of two and a half intervals. One in ten cools through the minimum and one in twenty goes
+#silent. Counts aprs.fi queries, and the delay from each minimum crossing and each beacon turning
+#stale to the poll that sees it. Passes when the cadence makes fewer queries without a longer delay
+def bench_cadence():
+    import math
+    import APRS_rules
+    import APRS_cadence
+    from APRS_trend import update_trend, format_trend
+    from APRS_beacons import BEACON_CLOCK_SKEW_SECONDS
+    generator = random.Random(7)
+    start = 1_800_000_000
+    end = start + CADENCE_BENCH_HOURS * 3600
+    minimum = APRS_rules.DEFAULT_PARAMETERS['minimum_temperature']
+    plans = {}
+    sites = []
+    for site in range(CADENCE_BENCH_SITES):
+        interval = generator.choice([120, 300, 600, 900])
+        if interval not in plans:
+            parameters = dict(APRS_rules.DEFAULT_PARAMETERS, maximum_beacon_age=math.ceil(interval * 2.5 / 60))
+            plans[interval] = APRS_rules.RulePlan('bench', {'parameters': parameters, 'rules': APRS_rules.DEFAULT_RULES})
+        #endif
+        sites.append({
+            'name': "SIM%05d" %site, 'interval': interval, 'phase': start + generator.uniform(0, interval), 'plan': plans[interval],
+            'base': generator.uniform(55, 75), 'cools_at': start + generator.uniform(2, CADENCE_BENCH_HOURS - 4) * 3600 if site % 10 == 3 else None,
+            'dies_at': start + generator.uniform(2, CADENCE_BENCH_HOURS - 2) * 3600 if site % 20 == 7 else None,
+        })
+    #endfor
+    def temperature(site, timestamp):
+        value = site['base'] + 5 * math.sin(timestamp / 86400 * 2 * math.pi)
+        if site['cools_at'] is not None and timestamp > site['cools_at']:
+            value = max(30, value - (timestamp - site['cools_at']) / 60 * 0.1)
+        #endif
+        return value
+    #end temperature
+    #the beacon aprs.fi returns at a time
+    def lasttime(site, timestamp):
+        timestamp = min(timestamp - CADENCE_BENCH_PUBLISH, site['dies_at'] or timestamp)
+        return int(site['phase'] + (timestamp - site['phase']) // site['interval'] * site['interval'])
+    #end lasttime
+    #the times each site's events become visible: the first beacon at or below the minimum, and turning stale
+    events = {}
+    for site in sites:
+        crossing = None
+        if site['cools_at'] is not None:
+            beacon = site['phase']
+            while beacon < end and temperature(site, beacon) > minimum:
+                beacon += site['interval']
+            #endwhile
+            crossing = beacon + CADENCE_BENCH_PUBLISH if beacon < end else None
+        #endif
+        stale = None
+        if site['dies_at'] is not None:
+            stale = lasttime(site, site['dies_at'] + CADENCE_BENCH_PUBLISH) + BEACON_CLOCK_SKEW_SECONDS + site['plan'].parameters['maximum_beacon_age'] * 60 + 1
+        #endif
+        events[site['name']] = (crossing, stale)
+    #endfor
+    def delays(polls):
+        found = {'crossing': [], 'stale': []}
+        for site in sites:
+            for kind, visible in zip(('crossing', 'stale'), events[site['name']]):
+                later = [timestamp for timestamp in polls[site['name']] if visible is not None and timestamp >= visible]
+                if later:
+                    found[kind].append(later[0] - visible)
+                #endif
+            #endfor
+        #endfor
+        return found
+    #end delays
+    #fixed schedule: every site on every poll
+    fixed_polls = {site['name']: list(range(start, end, CADENCE_BENCH_FIXED)) for site in sites}
+    fixed_queries = len(range(start, end, CADENCE_BENCH_FIXED)) * math.ceil(len(sites) / 20)
+    #adaptive schedule
+    by_name = {site['name']: site for site in sites}
+    states = {site['name']: None for site in sites}
+    trackers = {site['name']: {'trend': None, 'lasttime': 0} for site in sites}
+    polls = {site['name']: [] for site in sites}
+    queries_per_tick = max(1, int(APRS_cadence.CADENCE_BUDGET_PER_HOUR * CADENCE_BENCH_TICK / 3600))
+    adaptive_queries = 0
+    clock = time.perf_counter()
+    for now in range(start, end, CADENCE_BENCH_TICK):
+        polled, held = APRS_cadence.select_due(states, now, 20, queries_per_tick)
+        adaptive_queries += math.ceil(len(polled) / 20)
+        for name in polled:
+            site = by_name[name]
+            tracker = trackers[name]
+            beacon = lasttime(site, now)
+            if beacon > tracker['lasttime']:
+                tracker['trend'] = update_trend(tracker['trend'], beacon, temperature(site, beacon))
+                tracker['lasttime'] = beacon
+            #endif
+            stale = now - beacon - BEACON_CLOCK_SKEW_SECONDS > site['plan'].parameters['maximum_beacon_age'] * 60
+            alerting = stale or temperature(site, beacon) <= minimum + APRS_rules.DEFAULT_PARAMETERS['hysteresis']
+            tracker_state = {'alert_sent': 'True' if alerting else 'False', 'trend': format_trend(tracker['trend'])}
+            states[name] = APRS_cadence.next_cadence(states[name], beacon, now, tracker_state, site['plan'])
+            polls[name].append(now)
+        #endfor
+    #endfor
+    elapsed = time.perf_counter() - clock
+    site_hours = len(sites) * CADENCE_BENCH_HOURS
+    fixed_delays = delays(fixed_polls)
+    adaptive_delays = delays(polls)
+    for label, queries, found in (('fixed', fixed_queries, fixed_delays), ('cadence', adaptive_queries, adaptive_delays)):
+        print(f"cadence {label:<7} {queries} queries, {queries / site_hours:.3f} queries/site/hour, "
+              f"crossings {len(found['crossing'])} seen p95 {percentile_95(found['crossing']):.0f} s, stale {len(found['stale'])} seen p95 {percentile_95(found['stale']):.0f} s")
+    #endfor
+    passed = (adaptive_queries < fixed_queries
+              and all(len(adaptive_delays[kind]) >= len(fixed_delays[kind]) and percentile_95(adaptive_delays[kind]) <= percentile_95(fixed_delays[kind]) for kind in fixed_delays))
+    print(f"cadence {len(sites)} sites over {CADENCE_BENCH_HOURS} h simulated in {elapsed:.2f} s: {1 - adaptive_queries / fixed_queries:.0%} fewer queries {'ok' if passed else 'FAIL'}")
+    return passed
+#end bench_cadence
+
+#runs RATELIMIT_BENCH_THREADS commands at once against one number's bucket, each round on a new number
+#with an empty local bucket, as if every command landed in its own container
+#passes if no round lets more than the burst through
+def bench_ratelimit():
+    import APRS_state
+    import APRS_ratelimit
+    class SlowMemoryStateStore(APRS_state.MemoryStateStore):
+        def _read_chunk(self, names):
+            time.sleep(RATELIMIT_BENCH_LATENCY)
+            return super()._read_chunk(names)
+        #end _read_chunk
+
+        def _create(self, name, attributes):
+            time.sleep(RATELIMIT_BENCH_LATENCY)
+            return super()._create(name, attributes)
+        #end _create
+
+        def _update_if(self, name, attributes, attribute, expected):
+            time.sleep(RATELIMIT_BENCH_LATENCY)
+            return super()._update_if(name, attributes, attribute, expected)
+        #end _update_if
+    #end SlowMemoryStateStore
+    APRS_state.STATE_BACKENDS['bench'] = SlowMemoryStateStore
+    backend, APRS_state.STATE_BACKEND = APRS_state.STATE_BACKEND, 'bench'
+    limits, APRS_ratelimit.RATE_LIMITS = APRS_ratelimit.RATE_LIMITS, dict(APRS_ratelimit.RATE_LIMITS, number=(RATELIMIT_BENCH_BURST, 20.0))
+    most = 0
+    start = time.perf_counter()
+    try:
+        for round_number in range(RATELIMIT_BENCH_ROUNDS):
+            number = "+1555%07d" %round_number
+            barrier = threading.Barrier(RATELIMIT_BENCH_THREADS)
+            allowed = []
+            def command():
+                barrier.wait()
+                APRS_ratelimit._local_buckets['number'].pop(number)
+                allowed.append(APRS_ratelimit.allow('number', number))
+            #end command
+            threads = [threading.Thread(target=command) for thread in range(RATELIMIT_BENCH_THREADS)]
+            for thread in threads:
+                thread.start()
+            #endfor
+            for thread in threads:
+                thread.join()
+            #endfor
+            most = max(most, sum(allowed))
+        #endfor
+    finally:
+        APRS_state.STATE_BACKEND = backend
+        APRS_ratelimit.RATE_LIMITS = limits
+        del APRS_state.STATE_BACKENDS['bench']
+    #endtry
+    elapsed = time.perf_counter() - start
+    passed = 0 < most <= RATELIMIT_BENCH_BURST
+    print(f"ratelimit {RATELIMIT_BENCH_ROUNDS} rounds of {RATELIMIT_BENCH_THREADS} concurrent commands, burst {RATELIMIT_BENCH_BURST}: at most {most} allowed in {elapsed:.2f} s {'ok' if passed else 'FAIL'}")
+    return passed
+#end bench_ratelimit
+
+#name -> benchmark. Each returns True when it is within budget
+BENCHMARKS = {
+    'imports': bench_imports,
+    'telemetry': bench_telemetry,
+    'state': bench_state,
+    'webhook': bench_webhook,
+    'history': bench_history,
+    'trend': bench_trend,
+    'rules': bench_rules,
+    'kiss': bench_kiss,
+    'cadence': bench_cadence,
+    'ratelimit': bench_ratelimit,
+}
+
+def main(argv):
+    selected = argv or list(BENCHMARKS)
+    passed = True
+    for name in selected:
+        passed = BENCHMARKS[name]() and passed
+    #endfor
+    return 0 if passed else 1
+#end main
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#eof
@@ -0,0 +1,71 @@
+import time
+import threading
+from collections import OrderedDict
+
+#small in-process caches that live for the life of a warm container
+
+#marker for a cache miss, so None can be cached as a value
+MISSING = object()
+
+#bounded least recently used cache whose entries expire after ttl seconds
+#safe to share between the worker threads of one container
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    #end __init__
+
+    #returns the cached value, or default if it is missing or expired
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                #endif
+                self.misses += 1
+                return default
+            #endif
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        #endwith
+    #end get
+
+    #caches a value, evicting the least recently used entry when full
+    #ttl overrides the cache's default lifetime for this entry
+    def put(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            #endwhile
+        #endwith
+    #end put
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        #endwith
+        return default if entry is None else entry[1]
+    #end pop
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        #endwith
+    #end clear
+
+    def __len__(self):
+        return len(self._entries)
+    #end __len__
+#end TTLCache
+
+#eof
@@ -0,0 +1,231 @@
+import os
+import math
+import logging
+from typing import NamedTuple
+
+from APRS_state import get_state_store
+from APRS_trend import TREND_MIN_SAMPLES, parse_trend, minutes_until
+from APRS_rules import get_plan
+from APRS_beacons import BEACON_CLOCK_SKEW_SECONDS
+
+#setup logger
+logger = logging.getLogger()
+
+#adaptive polling cadence. Instead of querying every site on every tick, each site gets a window to
+#be polled in: from just after its next beacon is expected, to the latest time that still sees a
+#crossing or a stale beacon sooner than the fixed schedule would. The beacon interval is learned from
+#the lasttime deltas aprs.fi reports. A site far from its thresholds skips beacons for as long as the
+#temperature could not reach one even at CADENCE_MAX_RATE, and has a wide window; a site near a
+#threshold, trending toward the minimum or with a late beacon is polled as soon as it is due.
+#A stale or missing site backs off. A tick queries aprs.fi only once a window closes or the due sites
+#fill a query, and then takes every due site along, so the polls of many sites share each query.
+#At most CADENCE_BUDGET_PER_HOUR queries an hour are made across all shards, closing windows first.
+#One item per site: interval, lasttime, next_poll, deadline, idle (polls since the last new beacon).
+#The tick has to run more often than the beacons: on a 5 minute schedule every window is rounded up
+#to whole ticks and alerts come later than with the fixed poll. To enable it, change the schedule to
+#rate(1 minute) and set CADENCE_ENABLED=1 and CADENCE_TICK_SECONDS=60
+CADENCE_DOMAIN = 'APRS_cadence'
+
+#longest tick the cadence works with
+CADENCE_MAX_TICK_SECONDS = 60
+#seconds between ticks, from the schedule. The query budget is spread over the ticks
+CADENCE_TICK_SECONDS = int(os.environ.get('CADENCE_TICK_SECONDS', '300'))
+#off by default, polling every site on every tick. Only enabled with a tick of a minute or less
+CADENCE_ENABLED = os.environ.get('CADENCE_ENABLED', '0') == '1' and CADENCE_TICK_SECONDS <= CADENCE_MAX_TICK_SECONDS
+if os.environ.get('CADENCE_ENABLED', '0') == '1' and not CADENCE_ENABLED:
+    logger.warning("CAD:CADENCE_ENABLED needs CADENCE_TICK_SECONDS of " +str(CADENCE_MAX_TICK_SECONDS) +" or less and a schedule to match. Polling every site on every tick")
+#endif
+#aprs.fi queries an hour for all sites together. Each query carries up to 20 names
+CADENCE_BUDGET_PER_HOUR = int(os.environ.get('CADENCE_BUDGET_PER_HOUR', '600'))
+#beacon interval assumed until one is learned, and the range a learned interval is held to
+CADENCE_DEFAULT_INTERVAL = 300
+CADENCE_MIN_INTERVAL = 60
+CADENCE_MAX_INTERVAL = 3600
+#weight of each new lasttime delta in the learned interval
+CADENCE_ALPHA = float(os.environ.get('CADENCE_ALPHA', '0.3'))
+#seconds after the expected beacon before polling, for aprs.fi to receive and publish it
+CADENCE_GRACE_SECONDS = int(os.environ.get('CADENCE_GRACE_SECONDS', '20'))
+#longest a site goes without a poll, however stable or stale it is
+CADENCE_MAX_SECONDS = int(os.environ.get('CADENCE_MAX_SECONDS', '1800'))
+#fastest believable temperature change in degrees per minute. A site is given as long between polls
+#as the temperature takes to reach a threshold at this rate
+CADENCE_MAX_RATE = float(os.environ.get('CADENCE_MAX_RATE', '0.5'))
+#seconds a window may stay open after a crossing or a stale beacon could first be seen, so more sites
+#share each query. Detection is still quicker than on the fixed 5 minute schedule
+CADENCE_TOLERANCE_SECONDS = int(os.environ.get('CADENCE_TOLERANCE_SECONDS', '120'))
+
+#per site cadence
+class CadenceState(NamedTuple):
+    interval: float
+    lasttime: int
+    next_poll: int
+    deadline: int
+    idle: int
+#end CadenceState
+
+#parses a cadence item. Returns None if there is none
+def parse_cadence(item):
+    if not item:
+        return None
+    #endif
+    return CadenceState(float(item['interval']), int(item['lasttime']), int(item['next_poll']), int(item['deadline']), int(item['idle']))
+#end parse_cadence
+
+#formats a state as cadence item attributes
+def format_cadence(state):
+    return {'interval': "%.1f" %state.interval, 'lasttime': state.lasttime, 'next_poll': state.next_poll,
+            'deadline': state.deadline, 'idle': state.idle}
+#end format_cadence
+
+#returns the interval after a new beacon at lasttime
+#a delta spanning several intervals is taken as missed beacons, unless a poll in between found none
+def learn_interval(previous, lasttime):
+    if previous is None or previous.lasttime <= 0:
+        return CADENCE_DEFAULT_INTERVAL
+    #endif
+    delta = lasttime - previous.lasttime
+    beats = 1 if previous.idle else max(1, round(delta / previous.interval))
+    interval = previous.interval + CADENCE_ALPHA * (delta / beats - previous.interval)
+    return min(max(interval, CADENCE_MIN_INTERVAL), CADENCE_MAX_INTERVAL)
+#end learn_interval
+
+#returns the seconds a site's temperature needs to reach a threshold at CADENCE_MAX_RATE, from either
+#side, so a site in alert is measured to where the alert clears
+#0 for a site that has to be polled after every beacon: a trend heading for the minimum, or too few
+#readings for a trend
+#tracker_state is the site's tracker item after this cycle, plan its compiled rule set
+def safe_seconds(tracker_state, plan):
+    if tracker_state is None:
+        return 0
+    #endif
+    trend = parse_trend(tracker_state.get('trend'))
+    if trend is None or trend.count < TREND_MIN_SAMPLES:
+        return 0
+    #endif
+    parameters = plan.parameters
+    freeze_minutes = minutes_until(trend, parameters['minimum_temperature'])
+    if freeze_minutes is not None and freeze_minutes <= 2 * parameters['freeze_horizon']:
+        return 0
+    #endif
+    margin = min(abs(trend.level - parameters['minimum_temperature']), abs(parameters['maximum_temperature'] - trend.level))
+    return min(margin / CADENCE_MAX_RATE * 60, CADENCE_MAX_SECONDS)
+#end safe_seconds
+
+#returns the site's cadence after a poll at now
+#lasttime is the beacon time aprs.fi returned, or None if it returned no entry for the site
+#a poll before the site was due that found no new beacon leaves the schedule as it was
+def next_cadence(previous, lasttime, now, tracker_state, plan):
+    if previous is not None and now < previous.next_poll and (lasttime or 0) <= previous.lasttime:
+        return previous
+    #endif
+    interval = previous.interval if previous is not None else CADENCE_DEFAULT_INTERVAL
+    known_lasttime = previous.lasttime if previous is not None else 0
+    idle = previous.idle + 1 if previous is not None else 1
+    if lasttime is not None and lasttime > known_lasttime:
+        interval = learn_interval(previous, lasttime)
+        known_lasttime = lasttime
+        idle = 0
+    #endif
+    safe = safe_seconds(tracker_state, plan)
+    #the beacon age rule has to see the site once the beacon is too old
+    stale_at = known_lasttime + BEACON_CLOCK_SKEW_SECONDS + plan.parameters['maximum_beacon_age'] * 60 + 1
+    if lasttime is None or now >= stale_at:
+        #stale or unknown. Back off, doubling per empty poll, with as long again to share a query
+        delay = min(interval * 2 ** min(idle, 8), CADENCE_MAX_SECONDS)
+        next_poll = now + delay
+        deadline = next_poll + delay
+    elif idle == 0:
+        #the window opens after the last beacon the temperature cannot cross a threshold by, and closes
+        #CADENCE_TOLERANCE_SECONDS after the first one it could, or after the beacon would turn stale if
+        #that is sooner. A site that could cross by its next beacon has no window
+        beats = int(min(safe, stale_at - known_lasttime - CADENCE_GRACE_SECONDS) // interval)
+        expected = known_lasttime + interval * max(1, beats)
+        if expected + CADENCE_GRACE_SECONDS <= now:
+            expected += interval * math.ceil((now - expected - CADENCE_GRACE_SECONDS) / interval)
+        #endif
+        next_poll = min(expected + CADENCE_GRACE_SECONDS, stale_at)
+        deadline = min(expected + interval + CADENCE_GRACE_SECONDS, stale_at) + CADENCE_TOLERANCE_SECONDS if beats else next_poll
+    else:
+        #the beacon is late. Look again soon, and when it turns stale
+        next_poll = now + min(interval / 4 * 2 ** (idle - 1), stale_at - now)
+        deadline = next_poll
+    #endif
+    next_poll = int(min(max(next_poll, now + CADENCE_MIN_INTERVAL / 2), now + CADENCE_MAX_SECONDS))
+    return CadenceState(interval, known_lasttime, next_poll, int(max(deadline, next_poll)), idle)
+#end next_cadence
+
+#picks the sites to poll at now from site name -> cadence state, in order
+#a site without a state is polled at once. aprs.fi is only queried once a due site's window closes
+#or the due sites fill a query. Then every due site is polled, those whose window closes first
+#while the query budget lasts, and names left over in the last query are filled with the sites due
+#next, which costs no extra query
+#returns (names to poll, number of due sites held back)
+def select_due(states, now, names_per_query, queries):
+    due = []
+    upcoming = []
+    for name, state in states.items():
+        if state is None:
+            due.append((0, name))
+        elif state.next_poll <= now:
+            due.append((state.deadline, name))
+        else:
+            upcoming.append((state.next_poll, name))
+        #endif
+    #endfor
+    due.sort()
+    if not due or (due[0][0] > now and len(due) < names_per_query):
+        return [], len(due)
+    #endif
+    polled = [name for deadline, name in due[:queries * names_per_query]]
+    if len(polled) == len(due):
+        upcoming.sort()
+        polled += [name for next_poll, name in upcoming[:-len(polled) % names_per_query]]
+    #endif
+    return polled, len(due) - min(len(due), len(polled))
+#end select_due
+
+#picks the subscriptions to poll this tick from (callsign, SMS_to, expires), as select_due does
+#items of ended subscriptions are deleted
+#returns (subscriptions to poll, number of due sites held back)
+def due_subscriptions(subscriptions, now, names_per_query):
+    store = get_state_store(CADENCE_DOMAIN)
+    items = store.scan()
+    by_name = {subscription[0].upper(): subscription for subscription in subscriptions}
+    for name in items:
+        if name not in by_name:
+            store.delete(name)
+        #endif
+    #endfor
+    queries = max(1, int(CADENCE_BUDGET_PER_HOUR * CADENCE_TICK_SECONDS / 3600))
+    polled, held = select_due({name: parse_cadence(items.get(name)) for name in by_name}, now, names_per_query, queries)
+    if len(polled) >= queries * names_per_query and held:
+        logger.warning("CAD:query budget of " +str(queries) +" per tick reached, " +str(held) +" due sites deferred")
+    #endif
+    return [by_name[name] for name in polled], held
+#end due_subscriptions
+
+#records this cycle's polls and schedules each site's next one
+#entries is name -> aprs.fi entry for the names that returned one, tracker_store the cycle's
+#flushed tracker state. Sites whose query failed are left due, so the next tick retries them
+def record_polls(names, entries, tracker_store, now, workers=1):
+    store = get_state_store(CADENCE_DOMAIN)
+    store.load(names)
+    for name in names:
+        entry = entries.get(name)
+        lasttime = int(entry['lasttime']) if entry is not None and str(entry.get('lasttime', '')).isdigit() else None
+        previous = parse_cadence(store.get(name))
+        tracker_state = tracker_store.get(name)
+        plan = get_plan(tracker_state.get('rule_set') if tracker_state is not None else None)
+        state = next_cadence(previous, lasttime, now, tracker_state, plan)
+        if state is previous:
+            store.skip(name)
+        else:
+            store.stage(name, format_cadence(state))
+        #endif
+    #endfor
+    for name, message in store.flush(workers).items():
+        logger.error("CAD:" +message)
+    #endfor
+#end record_polls
+
+#eof
@@ -0,0 +1,188 @@
+import os
+import json
+import logging
+import threading
+import functools
+
+#setup logger
+logger = logging.getLogger()
+
+#shared client registry
+#clients live at module level so a warm Lambda container reuses them between invocations
+#keeping TLS sessions, keep-alive pools, and resolved credentials
+#boto3, urllib3 and twilio are imported inside the factories, so an invocation only pays
+#for the libraries its code path actually touches
+_clients = {}
+_client_lock = threading.Lock()
+_client_stats = {}
+
+#exception names that indicate a dropped or stale connection rather than a service error
+STALE_CONNECTION_ERRORS = {
+    'ConnectionError',
+    'ConnectionResetError',
+    'ConnectionAbortedError',
+    'BrokenPipeError',
+    'RemoteDisconnected',
+    'ProtocolError',
+    'NewConnectionError',
+    'MaxRetryError',
+    'EndpointConnectionError',
+    'ConnectionClosedError',
+}
+
+#set TWILIO_SDK=1 to send through the twilio package instead of the built in REST sender
+USE_TWILIO_SDK = os.environ.get('TWILIO_SDK', '0') == '1'
+
+#set APRS_RECORD_PATH to append every handler event to that file, for replay with APRS_replay
+#events are written as they arrive, phone numbers included, so only turn this on for a capture
+APRS_RECORD_PATH = os.environ.get('APRS_RECORD_PATH', '')
+_record_lock = threading.Lock()
+
+def _build_boto3(service):
+    import boto3
+    return boto3.client(service)
+#end _build_boto3
+
+#builds the shared http pool. Retries cover connections the server closed while we were idle
+def _build_http():
+    import urllib3
+    return urllib3.PoolManager(
+        num_pools=4,
+        maxsize=10,
+        retries=urllib3.Retry(total=2, connect=2, read=1, backoff_factor=0.2),
+        timeout=urllib3.Timeout(connect=3.0, read=10.0)
+    )
+#end _build_http
+
+def _build_twilio():
+    if USE_TWILIO_SDK:
+        from twilio.rest import Client
+    else:
+        from APRS_twilio import TwilioRestClient as Client
+    #endif
+    return Client(os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'])
+#end _build_twilio
+
+#client name -> factory. Factories only run the first time a client is requested
+CLIENT_FACTORIES = {
+    'sdb': lambda: _build_boto3('sdb'),
+    'scheduler': lambda: _build_boto3('scheduler'),
+    'sqs': lambda: _build_boto3('sqs'),
+    'lambda': lambda: _build_boto3('lambda'),
+    's3': lambda: _build_boto3('s3'),
+    'twilio': _build_twilio,
+    'http': _build_http,
+}
+
+#returns the shared client for name, building it on first use
+def get_client(name):
+    client = _clients.get(name)
+    if client is not None:
+        _count(name, 'hits')
+        return client
+    #endif
+    with _client_lock:
+        #another thread may have built it while we waited
+        client = _clients.get(name)
+        if client is None:
+            logger.info("CLI:building client " +name)
+            client = CLIENT_FACTORIES[name]()
+            _clients[name] = client
+            _count(name, 'misses')
+        else:
+            _count(name, 'hits')
+        #endif
+    #endwith
+    return client
+#end get_client
+
+#drops a client so the next request builds a fresh one
+def reset_client(name):
+    with _client_lock:
+        client = _clients.pop(name, None)
+    #endwith
+    if client is not None:
+        _count(name, 'resets')
+        try:
+            if hasattr(client, 'clear'):
+                client.clear()
+            elif hasattr(client, 'close'):
+                client.close()
+            #endif
+        except Exception as err:
+            logger.info("CLI:error closing stale client " +name +(f": {type(err).__name__}"))
+        #endtry
+    #endif
+#end reset_client
+
+#true if the exception, or anything it wraps, looks like a stale connection
+def is_stale_connection(err):
+    while err is not None:
+        if any(cls.__name__ in STALE_CONNECTION_ERRORS for cls in type(err).__mro__):
+            return True
+        #endif
+        err = err.__cause__ or err.__context__
+    #endwhile
+    return False
+#end is_stale_connection
+
+#runs action(client). If the connection has gone stale, rebuilds the client and tries once more
+def call_with_client(name, action):
+    try:
+        return action(get_client(name))
+    except Exception as err:
+        if not is_stale_connection(err):
+            raise
+        #endif
+        logger.info("CLI:stale connection on " +name +(f" ({type(err).__name__}), rebuilding client"))
+        reset_client(name)
+        return action(get_client(name))
+    #endtry
+#end call_with_client
+
+def _count(name, field):
+    counters = _client_stats.setdefault(name, {'hits': 0, 'misses': 0, 'resets': 0})
+    counters[field] += 1
+#end _count
+
+#returns a copy of the per client hit / miss / reset counters for this container
+def client_stats():
+    return {name: dict(counters) for name, counters in _client_stats.items()}
+#end client_stats
+
+#logs the reuse counters once per invocation
+def log_client_stats():
+    hits = sum(counters['hits'] for counters in _client_stats.values())
+    misses = sum(counters['misses'] for counters in _client_stats.values())
+    total = hits + misses
+    reuse_rate = (hits / total) if total else 0.0
+    logger.info("CLI:client reuse " +(f"{reuse_rate:.2%}") +" " +json.dumps(client_stats()))
+#end log_client_stats
+
+#appends one handler event to the APRS_RECORD_PATH file as a JSON line
+def record_event(handler_name, event):
+    line = json.dumps({'handler': handler_name, 'event': event}) + "\n"
+    with _record_lock:
+        with open(APRS_RECORD_PATH, 'a') as record_file:
+            record_file.write(line)
+        #endwith
+    #endwith
+#end record_event
+
+#decorator for lambda handlers. Logs client reuse after every invocation, however it returns
+def with_client_stats(handler):
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if APRS_RECORD_PATH:
+            record_event(handler.__module__, event)
+        #endif
+        try:
+            return handler(event, context)
+        finally:
+            log_client_stats()
+        #endtry
+    #end wrapper
+    return wrapper
+#end with_client_stats
+
+#eof
@@ -0,0 +1,45 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#setup logger
+logger = logging.getLogger()
+
+#concurrent fan-out for multi site cycles
+#boto3, urllib3 and the Twilio sender are all blocking, so this uses a bounded thread pool
+#rather than asyncio. Each external dependency has its own limit, so a slow Twilio call
+#holds one Twilio slot and nothing else
+
+#default number of sites worked on at once. 1 keeps the serial behaviour
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', '1'))
+
+#maximum calls in flight per external dependency, per container
+DEPENDENCY_LIMITS = {
+    'aprs': int(os.environ.get('APRS_CONCURRENCY', '4')),
+    'sdb': int(os.environ.get('SDB_CONCURRENCY', '8')),
+    'twilio': int(os.environ.get('TWILIO_CONCURRENCY', '4')),
+}
+
+_slots = {name: threading.BoundedSemaphore(limit) for name, limit in DEPENDENCY_LIMITS.items()}
+
+#returns the semaphore guarding a dependency. Use as: with dependency_slot('twilio'): ...
+def dependency_slot(name):
+    return _slots[name]
+#end dependency_slot
+
+#applies func to every item and returns the results in order
+#with workers <= 1 this is a plain serial loop. Exceptions propagate from the item that raised them
+def run_concurrently(func, items, workers=None):
+    items = list(items)
+    workers = NOTIFY_WORKERS if workers is None else workers
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    #endif
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='APRS') as executor:
+        return list(executor.map(func, items))
+    #endwith
+#end run_concurrently
+
+#eof
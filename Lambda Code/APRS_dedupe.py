@@ -0,0 +1,95 @@
+import os
+import time
+import logging
+
+from APRS_cache import TTLCache, MISSING
+from APRS_state import get_state_store
+
+#setup logger
+logger = logging.getLogger()
+
+#webhook retry dedupe
+#Twilio retries a webhook that answers slowly, with the same MessageSid. The first request to
+#arrive claims the MessageSid in the state store; retries get the reply recorded for it instead
+#of running the command again. Warm containers answer repeat retries from memory
+WEBHOOK_DOMAIN = 'APRS_webhooks'
+
+#how long a handled MessageSid is remembered, in seconds
+DEDUPE_TTL_SECONDS = int(os.environ.get('DEDUPE_TTL_SECONDS', '600'))
+#a claim with no reply after this many seconds is treated as abandoned and may be taken over
+DEDUPE_CLAIM_TIMEOUT_SECONDS = int(os.environ.get('DEDUPE_CLAIM_TIMEOUT_SECONDS', '60'))
+
+#MessageSid -> reply, for the life of the warm container
+_replies = TTLCache(maxsize=1024, ttl=DEDUPE_TTL_SECONDS)
+
+#returns the reply this container recorded for a MessageSid, or MISSING. Makes no network call
+def local_reply(message_sid):
+    return _replies.get(message_sid, MISSING)
+#end local_reply
+
+#claims a MessageSid for processing
+#returns (True, None) if the caller should process the message, or (False, reply) for a retry.
+#reply is None while the first request is still working on it
+def claim_message(message_sid, now=None):
+    reply = local_reply(message_sid)
+    if reply is not MISSING:
+        return False, reply
+    #endif
+    now = int(now or time.time())
+    try:
+        store = get_state_store(WEBHOOK_DOMAIN)
+        if store.create(message_sid, {'received': now, 'status': 'pending'}):
+            return True, None
+        #endif
+        claim = store.get(message_sid)
+        if claim is None:
+            #purged between the create and the read, so nobody holds it now
+            return True, None
+        elif claim['status'] == 'done':
+            _replies.put(message_sid, claim['reply'])
+            return False, claim['reply']
+        elif now - int(claim['received']) > DEDUPE_CLAIM_TIMEOUT_SECONDS:
+            #only one of several retries timing out together wins the takeover
+            if store.update_if(message_sid, {'received': now}, 'received', claim['received']):
+                logger.info("Taking over abandoned claim for: " +message_sid)
+                return True, None
+            #endif
+        #endif
+    except Exception as err:
+        #without the dedupe table, process the message. The outbox still keys the reply on the MessageSid
+        logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+        return True, None
+    #endtry
+    return False, None
+#end claim_message
+
+#records the reply sent for a claimed MessageSid, so retries can be answered with it
+def record_reply(message_sid, reply):
+    _replies.put(message_sid, reply)
+    try:
+        store = get_state_store(WEBHOOK_DOMAIN)
+        store.stage(message_sid, {'status': 'done', 'reply': reply})
+        failed = store.flush()
+        if failed:
+            logger.error(failed[message_sid])
+        #endif
+    except Exception as err:
+        logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+    #endtry
+#end record_reply
+
+#deletes MessageSids older than the dedupe window. Returns the number removed
+def purge_messages(now=None):
+    now = int(now or time.time())
+    store = get_state_store(WEBHOOK_DOMAIN)
+    purged = 0
+    for message_sid, claim in store.scan().items():
+        if now - int(claim['received']) > DEDUPE_TTL_SECONDS:
+            store.delete(message_sid)
+            purged += 1
+        #endif
+    #endfor
+    return purged
+#end purge_messages
+
+#eof
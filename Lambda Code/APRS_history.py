@@ -0,0 +1,348 @@
+import os
+import struct
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from typing import NamedTuple
+
+from APRS_clients import get_client
+from APRS_concurrency import run_concurrently
+from APRS_metrics import timer
+
+#setup logger
+logger = logging.getLogger()
+
+#append only telemetry history
+#each site's readings are kept in time bucketed segments, one per HISTORY_SEGMENT_SECONDS.
+#A segment is a small header followed by fixed width packed records, so a day of 5 minute
+#samples is a few kilobytes and decodes with a single struct.iter_unpack.
+#Delta segments store each reading as hundredths offset from the segment's first reading in
+#16 bits, which is 12 bytes a record instead of 20. A reading that does not fit rewrites the
+#segment in the raw layout
+#backends: local files for testing, an S3 bucket in production
+#in Lambda /tmp belongs to one container and is lost on a cold start, so the backend defaults to S3
+#there and HISTORY_BUCKET has to be set. Without it history is off: one warning is logged per
+#container, and the handlers run without a history store
+
+#one segment per site per UTC day
+HISTORY_SEGMENT_SECONDS = int(os.environ.get('HISTORY_SEGMENT_SECONDS', '86400'))
+HISTORY_BACKEND = os.environ.get('HISTORY_BACKEND', 's3' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'file')
+HISTORY_PATH = os.environ.get('HISTORY_PATH', '/tmp/APRS_history')
+HISTORY_BUCKET = os.environ.get('HISTORY_BUCKET', '')
+HISTORY_PREFIX = os.environ.get('HISTORY_PREFIX', 'history/')
+#set HISTORY_DELTA=0 to write new segments in the raw layout
+HISTORY_DELTA = os.environ.get('HISTORY_DELTA', '1') == '1'
+
+#segment header: magic, version, encoding, reserved, base timestamp and base readings
+SEGMENT_MAGIC = b'APRH'
+SEGMENT_VERSION = 1
+ENCODING_RAW = 0
+ENCODING_DELTA = 1
+HEADER = struct.Struct('<4sBBHIffff')
+#raw record: epoch seconds, internal temp, BMP temp, pressure, battery
+RAW_RECORD = struct.Struct('<Iffff')
+#delta record: seconds and hundredths offset from the header's base reading
+DELTA_RECORD = struct.Struct('<Ihhhh')
+DELTA_SCALE = 100
+DELTA_LIMIT = 32767
+
+#one telemetry reading
+class HistoryRecord(NamedTuple):
+    timestamp: int
+    internal_temp: float
+    bmp_temp: float
+    pressure: float
+    battery: float
+#end HistoryRecord
+
+#returns the start of the segment holding timestamp
+def segment_start(timestamp):
+    return int(timestamp) - int(timestamp) % HISTORY_SEGMENT_SECONDS
+#end segment_start
+
+#returns the header for a new segment starting with record, in the chosen encoding
+def encode_header(record, encoding):
+    return HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, encoding, 0, *record)
+#end encode_header
+
+#packs records relative to a header. Returns None if a delta record does not fit
+def encode_records(records, encoding, base):
+    if encoding == ENCODING_RAW:
+        return b"".join(RAW_RECORD.pack(*record) for record in records)
+    #endif
+    packed = []
+    for record in records:
+        offsets = [round((value - base_value) * DELTA_SCALE) for value, base_value in zip(record[1:], base[1:])]
+        if max(offsets) > DELTA_LIMIT or min(offsets) < -DELTA_LIMIT or record[0] < base[0]:
+            return None
+        #endif
+        packed.append(DELTA_RECORD.pack(record[0] - base[0], *offsets))
+    #endfor
+    return b"".join(packed)
+#end encode_records
+
+#encodes a whole segment, delta if every record fits and it is enabled, raw otherwise
+def encode_segment(records, delta=None):
+    delta = HISTORY_DELTA if delta is None else delta
+    if delta:
+        header = encode_header(records[0], ENCODING_DELTA)
+        #offsets are taken from the base as stored, in single precision, so they decode exactly
+        body = encode_records(records, ENCODING_DELTA, segment_header(header)[1])
+        if body is not None:
+            return header + body
+        #endif
+    #endif
+    return encode_header(records[0], ENCODING_RAW) + encode_records(records, ENCODING_RAW, records[0])
+#end encode_segment
+
+#returns (encoding, base record) for a segment, or None for an empty segment
+def segment_header(data):
+    if len(data) < HEADER.size:
+        return None
+    #endif
+    magic, version, encoding, reserved, *base = HEADER.unpack_from(data)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        raise ValueError("not a history segment")
+    #endif
+    return encoding, HistoryRecord(*base)
+#end segment_header
+
+#decodes a segment into a list of records. A torn trailing record is ignored
+def decode_segment(data):
+    header = segment_header(data)
+    if header is None:
+        return []
+    #endif
+    encoding, base = header
+    record = DELTA_RECORD if encoding == ENCODING_DELTA else RAW_RECORD
+    end = HEADER.size + (len(data) - HEADER.size) // record.size * record.size
+    body = memoryview(data)[HEADER.size:end]
+    if encoding == ENCODING_RAW:
+        return [HistoryRecord(*values) for values in RAW_RECORD.iter_unpack(body)]
+    #endif
+    base_time, base_internal, base_bmp, base_pressure, base_battery = base
+    return [
+        HistoryRecord(base_time + seconds, base_internal + internal / DELTA_SCALE, base_bmp + bmp / DELTA_SCALE, base_pressure + pressure / DELTA_SCALE, base_battery + battery / DELTA_SCALE)
+        for seconds, internal, bmp, pressure, battery in DELTA_RECORD.iter_unpack(body)
+    ]
+#end decode_segment
+
+#averages records into one record per interval seconds, stamped with the interval start
+def downsample(records, interval):
+    buckets = {}
+    for record in records:
+        start = record[0] - record[0] % interval
+        bucket = buckets.get(start)
+        if bucket is None:
+            buckets[start] = [1, record[1], record[2], record[3], record[4]]
+        else:
+            bucket[0] += 1
+            bucket[1] += record[1]
+            bucket[2] += record[2]
+            bucket[3] += record[3]
+            bucket[4] += record[4]
+        #endif
+    #endfor
+    return [
+        HistoryRecord(start, internal / count, bmp / count, pressure / count, battery / count)
+        for start, (count, internal, bmp, pressure, battery) in sorted(buckets.items())
+    ]
+#end downsample
+
+#history store interface
+#stage() collects new readings during a cycle and flush() appends them, one segment write per
+#site per segment. Backends implement _read, _write and optionally _append
+class HistoryStore:
+    def __init__(self):
+        self._staged = {}
+        self._lock = threading.Lock()
+    #end __init__
+
+    def _key(self, site, start):
+        return site.upper() +"/" +str(start) +".seg"
+    #end _key
+
+    #queues a reading for a site
+    def stage(self, site, record):
+        with self._lock:
+            self._staged.setdefault(site, []).append(HistoryRecord(*record))
+        #endwith
+    #end stage
+
+    #appends every staged reading. Returns site -> error message for sites that failed
+    def flush(self, workers=1):
+        with self._lock:
+            staged = list(self._staged.items())
+            self._staged = {}
+        #endwith
+        failed = {}
+        for site, error in zip([site for site, records in staged], run_concurrently(self._flush_site, staged, workers)):
+            if error:
+                failed[site] = error
+            #endif
+        #endfor
+        return failed
+    #end flush
+
+    def _flush_site(self, staged):
+        site, records = staged
+        try:
+            segments = {}
+            for record in sorted(records):
+                segments.setdefault(segment_start(record[0]), []).append(record)
+            #endfor
+            with timer('history'):
+                for start, segment_records in segments.items():
+                    self.append(site, start, segment_records)
+                #endfor
+            #endwith
+        except Exception as err:
+            message = "Exception in HIS: " +(f"{type(err).__name__} was raised: {err}")
+            logger.exception(message)
+            return message
+        #endtry
+        return None
+    #end _flush_site
+
+    #appends time ordered records to one segment. Readings at or before the segment's last one are dropped
+    def append(self, site, start, records):
+        key = self._key(site, start)
+        data = self._read(key)
+        header = segment_header(data)
+        if header is None:
+            self._write(key, encode_segment(records))
+            return
+        #endif
+        existing = decode_segment(data)
+        if existing:
+            records = [record for record in records if record[0] > existing[-1][0]]
+        #endif
+        if not records:
+            return
+        #endif
+        encoding, base = header
+        tail = encode_records(records, encoding, base)
+        if tail is None:
+            #a reading outside the delta range, rewrite the whole segment in the raw layout
+            self._write(key, encode_segment(existing + records, delta=False))
+        else:
+            record_size = DELTA_RECORD.size if encoding == ENCODING_DELTA else RAW_RECORD.size
+            self._append(key, data, HEADER.size + len(existing) * record_size, tail)
+        #endif
+    #end append
+
+    #adds tail to a segment. The default rewrites the whole segment, length is where the records end
+    def _append(self, key, data, length, tail):
+        self._write(key, bytes(data[:length]) + tail)
+    #end _append
+
+    #returns a site's readings with start <= timestamp <= end, oldest first
+    def query(self, site, start, end, workers=1):
+        keys = [self._key(site, segment) for segment in range(segment_start(start), int(end) + 1, HISTORY_SEGMENT_SECONDS)]
+        records = []
+        for data in run_concurrently(self._read, keys, workers):
+            segment_records = decode_segment(data)
+            if segment_records:
+                timestamps = [record[0] for record in segment_records]
+                records.extend(segment_records[bisect_left(timestamps, start):bisect_right(timestamps, end)])
+            #endif
+        #endfor
+        return records
+    #end query
+#end HistoryStore
+
+#history kept as one file per segment under a local directory
+class FileHistoryStore(HistoryStore):
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path or HISTORY_PATH
+    #end __init__
+
+    def _read(self, key):
+        try:
+            with open(os.path.join(self.path, key), 'rb') as segment:
+                return segment.read()
+            #endwith
+        except FileNotFoundError:
+            return b""
+        #endtry
+    #end _read
+
+    def _write(self, key, data):
+        path = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'wb') as segment:
+            segment.write(data)
+        #endwith
+        os.replace(path + ".tmp", path)
+    #end _write
+
+    #files can be appended in place. A torn record left by a crash is cut off first
+    def _append(self, key, data, length, tail):
+        with open(os.path.join(self.path, key), 'r+b') as segment:
+            segment.truncate(length)
+            segment.seek(length)
+            segment.write(tail)
+        #endwith
+    #end _append
+#end FileHistoryStore
+
+#history kept as one object per segment in an S3 bucket
+#objects cannot be appended, so an append rewrites the segment. A day is a few kilobytes
+class S3HistoryStore(HistoryStore):
+    def __init__(self, bucket=None, prefix=None):
+        super().__init__()
+        self.bucket = bucket or HISTORY_BUCKET
+        self.prefix = HISTORY_PREFIX if prefix is None else prefix
+    #end __init__
+
+    #raises ValueError if no bucket is configured, rather than quietly keeping no history
+    def _check_bucket(self):
+        if not self.bucket:
+            raise ValueError("HISTORY_BUCKET is not set. The file history backend is for local runs only")
+        #endif
+    #end _check_bucket
+
+    def _read(self, key):
+        self._check_bucket()
+        try:
+            return get_client('s3').get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except Exception as err:
+            #botocore is not imported here, so match the error code rather than the class
+            if getattr(err, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return b""
+            #endif
+            raise
+        #endtry
+    #end _read
+
+    def _write(self, key, data):
+        self._check_bucket()
+        get_client('s3').put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType='application/octet-stream')
+    #end _write
+#end S3HistoryStore
+
+#backend name -> history store class
+HISTORY_BACKENDS = {
+    'file': FileHistoryStore,
+    's3': S3HistoryStore,
+}
+
+#set once the container has warned that history is off
+_disabled_logged = False
+
+#returns a new history store on the configured backend, or None if history is off
+def get_history_store(backend=None):
+    global _disabled_logged
+    backend = backend or HISTORY_BACKEND
+    if backend == 's3' and not HISTORY_BUCKET:
+        if not _disabled_logged:
+            logger.warning("HIS:HISTORY_BUCKET is not set, telemetry history is off")
+            _disabled_logged = True
+        #endif
+        return None
+    #endif
+    return HISTORY_BACKENDS[backend]()
+#end get_history_store
+
+#eof
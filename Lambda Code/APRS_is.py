@@ -0,0 +1,317 @@
+import os
+import sys
+import time
+import random
+import socket
+import logging
+
+from APRS_cache import TTLCache
+from APRS_packet import TNC2Stream, PacketError, parse_tnc2, position_comment
+from APRS_state import get_state_store
+from APRS_history import get_history_store
+from APRS_outbox import deliver_pending
+from APRS_subscriptions import INGEST_MODE, active_subscriptions
+from APRS_beacons import BeaconIndex, beacon_age
+from APRS_rules import get_plan
+from APRS_notify import evaluate_site, evaluate_unchanged_site, site_tag
+
+#setup logger
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+#push ingestion from APRS-IS. Runs as a long lived process, not a Lambda:
+#   python APRS_is.py
+#one connection to an APRS-IS filter port carries every subscribed callsign. Each position
+#report is evaluated by APRS_notify's evaluate_site the moment it arrives, instead of waiting
+#for the next aprs.fi poll. The subscription table is reread every APRSIS_REFRESH_SECONDS and the
+#server filter is only resent when the callsigns changed. Sites that stop beaconing are found on
+#the same timer and go through the beacon age rule as before.
+#Set INGEST_MODE=aprsis on APRS_notify and here. The tick then skips its aprs.fi poll and only purges
+#expired subscriptions, the webhook dedupe table and the outbox. With the tick still polling, each
+#beacon is evaluated twice, once with its arrival time and once with aprs.fi's lasttime.
+#Needs the same environment as APRS_notify
+
+#server to connect to, as host:port. 14580 is the user filter port
+APRSIS_SERVER = os.environ.get('APRSIS_SERVER', 'rotate.aprs2.net:14580')
+#login callsign. The -1 passcode makes the connection receive only, which is all this needs
+APRSIS_LOGIN = os.environ.get('APRSIS_LOGIN', 'N0CALL')
+APRSIS_SOFTWARE = "APRS-Monitor 1.0"
+#seconds between subscription refreshes and stale beacon checks
+APRSIS_REFRESH_SECONDS = int(os.environ.get('APRSIS_REFRESH_SECONDS', '60'))
+#servers send a keepalive comment about every 20 seconds. Silence this long means a dead link
+APRSIS_IDLE_SECONDS = 120
+#reconnect backoff, doubled after each failed attempt and jittered
+APRSIS_BACKOFF_SECONDS = 2
+APRSIS_MAX_BACKOFF_SECONDS = 300
+#a connection that stayed up this long resets the backoff
+APRSIS_STABLE_SECONDS = 300
+#callsigns per b/ budlist filter term
+APRSIS_FILTER_CALLS = 9
+#set to a file path to append every received line to it, for the stand-in server in APRS_replay
+APRSIS_CAPTURE_PATH = os.environ.get('APRSIS_CAPTURE_PATH', '')
+#a packet heard again with the same source and payload inside this many seconds is a duplicate, as
+#APRS-IS servers treat it. Over RF the direct copy and each digipeated copy arrive seconds apart
+APRSIS_DUPE_SECONDS = int(os.environ.get('APRSIS_DUPE_SECONDS', '30'))
+APRSIS_DUPE_ENTRIES = 4096
+
+#returns the server filter for a set of callsigns
+#an empty set filters on our own receive only login, which never transmits
+def build_filter(callsigns):
+    callsigns = sorted(callsigns) or [APRSIS_LOGIN]
+    return " ".join("b/" +"/".join(callsigns[i:i + APRSIS_FILTER_CALLS]) for i in range(0, len(callsigns), APRSIS_FILTER_CALLS))
+#end build_filter
+
+#returns the reconnect delay after a number of consecutive failures
+def backoff(failures):
+    delay = min(APRSIS_BACKOFF_SECONDS * (2 ** failures), APRSIS_MAX_BACKOFF_SECONDS)
+    return delay / 2 + random.uniform(0, delay / 2)
+#end backoff
+
+#the alert pipeline for pushed packets, shared by the APRS-IS client and the KISS gateway in APRS_kiss
+#keeps the subscribed callsigns, evaluates their position reports, and finds the ones gone quiet
+class PacketPipeline:
+    def __init__(self):
+        #callsign -> SMS_to for the active subscriptions
+        self.subscriptions = {}
+        #callsign -> epoch of the last packet we know of, and the same ordered by time
+        self.last_heard = {}
+        self.beacon_index = BeaconIndex()
+        #(source, payload) of the position reports heard inside the dupe window
+        self.recent = TTLCache(maxsize=APRSIS_DUPE_ENTRIES, ttl=APRSIS_DUPE_SECONDS)
+        self.packets = 0
+        self.duplicates = 0
+    #end __init__
+
+    #evaluates a packet if it is a position report from a subscribed callsign
+    #repeats inside the dupe window are dropped, so one beacon is evaluated once
+    def handle_packet(self, packet, now=None):
+        SMS_to = self.subscriptions.get(packet.source)
+        comment = position_comment(packet) if SMS_to else None
+        if comment is not None:
+            key = (packet.source, packet.payload)
+            if self.recent.get(key) is not None:
+                self.duplicates += 1
+                return
+            #endif
+            self.recent.put(key, True)
+            self.packets += 1
+            self.evaluate(packet.source, SMS_to, comment, int(now or time.time()))
+        #endif
+    #end handle_packet
+
+    #runs one received report through the alert pipeline and sends any alert
+    def evaluate(self, APRS_name, SMS_to, comment, lasttime_int):
+        state_store = get_state_store()
+        history_store = get_history_store()
+        site_return = evaluate_site(APRS_name, SMS_to, comment, lasttime_int, state_store, history_store, True)
+        failed = state_store.flush()
+        if APRS_name in failed:
+            logger.error(failed[APRS_name] +site_tag(APRS_name))
+        #endif
+        deliver_pending()
+        if history_store is not None:
+            history_store.flush()
+        #endif
+        self.last_heard[APRS_name] = lasttime_int
+        self.beacon_index.push(APRS_name, lasttime_int)
+        logger.info("ING:" +APRS_name +": " +site_return['Message'])
+        return site_return
+    #end evaluate
+
+    #rereads the subscription table. Returns the callsigns (added, removed)
+    #new callsigns start from the last packet recorded for them, so a silent site is still found stale
+    def refresh(self, now=None):
+        now = int(now or time.time())
+        subscriptions = {callsign.upper(): SMS_to for callsign, SMS_to, expires in active_subscriptions(now, purge=False)}
+        added = [callsign for callsign in subscriptions if callsign not in self.subscriptions]
+        removed = [callsign for callsign in self.subscriptions if callsign not in subscriptions]
+        self.subscriptions = subscriptions
+        if added:
+            state_store = get_state_store()
+            state_store.load(added)
+            for callsign in added:
+                state = state_store.get(callsign)
+                self.last_heard[callsign] = int(state['lasttime']) if state is not None and 'lasttime' in state else now
+                self.beacon_index.push(callsign, self.last_heard[callsign])
+            #endfor
+        #endif
+        for callsign in removed:
+            self.last_heard.pop(callsign, None)
+        #endfor
+        return added, removed
+    #end refresh
+
+    #runs the beacon age rule for every subscribed site not heard from inside the limit
+    #a stale site is checked again on every refresh until it beacons, so cooldowns can run out
+    #the index keeps an entry per packet. Entries of sites heard from since are dropped here
+    def check_stale(self, now=None):
+        now = int(now or time.time())
+        max_age = get_plan().parameters['maximum_beacon_age'] * 60
+        stale = [name for name in dict.fromkeys(self.beacon_index.stale(now, max_age))
+                 if name in self.subscriptions and name in self.last_heard and beacon_age(self.last_heard[name], now) > max_age]
+        if not stale:
+            return []
+        #endif
+        state_store = get_state_store()
+        state_store.load(stale)
+        for name in stale:
+            previous_state = state_store.get(name)
+            if previous_state is not None:
+                evaluate_unchanged_site(name, self.subscriptions[name], self.last_heard[name], previous_state, state_store)
+            #endif
+        #endfor
+        failed = state_store.flush()
+        for name, message in failed.items():
+            logger.error(message +site_tag(name))
+        #endfor
+        deliver_pending()
+        #index them again at their real last beacon, so the next check finds them again
+        for name in stale:
+            self.beacon_index.push(name, self.last_heard[name])
+        #endfor
+        return stale
+    #end check_stale
+#end PacketPipeline
+
+class APRSISClient(PacketPipeline):
+    def __init__(self, server=None, login=None):
+        super().__init__()
+        host, port = (server or APRSIS_SERVER).rsplit(":", 1)
+        self.address = (host, int(port))
+        self.login = login or APRSIS_LOGIN
+        self.filter = None
+        self._socket = None
+        self._stop = False
+    #end __init__
+
+    #connects and processes packets until stop() is called, reconnecting with backoff
+    def run(self):
+        failures = 0
+        while not self._stop:
+            connected_at = time.time()
+            try:
+                self.refresh()
+                self._connect()
+                self._read_loop()
+            except Exception as err:
+                logger.exception("Exception in APRS-IS: " +(f"{type(err).__name__} was raised: {err}"))
+            finally:
+                self._close()
+            #endtry
+            if self._stop:
+                break
+            #endif
+            failures = 0 if time.time() - connected_at > APRSIS_STABLE_SECONDS else failures + 1
+            delay = backoff(failures)
+            logger.info("ISC:reconnecting in %.1f s" %delay)
+            time.sleep(delay)
+        #endwhile
+    #end run
+
+    def stop(self):
+        self._stop = True
+        self._close()
+    #end stop
+
+    def _connect(self):
+        logger.info("ISC:connecting to " +self.address[0] +":" +str(self.address[1]))
+        self._socket = socket.create_connection(self.address, timeout=APRSIS_IDLE_SECONDS)
+        self.filter = build_filter(self.subscriptions)
+        self._send("user " +self.login +" pass -1 vers " +APRSIS_SOFTWARE +" filter " +self.filter)
+    #end _connect
+
+    def _close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            #endtry
+            self._socket = None
+        #endif
+    #end _close
+
+    def _send(self, line):
+        self._socket.sendall((line + "\r\n").encode('utf-8'))
+    #end _send
+
+    #reads until the connection drops, going idle too long, or stop()
+    def _read_loop(self):
+        stream = TNC2Stream()
+        last_data = time.time()
+        next_refresh = time.time() + APRSIS_REFRESH_SECONDS
+        self._socket.settimeout(min(APRSIS_REFRESH_SECONDS, APRSIS_IDLE_SECONDS))
+        while not self._stop:
+            try:
+                data = self._socket.recv(4096)
+                if not data:
+                    raise ConnectionError("server closed the connection")
+                #endif
+                last_data = time.time()
+                lines = stream.feed(data)
+            except socket.timeout:
+                lines = []
+            #endtry
+            for line in lines:
+                self.handle_line(line)
+            #endfor
+            now = time.time()
+            if now - last_data > APRSIS_IDLE_SECONDS:
+                raise TimeoutError("no data for " +str(APRSIS_IDLE_SECONDS) +" seconds")
+            #endif
+            if now >= next_refresh:
+                self.refresh()
+                self.check_stale()
+                next_refresh = now + APRSIS_REFRESH_SECONDS
+            #endif
+        #endwhile
+    #end _read_loop
+
+    #handles one line from the server: a comment starting with #, or a packet
+    def handle_line(self, line, now=None):
+        if APRSIS_CAPTURE_PATH:
+            with open(APRSIS_CAPTURE_PATH, 'a') as capture_file:
+                capture_file.write(line + "\n")
+            #endwith
+        #endif
+        if line.startswith("#"):
+            if "logresp" in line:
+                logger.info("ISC:" +line[1:].strip())
+            #endif
+            return
+        #endif
+        try:
+            packet = parse_tnc2(line)
+        except PacketError:
+            return
+        #endtry
+        self.handle_packet(packet, now)
+    #end handle_line
+
+    #rereads the subscription table and updates the server filter if the callsigns changed
+    def refresh(self, now=None):
+        added, removed = super().refresh(now)
+        new_filter = build_filter(self.subscriptions)
+        if new_filter != self.filter and self._socket is not None:
+            self._send("#filter " +new_filter)
+            logger.info("ISC:filter updated, " +str(len(added)) +" added, " +str(len(removed)) +" removed, " +str(len(self.subscriptions)) +" callsigns")
+        #endif
+        self.filter = new_filter
+        return added, removed
+    #end refresh
+#end APRSISClient
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    if INGEST_MODE != 'aprsis':
+        logger.warning("ING:INGEST_MODE is not aprsis. If the notify tick polls aprs.fi too, each beacon is evaluated twice")
+    #endif
+    client = APRSISClient()
+    try:
+        client.run()
+    except KeyboardInterrupt:
+        client.stop()
+    #endtry
+#endif
+
+#eof
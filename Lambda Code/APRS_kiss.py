@@ -0,0 +1,275 @@
+import os
+import sys
+import time
+import socket
+import logging
+
+from APRS_packet import Packet, PacketError
+from APRS_is import PacketPipeline, backoff
+
+#setup logger
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+#RF gateway. Reads KISS frames from a local TNC and feeds the position reports it hears into the
+#same alert pipeline as APRS_is, so a tracker heard by our own receiver is monitored even when no
+#igate forwards it. Runs as a long lived process:
+#   KISS_SOURCE=tcp:127.0.0.1:8001 python APRS_kiss.py
+#sources are tcp:host:port (Direwolf and most soundcard TNCs), serial:/dev/ttyUSB0:9600 (needs
+#pyserial, imported only for serial sources) or file:capture.kiss, a recorded byte stream, which
+#is read once. KISSStream splits the received bytes at FEND with bytearray.find and decodes each
+#AX.25 UI frame through memoryview slices of the receive buffer, so the only per byte work is done
+#in C and a frame is only copied when it contains an escape
+
+KISS_SOURCE = os.environ.get('KISS_SOURCE', 'tcp:127.0.0.1:8001')
+#set to a file path to append the raw KISS bytes to it, for replay with a file: source
+KISS_CAPTURE_PATH = os.environ.get('KISS_CAPTURE_PATH', '')
+#seconds a read waits before the gateway checks subscriptions and stale beacons
+KISS_POLL_SECONDS = 1
+KISS_READ_BYTES = 65536
+#seconds between subscription refreshes and stale beacon checks
+KISS_REFRESH_SECONDS = int(os.environ.get('KISS_REFRESH_SECONDS', '60'))
+#an unterminated frame longer than this is dropped. AX.25 frames are a few hundred bytes
+KISS_MAX_FRAME = 2048
+
+#KISS framing bytes
+FEND = b"\xc0"
+FESC = b"\xdb"
+ESCAPED_FEND = b"\xdb\xdc"
+ESCAPED_FESC = b"\xdb\xdd"
+
+#AX.25 UI frame control field and the no layer 3 protocol id APRS uses
+AX25_UI = 0x03
+AX25_NO_LAYER3 = 0xF0
+#addresses are 7 bytes: 6 callsign characters shifted left one bit, then the SSID byte
+AX25_ADDRESS_LENGTH = 7
+AX25_MAX_ADDRESSES = 10
+#translate tables that undo and apply the one bit shift of every address character
+_UNSHIFT = bytes(byte >> 1 for byte in range(256))
+_SHIFT = bytes((byte << 1) & 0xFF for byte in range(256))
+
+#decodes one AX.25 frame, without the KISS command byte. Returns a Packet
+#raises PacketError if it is not an APRS UI frame
+def decode_ax25(frame):
+    length = len(frame)
+    address_end = AX25_ADDRESS_LENGTH - 1
+    #the last address has the low bit of its SSID byte set
+    while address_end < length and not frame[address_end] & 1:
+        address_end += AX25_ADDRESS_LENGTH
+    #endwhile
+    address_count = (address_end + 1) // AX25_ADDRESS_LENGTH
+    if address_end + 2 >= length or address_count < 2 or address_count > AX25_MAX_ADDRESSES:
+        raise PacketError("Malformed AX.25 address field")
+    #endif
+    if frame[address_end + 1] != AX25_UI or frame[address_end + 2] != AX25_NO_LAYER3:
+        raise PacketError("Not an AX.25 UI frame")
+    #endif
+    characters = frame[:address_end + 1].tobytes().translate(_UNSHIFT)
+    addresses = []
+    for index in range(address_count):
+        offset = index * AX25_ADDRESS_LENGTH
+        ssid_byte = frame[offset + 6]
+        call = characters[offset:offset + 6].decode('ascii', 'replace').rstrip()
+        ssid = (ssid_byte >> 1) & 0x0F
+        if ssid:
+            call += "-" +str(ssid)
+        #endif
+        #the has been repeated bit of a digipeater
+        if index >= 2 and ssid_byte & 0x80:
+            call += "*"
+        #endif
+        addresses.append(call)
+    #endfor
+    return Packet(addresses[1].upper(), addresses[0], tuple(addresses[2:]), str(frame[address_end + 3:], 'utf-8', 'replace'))
+#end decode_ax25
+
+#encodes a packet as a KISS data frame on port 0. Used to build recorded streams and benchmarks
+def encode_kiss(packet):
+    addresses = [packet.destination, packet.source] + list(packet.path)
+    frame = bytearray()
+    for index, address in enumerate(addresses):
+        repeated = address.endswith("*")
+        call, _, ssid = address.rstrip("*").partition("-")
+        frame += call.upper().ljust(6)[:6].encode('ascii').translate(_SHIFT)
+        frame.append(0x60 | (int(ssid or 0) & 0x0F) << 1 | (0x80 if repeated else 0) | (1 if index == len(addresses) - 1 else 0))
+    #endfor
+    frame += bytes((AX25_UI, AX25_NO_LAYER3)) + packet.payload.encode('utf-8')
+    return FEND + b"\x00" + bytes(frame).replace(FESC, ESCAPED_FESC).replace(FEND, ESCAPED_FEND) + FEND
+#end encode_kiss
+
+#splits a KISS byte stream into decoded packets. Feed it whatever the TNC returned
+class KISSStream:
+    def __init__(self, max_frame=KISS_MAX_FRAME):
+        self.max_frame = max_frame
+        self._buffer = bytearray()
+        self.frames = 0
+        self.dropped = 0
+    #end __init__
+
+    #returns the packets of the frames completed by data
+    #frames that are not APRS UI frames, or not data frames, are counted in dropped
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        packets = []
+        position = 0
+        with memoryview(buffer) as view:
+            while True:
+                stop = buffer.find(FEND, position)
+                if stop < 0:
+                    break
+                #endif
+                if stop > position:
+                    packet = self._decode(buffer, view, position, stop)
+                    if packet is not None:
+                        packets.append(packet)
+                    #endif
+                #endif
+                position = stop + 1
+            #endwhile
+        #endwith
+        del buffer[:position]
+        if len(buffer) > self.max_frame:
+            buffer.clear()
+            self.dropped += 1
+        #endif
+        return packets
+    #end feed
+
+    def _decode(self, buffer, view, start, stop):
+        self.frames += 1
+        #the command byte: low nibble 0 is a data frame, the high nibble is the TNC port
+        if buffer[start] & 0x0F:
+            self.dropped += 1
+            return None
+        #endif
+        frame = view[start + 1:stop]
+        if buffer.find(FESC, start, stop) >= 0:
+            escaped = frame
+            frame = memoryview(escaped.tobytes().replace(ESCAPED_FEND, FEND).replace(ESCAPED_FESC, FESC))
+            escaped.release()
+        #endif
+        try:
+            return decode_ax25(frame)
+        except PacketError:
+            self.dropped += 1
+            return None
+        finally:
+            frame.release()
+        #endtry
+    #end _decode
+#end KISSStream
+
+class KISSGateway(PacketPipeline):
+    def __init__(self, source=None):
+        super().__init__()
+        self.source = source or KISS_SOURCE
+        self.stream = KISSStream()
+        self._stop = False
+    #end __init__
+
+    #reads the source until stop() is called, reconnecting with backoff
+    #a file source is read once, then run returns
+    def run(self):
+        failures = 0
+        while not self._stop:
+            connected_at = time.time()
+            try:
+                self.refresh()
+                read, close = self._open()
+                try:
+                    if self._pump(read):
+                        return
+                    #endif
+                finally:
+                    close()
+                #endtry
+            except Exception as err:
+                logger.exception("Exception in KISS: " +(f"{type(err).__name__} was raised: {err}"))
+            #endtry
+            if self._stop:
+                break
+            #endif
+            failures = 0 if time.time() - connected_at > KISS_REFRESH_SECONDS else failures + 1
+            delay = backoff(failures)
+            logger.info("KSS:reopening " +self.source +" in %.1f s" %delay)
+            time.sleep(delay)
+        #endwhile
+    #end run
+
+    def stop(self):
+        self._stop = True
+    #end stop
+
+    #opens the source. Returns (read, close). read returns b"" when nothing arrived in time
+    #and None at the end of a file source
+    def _open(self):
+        kind, _, target = self.source.partition(":")
+        logger.info("KSS:opening " +self.source)
+        if kind == 'tcp':
+            host, port = target.rsplit(":", 1)
+            connection = socket.create_connection((host, int(port)), timeout=KISS_POLL_SECONDS)
+            def read():
+                try:
+                    data = connection.recv(KISS_READ_BYTES)
+                except socket.timeout:
+                    return b""
+                #endtry
+                if not data:
+                    raise ConnectionError("TNC closed the connection")
+                #endif
+                return data
+            #end read
+            return read, connection.close
+        elif kind == 'serial':
+            import serial
+            device, _, baud = target.partition(":")
+            port = serial.Serial(device, int(baud or 9600), timeout=KISS_POLL_SECONDS)
+            return (lambda: port.read(port.in_waiting or 1)), port.close
+        elif kind == 'file':
+            capture = open(target, 'rb')
+            return (lambda: capture.read(KISS_READ_BYTES) or None), capture.close
+        #endif
+        raise ValueError("Unknown KISS source: " +self.source)
+    #end _open
+
+    #feeds the source through the stream. Returns True at the end of a file source
+    def _pump(self, read):
+        next_refresh = time.time() + KISS_REFRESH_SECONDS
+        while not self._stop:
+            data = read()
+            if data is None:
+                logger.info("KSS:end of " +self.source +", " +str(self.stream.frames) +" frames, " +str(self.stream.dropped) +" dropped, " +str(self.packets) +" reports, " +str(self.duplicates) +" duplicates")
+                return True
+            #endif
+            if data:
+                if KISS_CAPTURE_PATH:
+                    with open(KISS_CAPTURE_PATH, 'ab') as capture_file:
+                        capture_file.write(data)
+                    #endwith
+                #endif
+                for packet in self.stream.feed(data):
+                    self.handle_packet(packet)
+                #endfor
+            #endif
+            if time.time() >= next_refresh:
+                self.refresh()
+                self.check_stale()
+                next_refresh = time.time() + KISS_REFRESH_SECONDS
+            #endif
+        #endwhile
+        return False
+    #end _pump
+#end KISSGateway
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    gateway = KISSGateway()
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        gateway.stop()
+    #endtry
+#endif
+
+#eof
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import functools
+
+#setup logger
+logger = logging.getLogger()
+
+#per invocation metrics in CloudWatch Embedded Metric Format
+#the handlers time their stages (aprs.fi, the state store, Twilio, ...) and count bytes, DB
+#operations and SMS sends through timer() and count(). Everything accumulates in memory and
+#with_metrics writes one EMF record when the invocation ends, which CloudWatch turns into metrics
+#without any API call. Stage times are summed over threads, so with several workers they can add
+#up to more than the invocation took. When disabled, timer() and count() do nothing
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'APRSMonitor')
+#share of ordinary invocations that emit a record. Invocations slower than METRICS_SLOW_MS
+#always emit one, with their stage timeline
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1'))
+METRICS_SLOW_MS = float(os.environ.get('METRICS_SLOW_MS', '2000'))
+#most stage timings kept in a slow invocation's timeline
+METRICS_TIMELINE_MAX = 200
+#records go to stdout, where Lambda hands them to CloudWatch Logs, or are appended to this file
+#APRS_replay sets it so it can read the records back
+METRICS_PATH = os.environ.get('METRICS_PATH', '')
+
+#metric name suffix -> EMF unit
+UNITS = {'_ms': 'Milliseconds', '_bytes': 'Bytes'}
+
+#accumulates one invocation's metrics. Shared by the worker threads of the invocation
+class Recorder:
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.start = time.perf_counter()
+        self.values = {}
+        self.timeline = []
+        self.properties = {}
+        self._lock = threading.Lock()
+    #end __init__
+
+    def add(self, name, value):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+        #endwith
+    #end add
+
+    def add_stage(self, stage, started, elapsed_ms):
+        with self._lock:
+            self.values[stage + '_ms'] = self.values.get(stage + '_ms', 0) + elapsed_ms
+            self.values[stage + '_calls'] = self.values.get(stage + '_calls', 0) + 1
+            if len(self.timeline) < METRICS_TIMELINE_MAX:
+                self.timeline.append((stage, round((started - self.start) * 1000, 2), round(elapsed_ms, 2)))
+            #endif
+        #endwith
+    #end add_stage
+
+    #builds the EMF record for the invocation
+    def record(self, duration_ms, status):
+        values = dict(self.values, duration_ms=duration_ms)
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name, 'Unit': UNITS.get(name[name.rfind('_'):], 'Count')} for name in sorted(values)],
+                }],
+            },
+            'Function': self.function_name,
+            'Status': status,
+        }
+        record.update({name: round(value, 2) for name, value in values.items()})
+        record.update(self.properties)
+        return record
+    #end record
+#end Recorder
+
+#times a stage of the current invocation
+class _Timer:
+    __slots__ = ('recorder', 'stage', 'started')
+
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+    #end __init__
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    #end __enter__
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.add_stage(self.stage, self.started, (time.perf_counter() - self.started) * 1000)
+        return False
+    #end __exit__
+#end _Timer
+
+#stands in for a timer when there is nothing to record
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+    #end __enter__
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+    #end __exit__
+#end _NullTimer
+
+_NULL_TIMER = _NullTimer()
+#the recorder of the invocation in progress. A Lambda container runs one invocation at a time
+_current = None
+_sink_lock = threading.Lock()
+
+#returns a context manager that adds its elapsed time to stage_ms, and one to stage_calls
+#use as: with timer('aprs'): ...
+def timer(stage):
+    recorder = _current
+    if recorder is None:
+        return _NULL_TIMER
+    #endif
+    return _Timer(recorder, stage)
+#end timer
+
+#adds value to a counter of the current invocation. Names ending _bytes are reported in bytes
+def count(name, value=1):
+    recorder = _current
+    if recorder is not None:
+        recorder.add(name, value)
+    #endif
+#end count
+
+#attaches a searchable property to the current invocation's record, such as the site polled
+def set_property(name, value):
+    recorder = _current
+    if recorder is not None:
+        recorder.properties[name] = value
+    #endif
+#end set_property
+
+#writes one record to the sink
+def emit(record):
+    line = json.dumps(record, separators=(',', ':')) + "\n"
+    with _sink_lock:
+        if METRICS_PATH:
+            with open(METRICS_PATH, 'a') as metrics_file:
+                metrics_file.write(line)
+            #endwith
+        else:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        #endif
+    #endwith
+#end emit
+
+#decorator for lambda handlers. Records the invocation and emits its EMF record when it ends
+#a failure to emit is logged and never fails the invocation. An invocation run inside another,
+#like a tick shard under APRS_replay, gets its own record
+def with_metrics(handler):
+    if not METRICS_ENABLED:
+        return handler
+    #endif
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _current
+        previous = _current
+        recorder = _current = Recorder(handler.__module__)
+        status = 'Exception'
+        try:
+            response = handler(event, context)
+            status = str(response.get('statusCode', '')) if isinstance(response, dict) else ''
+            return response
+        finally:
+            _current = previous
+            try:
+                duration_ms = (time.perf_counter() - recorder.start) * 1000
+                slow = duration_ms >= METRICS_SLOW_MS
+                if slow or METRICS_SAMPLE_RATE >= 1 or random.random() < METRICS_SAMPLE_RATE:
+                    record = recorder.record(duration_ms, status)
+                    if slow:
+                        record['Timeline'] = recorder.timeline
+                    #endif
+                    emit(record)
+                #endif
+            except Exception as err:
+                logger.error("MET:Exception emitting metrics: " +(f"{type(err).__name__} was raised: {err}"))
+            #endtry
+        #endtry
+    #end wrapper
+    return wrapper
+#end with_metrics
+
+#eof
@@ -1,40 +1,60 @@
 import os
-import boto3
 import json
 import time
-import urllib3
 import logging
 
-from twilio.rest import Client
+from APRS_clients import get_client, with_client_stats
+from APRS_aprsfi import APRSFI_MAX_NAMES, APRSFIError, get_locations
+from APRS_metrics import with_metrics, timer, count, set_property
+from APRS_telemetry import parse_telemetry, TelemetryError
+from APRS_state import get_state_store
+from APRS_concurrency import NOTIFY_WORKERS, run_concurrently
+from APRS_outbox import enqueue_sms, deliver_pending, purge_outbox, idempotency_key
+from APRS_subscriptions import TICK_SHARDS, INGEST_MODE, active_subscriptions, shard_subscriptions
+from APRS_dedupe import purge_messages
+from APRS_status import status_attributes
+from APRS_history import HistoryRecord, get_history_store
+from APRS_trend import TREND_MIN_SAMPLES, parse_trend, format_trend, update_trend, forecast, minutes_until, is_anomaly
+from APRS_rules import get_plan, parse_rule_states, format_rule_states
+from APRS_beacons import BeaconIndex, beacon_age, format_time
+from APRS_cadence import CADENCE_ENABLED, due_subscriptions, record_polls
 
 #setup logger
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
 
-#set program configuration here
-Maximum_Temperature = 85
-Minimum_Temperature = 40
-Maximum_Temp_Delta = 3
-Maximum_Beacon_Age = 5 #in minutes
+#program configuration: the alert thresholds are the rule set parameters in APRS_rules
 
-#pick up environment variables
-APRSFI_API = os.environ['APRSFI_KEY']
+#pick up environment variables. The aprs.fi key and endpoint are read by APRS_aprsfi
 TWILIO_ACCOUNT_SID = os.environ['TWILIO_ACCOUNT_SID']
 TWILIO_AUTH_TOKEN = os.environ['TWILIO_AUTH_TOKEN']
 MESSAGING_SERVICE_SID = os.environ['TWILIO_MSG_SERVICE_SID']
 
 #the Lambda Handler is called by AWS. Acts as core of the application
+@with_client_stats
+@with_metrics
 def lambda_handler(event, context):
     
-    #pick up event flags
-    logger.info("received: " + str(event))
+    #pick up event flags. The event is formatted lazily, so it costs nothing when the level is INFO
+    logger.debug("received: %s", event)
+    
+    #tick mode: the single scheduler tick reads the subscription table and shards it
+    if isinstance(event, dict) and "tick" in event:
+        return tick_handler(event, context)
+    #endif
+    
+    #batch mode: event carries a list of sites, or asks for every active subscription
+    if isinstance(event, dict) and ("sites" in event or "all_active" in event):
+        return batch_handler(event)
+    #endif
   
     #First, extract event flags to identify what needs to be monitored
     try:
         APRS_name = event["APRS_name"]
         SMS_to = event["SMS_to"]
         logger.info("inbound event request for: " +APRS_name +", " +SMS_to)
+        set_property('APRS_name', APRS_name)
     except Exception as err:
         lambda_return =  {'Status': '400', 'Message': 'Invalid event arguments', 'Code':'STA'}
         return {
@@ -47,249 +67,518 @@ def lambda_handler(event, context):
     lambda_return = {'Status': '200', 'Message': '', 'Code':''}
     
     try:
-        #create instance of urllib3 and PoolManager
-        http = urllib3.PoolManager()
-        # Retrieve the JSON from the URL
-        url = "https://api.aprs.fi/api/get?name=" +APRS_name +"&what=loc&apikey=" +APRSFI_API +"&format=json"
-        response = http.request('GET',url)
-        body_data = response.data
-        json_payload = json.loads(body_data)
+        entries = get_locations([APRS_name])
+    except Exception as err:
+        lambda_return = aprs_error(err, [APRS_name])
+        return {
+            'statusCode': lambda_return['Status'],
+            'body': json.dumps(lambda_return)
+        }
+    #endtry
+    
+    #continuing. We should have a good response from APRS.FI at this point
+    
+    if APRS_name.upper() not in entries:
+        lambda_return = {'Status': '500', 'Message': "APRS:No entry returned for " +APRS_name, 'Code': 'APRS'}
+        logger.error(lambda_return['Message'] +site_tag(APRS_name))
+        return {
+            'statusCode': lambda_return['Status'],
+            'body': json.dumps(lambda_return)
+        }
+    #endif
+    try:
+        comment, lasttime_int = extract_entry(entries[APRS_name.upper()])
     except Exception as err:
         lambda_return['Status'] = "500"
         lambda_return['Message'] = "APRS:Exception in APRS Query: " +(f"{type(err).__name__} was raised: {err}")
         lambda_return['Code'] = "APRS"
         
-        logger.exception(lambda_return['Message'])
+        logger.exception(lambda_return['Message'] +site_tag(APRS_name))
         return {
             'statusCode': lambda_return['Status'],
             'body': json.dumps(lambda_return)
         }
-    finally:
-        http.clear()
     #endtry
+    #we now have the required data from the APRS packet.
     
-    #continuing. We should have a good response from APRS.FI at this point
-    
+    state_store = get_state_store()
     try:
-    # Check if the result field is "fail"
-        result = json_payload['result']
-        if result == 'fail':
-            comment = "Request Failed " +json_payload['description']
-            lambda_return['Status'] = "500"
-            lambda_return['Message'] = "APRS:Response payload was failure"
-            lambda_return['Code'] = "APRS"
-        
-            logger.exception(lambda_return['Message'])
-            return {
-                'statusCode': lambda_return['Status'],
-                'body': json.dumps(lambda_return)
-            }
-        elif not(200 <= response.status <= 299):
-            lambda_return['Status'] = "500"
-            lambda_return['Message'] = "APRS:Response not 200: " +str(response.status)
-            lambda_return['Code'] = "APRS"
+        state_store.load([APRS_name])
+    except Exception as err:
+        lambda_return['Status'] = "500"
+        lambda_return['Message'] = "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}")
+        lambda_return['Code'] = "SDB"
         
-            logger.exception(lambda_return['Message'])
-            return {
-                'statusCode': lambda_return['Status'],
-                'body': json.dumps(lambda_return)
-            }
+        logger.exception(lambda_return['Message'] +site_tag(APRS_name))
+        return {
+            'statusCode': lambda_return['Status'],
+            'body': json.dumps(lambda_return)
+        }
+    #endtry
+    
+    history_store = get_history_store()
+    lambda_return = evaluate_site(APRS_name, SMS_to, comment, lasttime_int, state_store, history_store)
+    
+    #Complete by publishing the current state in the database
+    failed = state_store.flush()
+    if APRS_name in failed:
+        lambda_return = {'Status': '500', 'Message': failed[APRS_name], 'Code': 'SDB'}
+    #endif
+    logger.info("SDB:" +str(state_store.writes_skipped) +" writes skipped")
+    
+    #alerts were queued during evaluation, send them now the state is safe
+    deliver_pending()
+    
+    #history is best effort and written after the alerts are sent, so it never holds one up
+    if history_store is not None:
+        history_store.flush()
+    #endif
+
+    # Return to close the lambda
+    return {
+        'statusCode': lambda_return['Status'],
+        'body': json.dumps(lambda_return)
+    }
+#end lambda_handler
+
+#batch handler polls many sites per invocation
+#sites are packed into aprs.fi name lists of up to APRSFI_MAX_NAMES, then each site is
+#evaluated exactly as the single site path would evaluate it
+#with more than one worker (event "concurrency" or NOTIFY_WORKERS) queries, loads, site
+#evaluations and writes fan out over a thread pool, bounded per dependency
+def batch_handler(event):
+    lambda_return = {'Status': '200', 'Message': '', 'Code':'', 'Sites': []}
+    
+    try:
+        if "sites" in event:
+            sites = [(site["APRS_name"], site["SMS_to"]) for site in event["sites"]]
         else:
-            # Extract the comment from the JSON  WARNING. NOT SANITIZED - exception to handle
-            comment = json_payload['entries'][0]['comment']
-            # Extract the last published time from the JSON
-            lasttime_int = int(json_payload['entries'][0]['lasttime'])
-            #convert APRS last reported time to ISO object
-            #need this for database logging and comparison
-            lasttime_iso = time.strftime('%Y-%m-%dT%H:%M:%SZ%z', time.localtime(lasttime_int))
+            sites = [(callsign, SMS_to) for callsign, SMS_to, expires in active_subscriptions()]
         #endif
+        workers = int(event.get("concurrency", NOTIFY_WORKERS))
     except Exception as err:
-        lambda_return['Status'] = "500"
-        lambda_return['Message'] = "APRS:Exception in APRS Query: " +(f"{type(err).__name__} was raised: {err}")
-        lambda_return['Code'] = "APRS"
-        
+        lambda_return =  {'Status': '400', 'Message': 'Invalid event arguments', 'Code':'STA'}
+        return {
+            'statusCode': lambda_return['Status'],
+            'body': json.dumps(lambda_return)
+        }
+    #endtry
+    logger.info("batch request for " +str(len(sites)) +" sites, " +str(workers) +" workers")
+    count('sites', len(sites))
+    
+    #pack unique names into aprs.fi queries, and run the queries side by side
+    names = list(dict.fromkeys(APRS_name.upper() for APRS_name, SMS_to in sites))
+    chunks = [names[i:i + APRSFI_MAX_NAMES] for i in range(0, len(names), APRSFI_MAX_NAMES)]
+    entries = {}
+    query_errors = {}
+    for chunk, (chunk_entries, chunk_error) in zip(chunks, run_concurrently(fetch_aprs_chunk, chunks, workers)):
+        entries.update(chunk_entries)
+        if chunk_error:
+            for APRS_name in chunk:
+                query_errors[APRS_name] = chunk_error
+            #endfor
+        #endif
+    #endfor
+    
+    #index this cycle's beacons by time, so every stale site is found without evaluating each one
+    #sites known to be fresh whose packet has not changed can then skip the rules altogether
+    beacon_index = BeaconIndex((key, entry['lasttime']) for key, entry in entries.items() if str(entry.get('lasttime', '')).isdigit())
+    stale_names = set(beacon_index.stale(int(time.time()), get_plan().parameters['maximum_beacon_age'] * 60))
+    logger.info("APRS:" +str(len(stale_names)) +" of " +str(len(entries)) +" sites have stale beacons")
+    lambda_return['Stale'] = sorted(stale_names)
+    
+    #load the state for every site we have a packet for in as few selects as possible
+    state_store = get_state_store()
+    history_store = get_history_store()
+    state_error = None
+    try:
+        found_names = [APRS_name for APRS_name, SMS_to in sites if APRS_name.upper() in entries]
+        read_chunks = [found_names[i:i + state_store.read_chunk] for i in range(0, len(found_names), state_store.read_chunk)]
+        run_concurrently(state_store.load, read_chunks, workers)
+    except Exception as err:
+        state_error = {'Status': '500', 'Message': "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"), 'Code': 'SDB'}
+        logger.exception(state_error['Message'])
+    #endtry
+    
+    #run the per site evaluation over the merged response
+    def evaluate_batch_site(site):
+        APRS_name, SMS_to = site
+        key = APRS_name.upper()
+        if key in query_errors:
+            site_return = dict(query_errors[key])
+        elif key not in entries:
+            site_return = {'Status': '500', 'Message': "APRS:No entry returned for " +APRS_name, 'Code': 'APRS'}
+            logger.error(site_return['Message'] +site_tag(APRS_name))
+        elif state_error:
+            site_return = dict(state_error)
+        else:
+            try:
+                comment, lasttime_int = extract_entry(entries[key])
+                site_return = evaluate_site(APRS_name, SMS_to, comment, lasttime_int, state_store, history_store, key not in stale_names)
+            except Exception as err:
+                site_return = {'Status': '500', 'Message': "APRS:Exception in APRS Query: " +(f"{type(err).__name__} was raised: {err}"), 'Code': 'APRS'}
+                logger.exception(site_return['Message'] +site_tag(APRS_name))
+            #endtry
+        #endif
+        site_return['APRS_name'] = APRS_name
+        site_return['SMS_to'] = SMS_to
+        return site_return
+    #end evaluate_batch_site
+    lambda_return['Sites'] = run_concurrently(evaluate_batch_site, sites, workers)
+    
+    #publish every site's state in batched writes
+    failed = state_store.flush(workers)
+    for site_return in lambda_return['Sites']:
+        if site_return['APRS_name'] in failed:
+            site_return.update({'Status': '500', 'Message': failed[site_return['APRS_name']], 'Code': 'SDB'})
+        #endif
+    #endfor
+    logger.info("SDB:" +str(state_store.round_trips) +" round trips for " +str(len(sites)) +" sites, " +str(state_store.writes_skipped) +" writes skipped")
+    lambda_return['Writes_skipped'] = state_store.writes_skipped
+    
+    #alerts were queued during evaluation, send them now the state is safe
+    deliver_pending()
+    
+    #history is best effort and written after the alerts are sent, so it never holds one up
+    if history_store is not None:
+        history_store.flush(workers)
+    #endif
+    
+    #schedule each polled site's next poll. Sites whose query failed stay due
+    if CADENCE_ENABLED:
+        try:
+            record_polls([APRS_name for APRS_name in names if APRS_name not in query_errors], entries, state_store, int(time.time()), workers)
+        except Exception as err:
+            logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+        #endtry
+    #endif
+    
+    failed = sum(1 for site_return in lambda_return['Sites'] if site_return['Status'] != '200')
+    lambda_return['Message'] = "Processed " +str(len(sites)) +" sites, " +str(failed) +" failed"
+    return {
+        'statusCode': lambda_return['Status'],
+        'body': json.dumps(lambda_return)
+    }
+#end batch_handler
+
+#tick handler. One EventBridge schedule, rate(5 minutes), or rate(1 minute) with the APRS_cadence settings,
+#runs APRS_notify with {"tick": true}
+#expired subscriptions are dropped, the sites APRS_cadence finds due are sharded by callsign across
+#TICK_SHARDS worker invocations of this function. With a single shard the tick does the work itself
+def tick_handler(event, context):
+    try:
+        subscriptions = active_subscriptions()
+        shards = int(event.get("shards", TICK_SHARDS))
+    except Exception as err:
+        lambda_return = {'Status': '500', 'Message': "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"), 'Code': 'SDB'}
         logger.exception(lambda_return['Message'])
         return {
             'statusCode': lambda_return['Status'],
             'body': json.dumps(lambda_return)
         }
     #endtry
-    #we now have the required data from the APRS packet.
+    logger.info("tick: " +str(len(subscriptions)) +" active subscriptions over " +str(shards) +" shards")
     
+    #the tick also ages out the webhook dedupe table and the outbox. A failure here must not stop the poll
     try:
-        #create a database connection
-        simpleDBclient = boto3.client('sdb')
-        getDB_response = simpleDBclient.get_attributes(
-            DomainName='APRS_tracker',
-            ItemName= APRS_name
-        )
+        purge_messages()
+        purge_outbox()
+    except Exception as err:
+        logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+    #endtry
+    
+    #with APRS-IS ingestion every beacon is evaluated by APRS_is as it arrives. Polling aprs.fi as well
+    #would evaluate each beacon a second time, so the tick stops after the purges
+    if INGEST_MODE == 'aprsis':
+        lambda_return = {'Status': '200', 'Message': "APRS-IS ingestion, " +str(len(subscriptions)) +" sites not polled", 'Code': ''}
+        return {
+            'statusCode': lambda_return['Status'],
+            'body': json.dumps(lambda_return)
+        }
+    #endif
+    
+    #only the sites whose next beacon is due are polled, within the aprs.fi query budget
+    #if the cadence table cannot be read, every site is polled as before
+    if CADENCE_ENABLED:
+        try:
+            subscriptions, held = due_subscriptions(subscriptions, int(time.time()), APRSFI_MAX_NAMES)
+            logger.info("tick: " +str(len(subscriptions)) +" sites due, " +str(held) +" held back")
+            count('sites_held', held)
+        except Exception as err:
+            logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+        #endtry
+    #endif
+    
+    if shards <= 1:
+        return batch_handler({"sites": [{"APRS_name": callsign, "SMS_to": SMS_to} for callsign, SMS_to, expires in subscriptions], "concurrency": event.get("concurrency", NOTIFY_WORKERS)})
+    #endif
+    
+    #hand each shard to its own asynchronous invocation
+    lambda_return = {'Status': '200', 'Message': '', 'Code':''}
+    function_name = os.environ.get('NOTIFY_FUNCTION_NAME') or context.invoked_function_arn
+    dispatched = 0
+    for shard, shard_subscriptions_list in sorted(shard_subscriptions(subscriptions, shards).items()):
+        payload = {"sites": [{"APRS_name": callsign, "SMS_to": SMS_to} for callsign, SMS_to, expires in shard_subscriptions_list], "shard": shard}
+        try:
+            with timer('dispatch'):
+                get_client('lambda').invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload).encode("utf-8"))
+            #endwith
+            dispatched += 1
+        except Exception as err:
+            lambda_return['Status'] = "500"
+            lambda_return['Code'] = "TICK"
+            logger.exception("TICK:Exception dispatching shard " +str(shard) +": " +(f"{type(err).__name__} was raised: {err}"))
+        #endtry
+    #endfor
+    lambda_return['Message'] = "Dispatched " +str(len(subscriptions)) +" sites to " +str(dispatched) +" workers"
+    return {
+        'statusCode': lambda_return['Status'],
+        'body': json.dumps(lambda_return)
+    }
+#end tick_handler
+
+#queries one chunk of names. Returns (name -> entry, error return object or None)
+def fetch_aprs_chunk(chunk):
+    try:
+        return get_locations(chunk), None
+    except Exception as err:
+        return {}, aprs_error(err, chunk)
+    #endtry
+#end fetch_aprs_chunk
+
+#returns the error return object for a failed aprs.fi query, logged against the queried sites
+#APRSFIError messages are safe to log and need no traceback
+def aprs_error(err, names):
+    if isinstance(err, APRSFIError):
+        lambda_return = {'Status': '500', 'Message': "APRS:" +str(err), 'Code': 'APRS'}
+        logger.error(lambda_return['Message'] +site_tag(*names))
+    else:
+        lambda_return = {'Status': '500', 'Message': "APRS:Exception in APRS Query: " +(f"{type(err).__name__} was raised: {err}"), 'Code': 'APRS'}
+        logger.exception(lambda_return['Message'] +site_tag(*names))
+    #endif
+    return lambda_return
+#end aprs_error
+
+#pulls the comment and last published time from one aprs.fi entry
+def extract_entry(entry):
+    # Extract the comment from the JSON  WARNING. NOT SANITIZED - exception to handle
+    comment = entry['comment']
+    # Extract the last published time from the JSON, epoch seconds
+    lasttime_int = int(entry['lasttime'])
+    return comment, lasttime_int
+#end extract_entry
+
+#evaluates one site against the alert rules and stages the current state in the state store
+#a new packet's readings are also staged in the history store, when one is given
+#the caller flushes the stores once for the whole cycle
+#beacon_fresh is True when the caller already knows the beacon is inside the age limit
+#returns the lambda return object for the site
+def evaluate_site(APRS_name, SMS_to, comment, lasttime_int, state_store, history_store=None, beacon_fresh=False):
+    
+    #set up response item
+    lambda_return = {'Status': '200', 'Message': '', 'Code':''}
+    
+    #the state was loaded for the whole cycle, this is a lookup
+    try:
+        previous_state = state_store.get(APRS_name)
+    except Exception as err:
+        lambda_return['Status'] = "500"
+        lambda_return['Message'] = "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}")
+        lambda_return['Code'] = "SDB"
         
+        logger.exception(lambda_return['Message'] +site_tag(APRS_name))
+        return lambda_return
+    #endtry
+    
+    #if the tracker has not beaconed since the last poll, the packet was already evaluated
+    #only its age can have changed, so skip parsing and the database write
+    #pushed packets are stamped on arrival, so two in the same second are told apart by their comment
+    if previous_state is not None and previous_state.get("lasttime") == str(lasttime_int) and previous_state.get("comment", comment) == comment:
+        return evaluate_unchanged_site(APRS_name, SMS_to, lasttime_int, previous_state, state_store, beacon_fresh)
+    #endif
+    
+    #decode the tracker telemetry frame before touching the database
+    try:
+        telemetry = parse_telemetry(comment)
+    except TelemetryError as err:
+        lambda_return['Status'] = "500"
+        lambda_return['Message'] = "APRS:" +str(err)
+        lambda_return['Code'] = "APRS"
+        
+        logger.exception(lambda_return['Message'] +site_tag(APRS_name))
+        return lambda_return
+    #endtry
+    
+    if history_store is not None:
+        history_store.stage(APRS_name, HistoryRecord(lasttime_int, telemetry.internal_temp, telemetry.bmp_temp, telemetry.pressure, telemetry.battery))
+    #endif
+    
+    try:
         #identify if we have seen this before
-        if "Attributes" in getDB_response:
+        previous_recorded_temp = None
+        trend = None
+        rule_states = {}
+        SMS_key = None
+        if previous_state is not None:
             #we have a record for this name, get the alert flag
-            for attribute in getDB_response["Attributes"]:
-                if attribute["Name"] == "alert_sent":
-                    alert_sent = attribute["Value"]
-                elif attribute["Name"] == "comment":
-                    previous_comment = attribute["Value"]
-                    previous_recorded_temp = float(previous_comment[2:7])
-                #endif
-            #endfor
+            alert_sent = previous_state.get("alert_sent", 'False')
+            if "comment" in previous_state:
+                try:
+                    previous_recorded_temp = parse_telemetry(previous_state["comment"]).internal_temp
+                except TelemetryError as err:
+                    logger.info("SDB:Stored comment for " +APRS_name +" is not telemetry, skipping delta check. " +str(err))
+                #endtry
+            #endif
+            trend = parse_trend(previous_state.get("trend"))
+            rule_states = parse_rule_states(previous_state.get("rules"), alert_sent, lasttime_int)
             logger.info("SDB:Existing entry found in DB for " +APRS_name +". Alert value is " +alert_sent)
         else:
             logger.info("SDB:New entry in DB for " + APRS_name)
             #we don't have a record, set alert flag to false
             alert_sent = 'False'
         #endif
+        #the site's compiled rule set holds the thresholds
+        plan = get_plan(previous_state.get("rule_set") if previous_state is not None else None)
         
-        #Parse the comment and test the temperature
-        internal_temp = float(comment[2:7])
-        bmp_temp = float(comment[11:16])
+        #test the temperature
+        internal_temp = telemetry.internal_temp
+        bmp_temp = telemetry.bmp_temp
         logger.info(f"Internal temp: {internal_temp:,.2f} , BMP temp: {bmp_temp:,.2f}")
         
-        #temperature will report 200 on known sensor error
-        if internal_temp > 199:
-            message_string = "Temperature Sensor Malfunction: error 200"
-            send_alert(message_string, alert_sent,SMS_to,APRS_name)
-            alert_sent = 'True'
-        
-        #if temperature is over, go to alert
-        elif internal_temp >= Maximum_Temperature:
-            message_string = "Temperature exceeds Maximum! Internal Temp: %.2f" %internal_temp
-            send_alert(message_string, alert_sent,SMS_to,APRS_name)
-            alert_sent = 'True'
+        #a jump is measured against the trend's forecast once it has enough readings, and against
+        #the previous reading before that. There is nothing to compare on the first report for a site
+        temperature_delta = plan.parameters['temperature_delta']
+        if trend is not None and trend.count >= TREND_MIN_SAMPLES:
+            reference_temp = forecast(trend, lasttime_int)
+            temperature_jump = is_anomaly(trend, lasttime_int, internal_temp, temperature_delta)
+        else:
+            reference_temp = previous_recorded_temp
+            temperature_jump = previous_recorded_temp is not None and not ((previous_recorded_temp - temperature_delta) < internal_temp < (previous_recorded_temp + temperature_delta))
+        #endif
+        #fold the reading into the trend, then project it toward the minimum
+        trend = update_trend(trend, lasttime_int, internal_temp)
+        freeze_minutes = minutes_until(trend, plan.parameters['minimum_temperature'])
         
-        #elseif temperature is below minimum, go to alert
-        elif internal_temp <= Minimum_Temperature:
-            message_string = "Temperature below Minimum! Internal Temp: %.2f" %internal_temp
-            send_alert(message_string, alert_sent,SMS_to,APRS_name)
-            alert_sent = 'True'
+        #prepare to check time delta from reports
+        #get current time from clock
+        test_time_int = int(time.time())
+        logger.info("Last report time: " +format_time(lasttime_int) +" Test time: " +format_time(test_time_int))
         
-        #elseif internal and BMP temp are different by greater than 20F, go to alert
-        elif not ((bmp_temp - 20) < internal_temp < (bmp_temp + 20)):
-            message_string = f"Temperature Sensor Mismatch! Internal Temp: {internal_temp:,.2f}, BMP Temp: {bmp_temp:,.2f}" 
-            send_alert(message_string, alert_sent,SMS_to,APRS_name)
+        #measure the site and run its rules. The first active rule is the site's status
+        metrics = {
+            'internal_temp': internal_temp,
+            'bmp_temp': bmp_temp,
+            'sensor_gap': abs(internal_temp - bmp_temp),
+            'age_minutes': beacon_age(lasttime_int, test_time_int) / 60,
+            'report_time': format_time(lasttime_int),
+            'temperature_jump': 1 if temperature_jump else 0,
+            'reference_temp': reference_temp,
+            #a trend that is not heading for the minimum never reaches it
+            'freeze_minutes': freeze_minutes if freeze_minutes is not None else float('inf'),
+            'trend_per_hour': trend.slope * 60,
+        }
+        rule_states, active_rule, fired_rule = plan.evaluate(metrics, rule_states, test_time_int)
+        if fired_rule is not None:
+            SMS_key = send_alert(plan.message(fired_rule, metrics), 'False', SMS_to, APRS_name, lasttime_int)
+        #endif
+        if active_rule is not None:
+            message_string = plan.message(active_rule, metrics)
             alert_sent = 'True'
-                
         else:
-            #if temperature has passed these core checks, move to secondary checks
-          
-            #prepare to check time delta from reports
-            #get current time from clock
-            test_time_int = int(time.time())
-            test_time_iso = time.strftime('%Y-%m-%dT%H:%M:%SZ%z', time.localtime(test_time_int))
-            
-            lasttime_int = test_time_int
-            logger.info("Last report time: " +lasttime_iso + " Test time: " +test_time_iso)
-        
-            #test if report is greater than 5 minutes old
-            if test_time_int > (lasttime_int + (Maximum_Beacon_Age * 60)):
-                message_string = "APRS report is greater than " + str(Maximum_Beacon_Age) +" minutes old. Last Reported time: " + lasttime_iso
-                send_alert(message_string, alert_sent,SMS_to,APRS_name)
-                alert_sent = 'True'
-            
-            #test the temperature delta
-            elif not ((previous_recorded_temp - Maximum_Temp_Delta) < internal_temp < (previous_recorded_temp + Maximum_Temp_Delta)):
-                message_string = f"Temperature Delta Too High! Internal Temp: {internal_temp:,.2f}, Previous Temp: {previous_recorded_temp:,.2f}"
-                send_alert(message_string, alert_sent,SMS_to,APRS_name)
-                alert_sent = 'True'
-            else:
-                #temperature and time passed checks
-                message_string = "APRS is ok and current"
-                alert_sent = 'False'
-            #endif   
-        #endtemp if here
+            #temperature and time passed checks
+            message_string = "APRS is ok and current"
+            alert_sent = 'False'
+        #endif
         lambda_return['Message'] = message_string
         
-        #Complete by publishing the current state in the database
-        DBresponse = simpleDBclient.put_attributes(
-            DomainName='APRS_tracker',
-            ItemName=APRS_name,
-            Attributes=[
-                {
-                    'Name': 'report_time',
-                    'Value': lasttime_iso,
-                    'Replace': True
-                },
-                {
-                    'Name': 'comment',
-                    'Value': comment,
-                    'Replace': True
-                },
-                {
-                    'Name': 'alert_sent',
-                    'Value': alert_sent,
-                    'Replace': True
-                }
-            ]
-        )
-        #TODO alert if DB response is not 200
-   
+        #stage the current state. The outbox key rides along with it, and the outbox adds the
+        #message SID as SMS_sid once the alert is sent, for future delivery test
+        #the STATUS summary attributes ride along, so STATUS never has to parse the comment
+        #times are stored as epoch seconds
+        attributes = {'lasttime': lasttime_int, 'comment': comment, 'alert_sent': alert_sent,
+                      'trend': format_trend(trend), 'rules': format_rule_states(rule_states)}
+        attributes.update(status_attributes(internal_temp))
+        if SMS_key:
+            attributes['SMS_key'] = SMS_key
+        #endif
+        state_store.stage(APRS_name, attributes)
         
     except Exception as err:
         lambda_return['Status'] = "500"
         lambda_return['Message'] = "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}")
         lambda_return['Code'] = "SDB"
         
-        logger.exception(lambda_return['Message'])
-        return {
-            'statusCode': lambda_return['Status'],
-            'body': json.dumps(lambda_return)
-        }
-    finally:
-        simpleDBclient.close()
+        logger.exception(lambda_return['Message'] +site_tag(APRS_name))
     #endtry
     
+    return lambda_return
+#end evaluate_site
 
-    # Return to close the lambda
-    return {
-        'statusCode': lambda_return['Status'],
-        'body': json.dumps(lambda_return)
-    }
-#end lambda_handler
+#handles a site whose aprs.fi packet is the one we processed last cycle
+#only the beacon age can have changed, so only rules on it are run and the others keep their state
+#the state is written only if a rule changed
+#a site on the default rules whose beacon the caller knows is fresh has nothing that can change
+def evaluate_unchanged_site(APRS_name, SMS_to, lasttime_int, previous_state, state_store, beacon_fresh=False):
+    lambda_return = {'Status': '200', 'Message': '', 'Code':''}
+    alert_sent = previous_state.get("alert_sent", 'False')
+    lasttime_iso = format_time(lasttime_int)
+    logger.info("SDB:Packet for " +APRS_name +" unchanged since " +lasttime_iso +". Alert value is " +alert_sent)
+    
+    if beacon_fresh and "rules" in previous_state and previous_state.get("rule_set", 'default') == 'default':
+        state_store.skip(APRS_name)
+        lambda_return['Message'] = "APRS report unchanged since last poll. Alert Status is: " +alert_sent
+        return lambda_return
+    #endif
+    
+    plan = get_plan(previous_state.get("rule_set"))
+    test_time_int = int(time.time())
+    metrics = {'age_minutes': beacon_age(lasttime_int, test_time_int) / 60, 'report_time': lasttime_iso}
+    rule_states = parse_rule_states(previous_state.get("rules"), alert_sent, lasttime_int)
+    new_rule_states, active_rule, fired_rule = plan.evaluate(metrics, rule_states, test_time_int)
+    SMS_key = None
+    if fired_rule is not None:
+        message_string = plan.message(fired_rule, metrics)
+        SMS_key = send_alert(message_string, 'False', SMS_to, APRS_name, lasttime_int)
+    elif active_rule is not None and active_rule.metric in metrics:
+        message_string = plan.message(active_rule, metrics)
+    else:
+        message_string = "APRS report unchanged since last poll. Alert Status is: " +alert_sent
+    #endif
+    new_alert_sent = 'True' if active_rule is not None else 'False'
+    if new_rule_states != rule_states or new_alert_sent != alert_sent or "rules" not in previous_state:
+        attributes = {'alert_sent': new_alert_sent, 'rules': format_rule_states(new_rule_states)}
+        if SMS_key:
+            attributes['SMS_key'] = SMS_key
+        #endif
+        state_store.stage(APRS_name, attributes)
+    else:
+        state_store.skip(APRS_name)
+    #endif
+    lambda_return['Message'] = message_string
+    return lambda_return
+#end evaluate_unchanged_site
 
-#send alert publishes a SMS message. Currently through Twilio
-#records message SID into database
+#returns the suffix that marks a logged error with the sites it affects, like " site=AB1CDE,CD2EFG"
+#APRS_watchdog reads it to send the failure to the subscribers of those sites
+def site_tag(*names):
+    return " site=" +",".join(names) if names else ""
+#end site_tag
+
+#send alert queues a SMS message on the outbox. The outbox sends it through Twilio once the cycle is done
+#the idempotency key is built from the site, packet time and message, so the same alert is never queued twice
+#returns the key so the caller can record it with the site state, or None if nothing was queued
 #note! if alert_flag is FALSE, this will SEND a message!
-def send_alert(error_message,alert_flag,sms_to_number,database_target):
+def send_alert(error_message, alert_flag, sms_to_number, APRS_name, lasttime_int):
     
     logger.info("SA:Error flag is: " +alert_flag +", Error message is: " +error_message)
     
     #if the alert flag is false, we want to send a message
     if alert_flag == "False":
         try:
-            #create a database connection
-            simpleDBclient = boto3.client('sdb')
-            getDB_response = simpleDBclient.get_attributes(
-                DomainName='APRS_tracker',
-                ItemName= database_target
-            )
-            client = Client(TWILIO_ACCOUNT_SID,TWILIO_AUTH_TOKEN)
-            message = client.messages.create(
-                    messaging_service_sid= MESSAGE_SERVICE_SID,
-                    to= sms_to_number,
-                    body= error_message
-                    )
-            logger.info("SMS Sent")
-            logger.info(message.sid)
-            #record message SID in database for future delivery test
-            DBresponse = simpleDBclient.put_attributes(
-                DomainName='APRS_tracker',
-                ItemName=database_target,
-                Attributes=[
-                    {
-                        'Name': 'SMS_sid',
-                        'Value': message.sid,
-                        'Replace': True
-                    }
-                ]
-            )
-            
+            key = idempotency_key(APRS_name, sms_to_number, lasttime_int, error_message)
+            return enqueue_sms(sms_to_number, error_message, key, APRS_name)
         except Exception as err:
             logger.exception("Exception in SMS: " + (f"{type(err).__name__} was raised: {err}"))
-        
-        finally:
-            simpleDBclient.close()
         #endtry
     #if the error flag is true, an alert has already been sent, so we just ignore
     else:
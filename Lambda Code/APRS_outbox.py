@@ -0,0 +1,406 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+
+from APRS_clients import get_client, with_client_stats
+from APRS_concurrency import dependency_slot
+from APRS_metrics import with_metrics, timer, count
+from APRS_state import TRACKER_DOMAIN, get_state_store, sqlite_connection
+
+#setup logger
+logger = logging.getLogger()
+
+#durable SMS outbox
+#handlers enqueue messages instead of calling Twilio inline. A drain sends them with retry and
+#exponential backoff, and pending messages for the same number inside the coalescing window
+#are packed into as few segment-aware messages as possible
+#backends: an SQS queue consumed by lambda_handler below, or a local sqlite file drained by the
+#handler that enqueued. The sqlite file is for local runs and APRS_replay only: in Lambda /tmp
+#belongs to one container and is lost when it is recycled, along with any retry still queued in it,
+#so in Lambda the outbox defaults to SQS and OUTBOX_QUEUE_URL has to be set
+RUNNING_IN_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+OUTBOX_QUEUE_URL = os.environ.get('OUTBOX_QUEUE_URL', '')
+OUTBOX_BACKEND = os.environ.get('OUTBOX_BACKEND', 'sqs' if OUTBOX_QUEUE_URL or RUNNING_IN_LAMBDA else 'sqlite')
+OUTBOX_SQLITE_PATH = os.environ.get('OUTBOX_SQLITE_PATH', '/tmp/APRS_outbox.sqlite3')
+MESSAGING_SERVICE_SID = os.environ.get('TWILIO_MSG_SERVICE_SID', '')
+
+#messages to one number created within this many seconds of each other are sent together
+OUTBOX_COALESCE_SECONDS = int(os.environ.get('OUTBOX_COALESCE_SECONDS', '120'))
+#a coalesced message never grows past this many SMS segments
+OUTBOX_MAX_SEGMENTS = int(os.environ.get('OUTBOX_MAX_SEGMENTS', '3'))
+#retry schedule: backoff base * 2^attempts seconds, capped, until the attempts run out
+OUTBOX_BACKOFF_SECONDS = 15
+OUTBOX_MAX_BACKOFF_SECONDS = 900
+OUTBOX_MAX_ATTEMPTS = 6
+#sent and failed messages are kept this long, then purged. Sent markers have to outlive the longest
+#an SQS message can be redelivered for, which is the queue's retention of at most 14 days
+OUTBOX_RETENTION_SECONDS = int(os.environ.get('OUTBOX_RETENTION_SECONDS', str(14 * 86400)))
+
+#state store domain recording idempotency key -> message SID for the SQS consumer
+OUTBOX_SENT_DOMAIN = 'APRS_outbox'
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    sms_to TEXT NOT NULL,
+    body TEXT NOT NULL,
+    label TEXT,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    sid TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt);
+"""
+
+#GSM 03.38 basic character set. Anything outside it forces UCS-2 encoding
+GSM7_BASIC = set("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                 "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+#GSM 03.38 extension characters, sent as two septets
+GSM7_EXTENDED = set("^{}\\[~]|€\f")
+
+#returns the number of SMS segments Twilio will bill for a body
+def sms_segments(body):
+    septets = 0
+    for character in body:
+        if character in GSM7_BASIC:
+            septets += 1
+        elif character in GSM7_EXTENDED:
+            septets += 2
+        else:
+            #UCS-2: 70 code units in one segment, 67 per segment once concatenated
+            units = len(body.encode('utf-16-le')) // 2
+            return 1 if units <= 70 else -(-units // 67)
+        #endif
+    #endfor
+    return 1 if septets <= 160 else -(-septets // 153)
+#end sms_segments
+
+#derives a stable idempotency key from the parts that make a message unique
+def idempotency_key(*parts):
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+#end idempotency_key
+
+#packs queued items for one number into message bodies
+#items are dictionaries with key, body and label. Returns a list of (body, [keys])
+#a single item goes out unchanged; coalesced items are prefixed with their label
+def coalesce(items, max_segments=None):
+    max_segments = max_segments or OUTBOX_MAX_SEGMENTS
+    if len(items) == 1:
+        return [(items[0]['body'], [items[0]['key']])]
+    #endif
+    messages = []
+    lines = []
+    keys = []
+    for item in items:
+        line = (item['label'] +": " +item['body']) if item.get('label') else item['body']
+        if lines and sms_segments("\n".join(lines + [line])) > max_segments:
+            messages.append(("\n".join(lines), keys))
+            lines = []
+            keys = []
+        #endif
+        lines.append(line)
+        keys.append(item['key'])
+    #endfor
+    if lines:
+        messages.append(("\n".join(lines), keys))
+    #endif
+    return messages
+#end coalesce
+
+#splits a number's pending items into groups whose creation times fall inside one window
+def _windows(items):
+    groups = []
+    for item in sorted(items, key=lambda item: item['created']):
+        if groups and item['created'] - groups[-1][0]['created'] <= OUTBOX_COALESCE_SECONDS:
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+        #endif
+    #endfor
+    return groups
+#end _windows
+
+#sends one message through the shared Twilio client. Returns the message SID
+def _send(sms_to, body):
+    client = get_client('twilio')
+    with dependency_slot('twilio'), timer('twilio'):
+        message = client.messages.create(
+            messaging_service_sid=MESSAGING_SERVICE_SID,
+            to=sms_to,
+            body=body
+        )
+    #endwith
+    count('sms_sent')
+    return message.sid
+#end _send
+
+#writes the message SID of a delivered alert to its site's tracker item as SMS_sid, next to the SMS_key
+#the alert staged there. The write only lands while SMS_key is still this message's key, so replies,
+#summaries and alerts already superseded leave the item alone
+def _record_sid(items, sid):
+    store = get_state_store(TRACKER_DOMAIN)
+    for item in items:
+        if not item.get('label'):
+            continue
+        #endif
+        try:
+            store.update_if(item['label'], {'SMS_sid': sid}, 'SMS_key', item['key'])
+        except Exception as err:
+            logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+        #endtry
+    #endfor
+#end _record_sid
+
+def _backoff(attempts):
+    return min(OUTBOX_BACKOFF_SECONDS * (2 ** attempts), OUTBOX_MAX_BACKOFF_SECONDS)
+#end _backoff
+
+#outbox on a local sqlite file. Messages survive until sent, so a failed drain is retried
+#by the next drain once the backoff has passed
+class SQLiteOutbox:
+    def __init__(self, path=None):
+        self.path = path or OUTBOX_SQLITE_PATH
+    #end __init__
+
+    def _connection(self):
+        return sqlite_connection(self.path, OUTBOX_SCHEMA)
+    #end _connection
+
+    #queues a message. Returns the key. A key already in the outbox is not queued twice
+    def enqueue(self, sms_to, body, key=None, label=None):
+        key = key or uuid.uuid4().hex
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR IGNORE INTO outbox (key, sms_to, body, label, created, next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, sms_to, body, label, now, now)
+        )
+        logger.info("OUT:queued " +key +" for " +sms_to)
+        return key
+    #end enqueue
+
+    #sends every due message. Returns counters for the drain
+    def drain(self):
+        connection = self._connection()
+        now = time.time()
+        rows = connection.execute(
+            "SELECT key, sms_to, body, label, created, attempts FROM outbox WHERE status = 'pending' AND next_attempt <= ? ORDER BY created",
+            (now,)
+        ).fetchall()
+        by_number = {}
+        for key, sms_to, body, label, created, attempts in rows:
+            by_number.setdefault(sms_to, []).append({'key': key, 'body': body, 'label': label, 'created': created, 'attempts': attempts})
+        #endfor
+        stats = {'queued': len(rows), 'sent': 0, 'messages': 0, 'retry': 0, 'failed': 0}
+        for sms_to, items in by_number.items():
+            attempts = {item['key']: item['attempts'] for item in items}
+            by_key = {item['key']: item for item in items}
+            for window in _windows(items):
+                for body, keys in coalesce(window):
+                    try:
+                        sid = _send(sms_to, body)
+                        with connection:
+                            connection.execute("BEGIN IMMEDIATE")
+                            connection.executemany("UPDATE outbox SET status = 'sent', sid = ? WHERE key = ?", [(sid, key) for key in keys])
+                        #endwith
+                        stats['sent'] += len(keys)
+                        stats['messages'] += 1
+                        logger.info("OUT:sent " +sid +" to " +sms_to +" for " +str(len(keys)) +" queued messages")
+                    except Exception as err:
+                        self._retry(connection, keys, attempts, err, stats)
+                        continue
+                    #endtry
+                    _record_sid([by_key[key] for key in keys], sid)
+                #endfor
+            #endfor
+        #endfor
+        return stats
+    #end drain
+
+    def _retry(self, connection, keys, attempts, err, stats):
+        now = time.time()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for key in keys:
+                attempt = attempts[key] + 1
+                if attempt >= OUTBOX_MAX_ATTEMPTS:
+                    connection.execute("UPDATE outbox SET status = 'failed', attempts = ? WHERE key = ?", (attempt, key))
+                    stats['failed'] += 1
+                    logger.exception("Exception in SMS: giving up on " +key +" after " +str(attempt) +" attempts. " +(f"{type(err).__name__} was raised: {err}"))
+                else:
+                    connection.execute("UPDATE outbox SET attempts = ?, next_attempt = ? WHERE key = ?", (attempt, now + _backoff(attempt), key))
+                    stats['retry'] += 1
+                    logger.info("OUT:send failed for " +key +", retry " +str(attempt) +(f": {type(err).__name__} was raised: {err}"))
+                #endif
+            #endfor
+        #endwith
+    #end _retry
+
+    #deletes sent and failed messages older than the retention. Returns the number removed
+    def purge(self, now=None):
+        now = now or time.time()
+        cursor = self._connection().execute(
+            "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND created < ?",
+            (now - OUTBOX_RETENTION_SECONDS,)
+        )
+        return cursor.rowcount
+    #end purge
+#end SQLiteOutbox
+
+#outbox on an SQS queue. enqueue sends to the queue; lambda_handler below is the consumer
+class SQSOutbox:
+    def __init__(self, queue_url=None):
+        self.queue_url = queue_url or OUTBOX_QUEUE_URL
+        if not self.queue_url:
+            raise ValueError("OUTBOX_QUEUE_URL is not set. The sqlite outbox is for local runs only")
+        #endif
+    #end __init__
+
+    def enqueue(self, sms_to, body, key=None, label=None):
+        key = key or uuid.uuid4().hex
+        message = {'key': key, 'sms_to': sms_to, 'body': body, 'label': label, 'created': time.time()}
+        with timer('sqs'):
+            get_client('sqs').send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+        #endwith
+        logger.info("OUT:queued " +key +" for " +sms_to)
+        return key
+    #end enqueue
+
+    #the queue is drained by its own consumer
+    def drain(self):
+        return {'queued': 0, 'sent': 0, 'messages': 0, 'retry': 0, 'failed': 0}
+    #end drain
+
+    #deletes sent markers older than the retention. Returns the number removed
+    def purge(self, now=None):
+        now = int(now or time.time())
+        store = get_state_store(OUTBOX_SENT_DOMAIN)
+        purged = 0
+        for key, marker in store.scan().items():
+            if now - int(marker.get('sent', 0)) > OUTBOX_RETENTION_SECONDS:
+                store.delete(key)
+                purged += 1
+            #endif
+        #endfor
+        return purged
+    #end purge
+#end SQSOutbox
+
+OUTBOX_BACKENDS = {
+    'sqlite': SQLiteOutbox,
+    'sqs': SQSOutbox,
+}
+
+_outbox = None
+
+#returns the container's outbox on the configured backend
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = OUTBOX_BACKENDS[OUTBOX_BACKEND]()
+    #endif
+    return _outbox
+#end get_outbox
+
+#queues a message on the container's outbox. Returns the idempotency key
+def enqueue_sms(sms_to, body, key=None, label=None):
+    return get_outbox().enqueue(sms_to, body, key, label)
+#end enqueue_sms
+
+#sends whatever the local outbox has due. Handlers call this once their real work is done
+def deliver_pending():
+    try:
+        stats = get_outbox().drain()
+        if stats['queued']:
+            logger.info("OUT:drain " +json.dumps(stats))
+        #endif
+        return stats
+    except Exception as err:
+        logger.exception("Exception in SMS: outbox drain failed. " +(f"{type(err).__name__} was raised: {err}"))
+        return None
+    #endtry
+#end deliver_pending
+
+#ages out delivered and given up messages. Returns the number removed
+def purge_outbox(now=None):
+    return get_outbox().purge(now)
+#end purge_outbox
+
+#SQS consumer. Needs ReportBatchItemFailures on the event source mapping, see the README
+#already sent keys are skipped, so redelivered messages are not sent twice. Each send's markers are
+#written before the next send, so a timeout or error later in the batch cannot lose them
+#failed messages have their visibility pushed out with exponential backoff, then SQS redelivers them
+@with_client_stats
+@with_metrics
+def lambda_handler(event, context):
+    records = event.get('Records', [])
+    items = []
+    for record in records:
+        item = json.loads(record['body'])
+        item['message_id'] = record['messageId']
+        item['receipt_handle'] = record.get('receiptHandle')
+        item['receive_count'] = int(record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+        items.append(item)
+    #endfor
+
+    sent_store = get_state_store(OUTBOX_SENT_DOMAIN)
+    sent_store.load([item['key'] for item in items])
+    pending = [item for item in items if sent_store.get(item['key']) is None]
+    logger.info("OUT:" +str(len(items)) +" records, " +str(len(items) - len(pending)) +" already sent")
+
+    by_number = {}
+    for item in pending:
+        by_number.setdefault(item['sms_to'], []).append(item)
+    #endfor
+    by_key = {item['key']: item for item in pending}
+    failures = []
+    for sms_to, number_items in by_number.items():
+        for window in _windows(number_items):
+            for body, keys in coalesce(window):
+                try:
+                    sid = _send(sms_to, body)
+                except Exception as err:
+                    logger.exception("Exception in SMS: " +(f"{type(err).__name__} was raised: {err}"))
+                    count('sms_failed', len(keys))
+                    for key in keys:
+                        item = by_key[key]
+                        failures.append({'itemIdentifier': item['message_id']})
+                        _delay_retry(item)
+                    #endfor
+                    continue
+                #endtry
+                for key in keys:
+                    sent_store.stage(key, {'sid': sid, 'sent': int(time.time())})
+                #endfor
+                for key, message in sent_store.flush().items():
+                    logger.error(message +" marking " +key +" sent as " +sid)
+                #endfor
+                _record_sid([by_key[key] for key in keys], sid)
+            #endfor
+        #endfor
+    #endfor
+    return {'batchItemFailures': failures}
+#end lambda_handler
+
+#pushes a failed record's visibility out with exponential backoff
+#if that fails SQS still redelivers it, after the queue's visibility timeout
+def _delay_retry(item):
+    if not item['receipt_handle']:
+        return
+    #endif
+    try:
+        get_client('sqs').change_message_visibility(
+            QueueUrl=OUTBOX_QUEUE_URL,
+            ReceiptHandle=item['receipt_handle'],
+            VisibilityTimeout=_backoff(item['receive_count'])
+        )
+    except Exception as err:
+        logger.exception("Exception in SQS: " +(f"{type(err).__name__} was raised: {err}"))
+    #endtry
+#end _delay_retry
+
+#eof
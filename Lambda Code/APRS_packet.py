@@ -0,0 +1,93 @@
+import logging
+from typing import NamedTuple
+
+#setup logger
+logger = logging.getLogger()
+
+#streaming parser for APRS packets in TNC2 text form, as APRS-IS sends them:
+#   SOURCE>DESTINATION,PATH1,PATH2:payload
+#TNC2Stream splits received bytes into lines as they arrive, holding only the unfinished line
+#between reads. position_comment() pulls the comment out of a position report, which for the
+#LightAPRS tracker is the telemetry frame APRS_telemetry decodes. ZeroAPRS sends positions as
+#!DDMM.mmN/DDDMM.mmWs<comment>, or /HHMMSSh<position><comment> when the GPS has the time
+
+#APRS-IS lines are at most 512 bytes. A longer run without a line ending is dropped
+TNC2_MAX_LINE = 512
+
+#data type identifiers of position reports, and whether a 7 character timestamp follows
+POSITION_TYPES = {'!': False, '=': False, '/': True, '@': True}
+#uncompressed position: 8 latitude, symbol table, 9 longitude, symbol code
+UNCOMPRESSED_POSITION_LENGTH = 19
+#compressed position: symbol table, 4 latitude, 4 longitude, symbol code, course/speed and type
+COMPRESSED_POSITION_LENGTH = 13
+
+#one decoded packet
+class Packet(NamedTuple):
+    source: str
+    destination: str
+    path: tuple
+    payload: str
+#end Packet
+
+#raised when a line is not a TNC2 packet
+class PacketError(ValueError):
+    pass
+#end PacketError
+
+#splits a byte stream into lines. Feed it whatever the socket returned
+class TNC2Stream:
+    def __init__(self, max_line=TNC2_MAX_LINE):
+        self.max_line = max_line
+        self._partial = b""
+        self.dropped = 0
+    #end __init__
+
+    #returns the complete lines in data and any held back from the last call, without line endings
+    def feed(self, data):
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        if len(self._partial) > self.max_line:
+            self._partial = b""
+            self.dropped += 1
+        #endif
+        return [line.rstrip(b"\r").decode('utf-8', 'replace') for line in lines if line.strip()]
+    #end feed
+#end TNC2Stream
+
+#decodes one TNC2 line. Raises PacketError if it is not a packet
+#a third party packet, relayed with a "}" payload, is returned as the packet it carries
+def parse_tnc2(line):
+    header, separator, payload = line.partition(":")
+    source, arrow, route = header.partition(">")
+    if not separator or not arrow or not source or not route:
+        raise PacketError("Malformed TNC2 packet: " +repr(line[:80]))
+    #endif
+    if payload.startswith("}"):
+        return parse_tnc2(payload[1:])
+    #endif
+    destination, *path = route.split(",")
+    return Packet(source.upper(), destination, tuple(path), payload)
+#end parse_tnc2
+
+#returns the comment of a position report, or None if the packet is not one
+def position_comment(packet):
+    payload = packet.payload
+    if not payload or payload[0] not in POSITION_TYPES:
+        return None
+    #endif
+    position = 8 if POSITION_TYPES[payload[0]] else 1
+    if position >= len(payload):
+        return None
+    #endif
+    if payload[position].isdigit():
+        position += UNCOMPRESSED_POSITION_LENGTH
+    else:
+        position += COMPRESSED_POSITION_LENGTH
+    #endif
+    if position > len(payload):
+        return None
+    #endif
+    return payload[position:]
+#end position_comment
+
+#eof
@@ -0,0 +1,127 @@
+import os
+import time
+import random
+import logging
+
+from APRS_cache import TTLCache
+from APRS_state import get_state_store
+
+#setup logger
+logger = logging.getLogger()
+
+#token bucket rate limiting for inbound SMS commands
+#each bucket holds up to burst tokens and refills at per_hour tokens an hour. A command takes one.
+#A warm container keeps its own copy of each bucket it has seen, which never holds more tokens
+#than the shared bucket, so an empty local bucket rejects without any network call. Otherwise the
+#shared bucket in the state store is taken with a compare and swap on its version. A caller that
+#loses every swap is rejected, since the bucket is being raced for. If the store cannot be reached,
+#the local bucket decides
+RATE_LIMIT_DOMAIN = 'APRS_ratelimit'
+
+#bucket kind -> (burst, tokens per hour)
+RATE_LIMITS = {
+    'number': (int(os.environ.get('RATE_LIMIT_NUMBER_BURST', '5')), float(os.environ.get('RATE_LIMIT_NUMBER_PER_HOUR', '20'))),
+    'callsign': (int(os.environ.get('RATE_LIMIT_CALLSIGN_BURST', '10')), float(os.environ.get('RATE_LIMIT_CALLSIGN_PER_HOUR', '30'))),
+}
+
+#attempts at the shared compare and swap before rejecting, and the jittered wait between them,
+#doubled after each lost swap
+RATE_LIMIT_CAS_ATTEMPTS = 4
+RATE_LIMIT_CAS_BACKOFF_SECONDS = 0.02
+
+#bucket kind -> local buckets. An entry expires once its bucket would have refilled completely
+_local_buckets = {kind: TTLCache(maxsize=4096, ttl=burst / per_hour * 3600) for kind, (burst, per_hour) in RATE_LIMITS.items()}
+
+#returns the tokens in a bucket at now, given its stored tokens and update time
+def refill(tokens, updated, now, burst, per_hour):
+    return min(burst, tokens + max(0.0, now - updated) * per_hour / 3600)
+#end refill
+
+#returns the tokens in this container's bucket for key, without taking one
+def _local_tokens(kind, key, now):
+    burst, per_hour = RATE_LIMITS[kind]
+    tokens, updated = _local_buckets[kind].get(key, (burst, now))
+    return refill(tokens, updated, now, burst, per_hour)
+#end _local_tokens
+
+#returns False if this container's bucket for key is already empty. Takes no token and makes no
+#network call, so a flood can be turned away before anything reaches AWS
+def allow_locally(kind, key, now=None):
+    now = now or time.time()
+    if RATE_LIMITS[kind][0] <= 0 or _local_tokens(kind, key, now) >= 1:
+        return True
+    #endif
+    logger.info("RATE:" +kind +" " +key +" rejected locally")
+    return False
+#end allow_locally
+
+#takes a token from the kind's bucket for key. Returns True if the command may run
+def allow(kind, key, now=None):
+    now = now or time.time()
+    burst, per_hour = RATE_LIMITS[kind]
+    if burst <= 0:
+        #a limit of 0 turns the bucket off
+        return True
+    #endif
+    tokens = _local_tokens(kind, key, now)
+    if tokens < 1:
+        logger.info("RATE:" +kind +" " +key +" rejected locally")
+        return False
+    #endif
+    try:
+        allowed, tokens = _take_shared(kind, key, now, burst, per_hour)
+    except Exception as err:
+        #without the shared store, the local bucket decides. It holds this container to the limit
+        logger.exception("Exception in SDB: " +(f"{type(err).__name__} was raised: {err}"))
+        allowed = tokens >= 1
+        tokens = tokens - 1 if allowed else tokens
+    #endtry
+    _local_buckets[kind].put(key, (tokens, now))
+    if not allowed:
+        logger.info("RATE:" +kind +" " +key +" rejected")
+    #endif
+    return allowed
+#end allow
+
+#checks an inbound command against the number's bucket and, if it names one, the callsign's bucket
+def allow_command(inbound_number, callsign=None):
+    if not allow('number', inbound_number):
+        return False
+    #endif
+    return callsign is None or allow('callsign', callsign)
+#end allow_command
+
+#checks an inbound command against this container's buckets only, as allow_locally does
+def allow_command_locally(inbound_number, callsign=None):
+    return allow_locally('number', inbound_number) and (callsign is None or allow_locally('callsign', callsign))
+#end allow_command_locally
+
+#takes a token from the shared bucket. Returns (allowed, tokens left)
+#every lost swap is followed by a jittered wait and a fresh read. A caller that loses them all is
+#rejected, so a flood across many containers cannot get past the limit by racing
+def _take_shared(kind, key, now, burst, per_hour):
+    store = get_state_store(RATE_LIMIT_DOMAIN)
+    name = kind +":" +key
+    for attempt in range(RATE_LIMIT_CAS_ATTEMPTS):
+        bucket = store.get(name)
+        if bucket is None:
+            tokens, version = burst, None
+        else:
+            tokens = refill(float(bucket['tokens']), float(bucket['updated']), now, burst, per_hour)
+            version = bucket['version']
+        #endif
+        if tokens < 1:
+            return False, tokens
+        #endif
+        tokens -= 1
+        if store.update_if(name, {'tokens': "%.4f" %tokens, 'updated': "%.3f" %now, 'version': int(version or 0) + 1}, 'version', version):
+            return True, tokens
+        #endif
+        delay = RATE_LIMIT_CAS_BACKOFF_SECONDS * (2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+    #endfor
+    logger.info("RATE:" +name +" lost the compare and swap " +str(RATE_LIMIT_CAS_ATTEMPTS) +" times, rejected")
+    return False, tokens + 1
+#end _take_shared
+
+#eof
@@ -0,0 +1,565 @@
+import os
+import sys
+import gzip
+import json
+import time
+import base64
+import random
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import socketserver
+import multiprocessing
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#offline replay and load generation for the three handlers. Run from this directory:
+#   python APRS_replay.py generate stream.jsonl --notify 2000 --webhook 2000 --watchdog 50
+#   python APRS_replay.py run stream.jsonl --rate 200 --processes 4 --allocations --output after.json --compare before.json
+#a stream is a JSON lines file of {"handler": module name, "event": Lambda event}. generate
+#synthesizes one, and a capture from a deployed function (APRS_RECORD_PATH, see APRS_clients) has
+#the same layout. run replays a stream through the real handlers at a target rate over several
+#processes, against local stand-ins: an HTTP server answering the aprs.fi and Twilio endpoints,
+#SQLite state, outbox and history under a scratch directory in place of SimpleDB, SQS and S3, and
+#an in process Lambda client for tick shards. Nothing leaves the machine.
+#   python APRS_replay.py aprsis capture.txt --port 14580 --rate 10
+#serves a TNC2 capture (APRSIS_CAPTURE_PATH, see APRS_is) as an APRS-IS server, for APRS_is to connect to
+#Reports p50/p95/p99 latency, throughput and per invocation allocations for each handler, and the
+#mean per invocation stage times and counters from the handlers' metrics records (APRS_metrics)
+
+#handler module -> short name used in reports and on the command line
+HANDLERS = {'APRS_notify': 'notify', 'APRS_SMS_processor': 'webhook', 'APRS_watchdog': 'watchdog'}
+
+#configuration every replay process runs with. Anything already in the environment wins
+REPLAY_ENVIRONMENT = {
+    'APRSFI_KEY': 'replay',
+    'TWILIO_ACCOUNT_SID': 'ACreplay',
+    'TWILIO_AUTH_TOKEN': 'replay',
+    'TWILIO_MSG_SERVICE_SID': 'MGreplay',
+    'REQUEST_URL': 'https://replay.invalid/sms',
+    'TWILIO_SDK': '0',
+    #synthetic streams reuse a few numbers and callsigns, far past the production limits
+    'RATE_LIMIT_NUMBER_BURST': '1000000',
+    'RATE_LIMIT_CALLSIGN_BURST': '1000000',
+}
+
+#synthetic sites the notify and watchdog streams name
+REPLAY_SITES = 100
+
+#notify sites whose stand-in beacon is one of these is reported too cold, late or broken
+STAND_IN_FAULTS = {'cold': 0.02, 'late': 0.02, 'sensor': 0.01}
+
+#the aprs.fi and Twilio stand-in. Serves both APIs from one port
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #headers and body go out in separate writes. Without this, delayed ACKs add 40 ms to every keep-alive call
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path != '/api/get':
+            return self._reply(404, {'result': 'fail', 'description': 'unknown endpoint'})
+        #endif
+        query = urllib.parse.parse_qs(parts.query)
+        names = query.get('name', [''])[0].split(',')
+        self.server.count('aprs')
+        self._reply(200, {'result': 'ok', 'what': 'loc', 'found': len(names), 'entries': [self.server.beacon(name) for name in names if name]})
+    #end do_GET
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        fields = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        if not self.path.endswith('/Messages.json'):
+            return self._reply(404, {'code': 20404, 'message': 'unknown endpoint'})
+        #endif
+        sid = "SM%032x" %self.server.count('twilio')
+        self._reply(201, {'sid': sid, 'status': 'queued', 'to': fields.get('To', [''])[0], 'body': fields.get('Body', [''])[0], 'error_code': None})
+    #end do_POST
+
+    def _reply(self, status, payload):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        #endif
+        body = json.dumps(payload).encode('utf-8')
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body)
+        #endif
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        #endif
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    #end _reply
+
+    def log_message(self, format, *args):
+        pass
+    #end log_message
+#end StandInHandler
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, seed=6):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self._seed = seed
+        self._counts = {'aprs': 0, 'twilio': 0}
+        self._counts_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, name='stand-in', daemon=True)
+    #end __init__
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" +str(self.server_address[1])
+    #end url
+
+    def start(self):
+        self._thread.start()
+        return self
+    #end start
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    #end stop
+
+    #counts one request. Returns the running count
+    def count(self, name):
+        with self._counts_lock:
+            self._counts[name] += 1
+            return self._counts[name]
+        #endwith
+    #end count
+
+    def counts(self):
+        with self._counts_lock:
+            return dict(self._counts)
+        #endwith
+    #end counts
+
+    #returns an aprs.fi location entry for a site, with a new packet every minute
+    #a fixed share of sites reports a fault, so the alert paths are exercised too
+    def beacon(self, name):
+        now = int(time.time())
+        generator = random.Random(name + str(now // 60) + str(self._seed))
+        internal_temp = generator.uniform(55, 75)
+        lasttime = now - generator.randint(5, 120)
+        fault = generator.random()
+        if fault < STAND_IN_FAULTS['cold']:
+            internal_temp = generator.uniform(20, 39)
+        elif fault < STAND_IN_FAULTS['cold'] + STAND_IN_FAULTS['late']:
+            lasttime = now - 3600
+        elif fault < STAND_IN_FAULTS['cold'] + STAND_IN_FAULTS['late'] + STAND_IN_FAULTS['sensor']:
+            internal_temp = 200
+        #endif
+        comment = "TI%6.2f TB%6.2f hPa%7.2f V%5.2f Tx%03d LightAPRS 2.0" %(internal_temp, internal_temp + generator.uniform(-1, 1), generator.uniform(1000, 1020), generator.uniform(3.8, 4.2), now // 60 % 1000)
+        return {'class': 'a', 'name': name, 'type': 'l', 'time': str(lasttime), 'lasttime': str(lasttime), 'comment': comment}
+    #end beacon
+#end StandInServer
+
+#in process stand-in for the Lambda client, so a sharded tick runs its shards here
+class LambdaStandIn:
+    def invoke(self, FunctionName, InvocationType, Payload):
+        import APRS_notify
+        APRS_notify.lambda_handler(json.loads(Payload), None)
+        return {'StatusCode': 202}
+    #end invoke
+#end LambdaStandIn
+
+#one APRS-IS client connection: login, then the capture at the server's rate
+#only packets from callsigns in the client's b/ filter are sent, and #filter lines from the client replace it
+class APRSISStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self._serve()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        #endtry
+    #end handle
+
+    def _serve(self):
+        self.filter = []
+        self.wfile.write(b"# aprsc 2.1.10-replay\r\n")
+        login = self.rfile.readline().decode('utf-8', 'replace').strip()
+        if not login.startswith("user "):
+            return
+        #endif
+        words = login.split()
+        self._set_filter(login.partition(" filter ")[2])
+        self.wfile.write(("# logresp " +words[1] +" unverified, server REPLAY\r\n").encode('utf-8'))
+        threading.Thread(target=self._read_commands, daemon=True).start()
+        interval = 1.0 / self.server.rate if self.server.rate else 0.0
+        while True:
+            for line in self.server.capture:
+                if line.startswith("#"):
+                    continue
+                #endif
+                source = line.partition(">")[0].upper()
+                if any(source == call or (call.endswith("*") and source.startswith(call[:-1])) for call in self.filter):
+                    self.wfile.write((line + "\r\n").encode('utf-8'))
+                    self.server.count()
+                    if interval:
+                        time.sleep(interval)
+                    #endif
+                #endif
+            #endfor
+            if not self.server.loop:
+                break
+            #endif
+        #endwhile
+        #keep the connection open with keepalives, like a real server with nothing more to send
+        while True:
+            time.sleep(20)
+            self.wfile.write(b"# replay keepalive\r\n")
+        #endwhile
+    #end _serve
+
+    def _read_commands(self):
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace').strip()
+            if line.startswith("#filter"):
+                self._set_filter(line[len("#filter"):])
+            #endif
+        #endfor
+    #end _read_commands
+
+    #keeps the callsigns of the b/ terms of a filter
+    def _set_filter(self, filter_text):
+        self.filter = [call.upper() for term in filter_text.split() if term.startswith("b/") for call in term[2:].split("/") if call]
+    #end _set_filter
+#end APRSISStandInHandler
+
+class APRSISStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, capture, port=0, rate=0.0, loop=False):
+        super().__init__(('127.0.0.1', port), APRSISStandInHandler)
+        self.capture = capture
+        self.rate = rate
+        self.loop = loop
+        self.sent = 0
+        self._sent_lock = threading.Lock()
+    #end __init__
+
+    def count(self):
+        with self._sent_lock:
+            self.sent += 1
+        #endwith
+    #end count
+#end APRSISStandIn
+
+#serves a capture file until interrupted
+def serve_aprsis(arguments):
+    with open(arguments.capture) as capture_file:
+        capture = [line.rstrip("\r\n") for line in capture_file if line.strip()]
+    #endwith
+    server = APRSISStandIn(capture, arguments.port, arguments.rate, arguments.loop)
+    print(f"serving {len(capture)} lines on 127.0.0.1:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    #endtry
+    server.server_close()
+    print(f"sent {server.sent} packets")
+    return 0
+#end serve_aprsis
+
+#builds notify events as the EventBridge schedules send them: one site per event, and an occasional tick
+def synthetic_notify_events(count, sites=REPLAY_SITES, tick_every=0):
+    events = []
+    for event in range(count):
+        if tick_every and event % tick_every == tick_every - 1:
+            events.append({'tick': True})
+        else:
+            site = event % sites
+            events.append({'APRS_name': "SIM%05d" %site, 'SMS_to': "+1970555%04d" %site})
+        #endif
+    #endfor
+    return events
+#end synthetic_notify_events
+
+#builds API Gateway events carrying signed Twilio webhooks, base64 encoded like the gateway sends them
+#START, STATUS and STOP are mixed so every command path runs
+def synthetic_webhook_events(count, url, auth_token):
+    from APRS_bench import synthetic_webhooks
+    events = []
+    for signature, payload in synthetic_webhooks(count, url, auth_token, ('START', 'STATUS', 'STATUS', 'STOP')):
+        events.append({'headers': {'x-twilio-signature': signature}, 'body': base64.b64encode(payload.encode('utf-8')).decode('ascii'), 'isBase64Encoded': True})
+    #endfor
+    return events
+#end synthetic_webhook_events
+
+#builds CloudWatch Logs subscription events, gzipped and base64 encoded, of failures_per_event error lines each
+def synthetic_watchdog_events(count, failures_per_event=20, sites=REPLAY_SITES, seed=7):
+    generator = random.Random(seed)
+    failures = [
+        "APRS:Response not 200: 503",
+        "Exception in SDB: ClientError was raised: An error occurred (ServiceUnavailable)",
+        "APRS:Exception in APRS Query: TimeoutError was raised: timed out",
+    ]
+    events = []
+    for event in range(count):
+        log_events = []
+        for failure in range(failures_per_event):
+            timestamp = int(time.time() * 1000) + failure
+            message = failures[generator.randrange(len(failures))] +" site=SIM%05d" %generator.randrange(sites)
+            log_events.append({'id': "%d%04d" %(event, failure), 'timestamp': timestamp,
+                               'message': "[ERROR]\t2024-01-01T00:00:00.000Z\treplay-%d\t%s\nTraceback (most recent call last):\n" %(event, message)})
+        #endfor
+        payload = {'messageType': 'DATA_MESSAGE', 'owner': '000000000000', 'logGroup': '/aws/lambda/APRS_notify', 'logStream': 'replay',
+                   'subscriptionFilters': ['errors'], 'logEvents': log_events}
+        events.append({'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(payload).encode('utf-8'))).decode('ascii')}})
+    #endfor
+    return events
+#end synthetic_watchdog_events
+
+#writes a synthetic stream, the handlers interleaved at random
+def generate(arguments):
+    environment = dict(REPLAY_ENVIRONMENT)
+    environment.update(os.environ)
+    stream = [('APRS_notify', event) for event in synthetic_notify_events(arguments.notify, arguments.sites, arguments.tick_every)]
+    stream += [('APRS_SMS_processor', event) for event in synthetic_webhook_events(arguments.webhook, environment['REQUEST_URL'], environment['TWILIO_AUTH_TOKEN'])]
+    stream += [('APRS_watchdog', event) for event in synthetic_watchdog_events(arguments.watchdog, arguments.failures, arguments.sites)]
+    random.Random(arguments.seed).shuffle(stream)
+    with open(arguments.stream, 'w') as stream_file:
+        for handler_name, event in stream:
+            stream_file.write(json.dumps({'handler': handler_name, 'event': event}) + "\n")
+        #endfor
+    #endwith
+    print(f"wrote {len(stream)} events to {arguments.stream}")
+    return 0
+#end generate
+
+#reads a stream file. Returns a list of (handler module, event)
+def load_stream(path):
+    stream = []
+    with open(path) as stream_file:
+        for line in stream_file:
+            if line.strip():
+                record = json.loads(line)
+                stream.append((record['handler'], record['event']))
+            #endif
+        #endfor
+    #endwith
+    return stream
+#end load_stream
+
+#replays one process's share of the stream at its share of the rate
+#returns handler -> list of (latency seconds, status code, peak bytes, retained bytes), and the wall time
+def replay_worker(task):
+    stream, rate, environment, allocations = task
+    os.environ.update(environment)
+    import APRS_clients
+    APRS_clients.CLIENT_FACTORIES['lambda'] = LambdaStandIn
+    modules = {handler_name: __import__(handler_name) for handler_name in sorted({handler_name for handler_name, event in stream})}
+    results = {handler_name: [] for handler_name in modules}
+    if allocations:
+        tracemalloc.start()
+    #endif
+    interval = 1.0 / rate if rate else 0.0
+    start = time.perf_counter()
+    for index, (handler_name, event) in enumerate(stream):
+        #open loop pacing: a slow invocation is not made up for by sending the next one early
+        delay = start + index * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        #endif
+        peak = retained = 0
+        if allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        #endif
+        invoke_start = time.perf_counter()
+        try:
+            status = str(modules[handler_name].lambda_handler(event, None)['statusCode'])
+        except Exception as err:
+            status = type(err).__name__
+        #endtry
+        latency = time.perf_counter() - invoke_start
+        if allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            peak, retained = peak - before, current - before
+        #endif
+        results[handler_name].append((latency, status, peak, retained))
+    #endfor
+    elapsed = time.perf_counter() - start
+    if allocations:
+        tracemalloc.stop()
+    #endif
+    return results, elapsed
+#end replay_worker
+
+#nearest rank percentile of a sorted list
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+#end percentile
+
+#summarizes the worker results per handler. Allocations are None unless they were traced
+def build_report(worker_results, wall, allocations=False):
+    merged = {}
+    for results, elapsed in worker_results:
+        for handler_name, samples in results.items():
+            merged.setdefault(handler_name, []).extend(samples)
+        #endfor
+    #endfor
+    report = {}
+    for handler_name, samples in sorted(merged.items()):
+        latencies = sorted(sample[0] for sample in samples)
+        statuses = {}
+        for sample in samples:
+            statuses[sample[1]] = statuses.get(sample[1], 0) + 1
+        #endfor
+        report[HANDLERS.get(handler_name, handler_name)] = {
+            'count': len(samples),
+            'throughput': len(samples) / wall,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'peak_kib': sum(sample[2] for sample in samples) / len(samples) / 1024 if allocations else None,
+            'retained_kib': sum(sample[3] for sample in samples) / len(samples) / 1024 if allocations else None,
+            'statuses': statuses,
+        }
+    #endfor
+    return report
+#end build_report
+
+#reads the metrics records the handlers wrote to the local sink
+#returns handler -> metric name -> mean per invocation, for the stage times and counters
+def summarize_metrics(path):
+    totals = {}
+    invocations = {}
+    if not os.path.exists(path):
+        return {}
+    #endif
+    with open(path) as metrics_file:
+        for line in metrics_file:
+            record = json.loads(line)
+            handler = HANDLERS.get(record['Function'], record['Function'])
+            invocations[handler] = invocations.get(handler, 0) + 1
+            handler_totals = totals.setdefault(handler, {})
+            for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                handler_totals[metric['Name']] = handler_totals.get(metric['Name'], 0) + record[metric['Name']]
+            #endfor
+        #endfor
+    #endwith
+    return {handler: {name: total / invocations[handler] for name, total in sorted(handler_totals.items())} for handler, handler_totals in totals.items()}
+#end summarize_metrics
+
+def print_report(report, baseline=None):
+    for handler, row in report.items():
+        line = f"{handler:<9} {row['count']:6d} calls {row['throughput']:8.1f}/s  p50 {row['p50_ms']:7.2f} ms  p95 {row['p95_ms']:7.2f} ms  p99 {row['p99_ms']:7.2f} ms  "
+        if row['peak_kib'] is not None:
+            line += f"peak {row['peak_kib']:7.1f} KiB  retained {row['retained_kib']:6.1f} KiB  "
+        #endif
+        print(line +" ".join(f"{status}:{count}" for status, count in sorted(row['statuses'].items())))
+        if row.get('metrics'):
+            print(f"{'':<9} per call: " +", ".join(f"{name} {value:.2f}" for name, value in row['metrics'].items() if name != 'duration_ms'))
+        #endif
+        if baseline and handler in baseline:
+            before = baseline[handler]
+            changes = [f"{field[:-3]} {(row[field] - before[field]) / before[field]:+.1%}" for field in ('p50_ms', 'p95_ms', 'p99_ms') if before[field]]
+            print(f"{'':<9} vs baseline: " +", ".join(changes))
+        #endif
+    #endfor
+#end print_report
+
+#replays a stream against the stand-ins and reports per handler
+def run(arguments):
+    stream = load_stream(arguments.stream)
+    if arguments.handlers:
+        wanted = set(arguments.handlers.split(','))
+        stream = [(handler_name, event) for handler_name, event in stream if HANDLERS.get(handler_name) in wanted or handler_name in wanted]
+    #endif
+    stream = stream * arguments.repeat
+    stand_in = StandInServer(arguments.latency / 1000).start()
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(REPLAY_ENVIRONMENT)
+        environment.update({
+            'APRSFI_URL': stand_in.url +"/api/get",
+            'TWILIO_API_URL': stand_in.url,
+            'STATE_BACKEND': 'sqlite',
+            'STATE_SQLITE_PATH': os.path.join(directory, 'state.sqlite3'),
+            'OUTBOX_BACKEND': 'sqlite',
+            'OUTBOX_SQLITE_PATH': os.path.join(directory, 'outbox.sqlite3'),
+            'HISTORY_BACKEND': 'file',
+            'HISTORY_PATH': os.path.join(directory, 'history'),
+            'METRICS_ENABLED': '1',
+            'METRICS_SAMPLE_RATE': '1',
+            'METRICS_PATH': os.path.join(directory, 'metrics.jsonl'),
+        })
+        environment.update({key: value for key, value in os.environ.items() if key in REPLAY_ENVIRONMENT})
+        processes = max(1, arguments.processes)
+        rate = arguments.rate / processes if arguments.rate else 0.0
+        tasks = [(stream[process::processes], rate, environment, arguments.allocations) for process in range(processes)]
+        #spawn, so every process imports the handlers fresh with the replay environment
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            start = time.perf_counter()
+            worker_results = pool.map(replay_worker, tasks)
+            wall = time.perf_counter() - start
+        #endwith
+        metrics = summarize_metrics(environment['METRICS_PATH'])
+    #endwith
+    stand_in.stop()
+    report = build_report(worker_results, wall, arguments.allocations)
+    for handler, row in report.items():
+        row['metrics'] = metrics.get(handler, {})
+    #endfor
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)['handlers']
+        #endwith
+    #endif
+    print(f"replayed {len(stream)} events over {processes} processes in {wall:.2f} s ({len(stream) / wall:.1f} events/s, target {arguments.rate or 'unpaced'}), stand-in calls {stand_in.counts()}")
+    print_report(report, baseline)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump({'events': len(stream), 'processes': processes, 'rate': arguments.rate, 'wall': wall, 'handlers': report}, output_file, indent=1)
+        #endwith
+    #endif
+    return 0 if all(status.startswith('2') for row in report.values() for status in row['statuses']) else 1
+#end run
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay event streams through the APRS handlers against local stand-ins")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate_parser = commands.add_parser('generate', help="write a synthetic event stream")
+    generate_parser.add_argument('stream')
+    generate_parser.add_argument('--notify', type=int, default=1000, help="notify events")
+    generate_parser.add_argument('--webhook', type=int, default=1000, help="Twilio webhook events")
+    generate_parser.add_argument('--watchdog', type=int, default=20, help="CloudWatch log events")
+    generate_parser.add_argument('--failures', type=int, default=20, help="log lines per watchdog event")
+    generate_parser.add_argument('--sites', type=int, default=REPLAY_SITES)
+    generate_parser.add_argument('--tick-every', type=int, default=0, help="make every Nth notify event a tick")
+    generate_parser.add_argument('--seed', type=int, default=8)
+    run_parser = commands.add_parser('run', help="replay a stream and report latency, throughput and allocations")
+    run_parser.add_argument('stream')
+    run_parser.add_argument('--rate', type=float, default=0.0, help="target events per second over all processes, 0 for as fast as possible")
+    run_parser.add_argument('--processes', type=int, default=1)
+    run_parser.add_argument('--repeat', type=int, default=1, help="replay the stream this many times")
+    run_parser.add_argument('--handlers', default='', help="comma separated handlers to replay, all by default")
+    run_parser.add_argument('--latency', type=float, default=0.0, help="milliseconds the stand-ins wait before answering")
+    run_parser.add_argument('--allocations', action='store_true', help="trace allocations per invocation, slower")
+    run_parser.add_argument('--output', help="write the report as JSON, for a later --compare")
+    run_parser.add_argument('--compare', help="print the change against a report written by --output")
+    aprsis_parser = commands.add_parser('aprsis', help="serve a TNC2 capture as an APRS-IS server")
+    aprsis_parser.add_argument('capture')
+    aprsis_parser.add_argument('--port', type=int, default=14580)
+    aprsis_parser.add_argument('--rate', type=float, default=0.0, help="packets per second per connection, 0 for as fast as possible")
+    aprsis_parser.add_argument('--loop', action='store_true', help="start the capture over when it ends")
+    arguments = parser.parse_args(argv)
+    return {'generate': generate, 'run': run, 'aprsis': serve_aprsis}[arguments.command](arguments)
+#end main
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#eof
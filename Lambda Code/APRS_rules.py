@@ -0,0 +1,199 @@
+import os
+import json
+import logging
+import operator
+import threading
+from typing import NamedTuple
+
+from APRS_trend import TREND_HORIZON_MINUTES
+
+#setup logger
+logger = logging.getLogger()
+
+#data driven alert rules
+#a rule set is a dictionary of parameters and an ordered list of rules. Each rule tests one
+#metric of a site against a threshold, given as a number or a parameter name. A rule that
+#triggers stays active until the metric is back past its threshold by the rule's hysteresis.
+#A rule sends its SMS when it triggers, or once its cooldown since its last SMS has passed if it
+#triggered during the cooldown. One SMS goes out per site per cycle, for the first rule in the list
+#that fires; other rules triggering in the same cycle are covered by it. The first active rule in
+#the list is the site's status, like the first true branch of the old if/elif chain. Rule sets are compiled once per container into a RulePlan
+#sites pick a rule set with the rule_set attribute of their tracker item, the default otherwise
+
+#the thresholds that used to be module constants in APRS_notify
+DEFAULT_PARAMETERS = {
+    'maximum_temperature': 85,
+    'minimum_temperature': 40,
+    'temperature_delta': 3,
+    'maximum_beacon_age': 5, #in minutes
+    #the internal and BMP sensors disagreeing by this much means one of them is wrong
+    'sensor_mismatch': 20,
+    #the tracker reports 200 on a known sensor error
+    'sensor_error': 199,
+    #degrees a temperature alert must recover by before it clears
+    'hysteresis': 2,
+    #minutes before a rule that cleared may send another SMS
+    'cooldown': 30,
+    'freeze_horizon': TREND_HORIZON_MINUTES,
+}
+
+DEFAULT_RULES = [
+    {'name': 'sensor_error', 'metric': 'internal_temp', 'op': '>', 'threshold': 'sensor_error',
+     'message': "Temperature Sensor Malfunction: error 200"},
+    {'name': 'maximum', 'metric': 'internal_temp', 'op': '>=', 'threshold': 'maximum_temperature', 'hysteresis': 'hysteresis',
+     'message': "Temperature exceeds Maximum! Internal Temp: {internal_temp:.2f}"},
+    {'name': 'minimum', 'metric': 'internal_temp', 'op': '<=', 'threshold': 'minimum_temperature', 'hysteresis': 'hysteresis',
+     'message': "Temperature below Minimum! Internal Temp: {internal_temp:.2f}"},
+    {'name': 'mismatch', 'metric': 'sensor_gap', 'op': '>=', 'threshold': 'sensor_mismatch',
+     'message': "Temperature Sensor Mismatch! Internal Temp: {internal_temp:,.2f}, BMP Temp: {bmp_temp:,.2f}"},
+    {'name': 'beacon_age', 'metric': 'age_minutes', 'op': '>', 'threshold': 'maximum_beacon_age',
+     'message': "APRS report is greater than {maximum_beacon_age} minutes old. Last Reported time: {report_time}"},
+    {'name': 'delta', 'metric': 'temperature_jump', 'op': '>=', 'threshold': 1,
+     'message': "Temperature Delta Too High! Internal Temp: {internal_temp:,.2f}, Previous Temp: {reference_temp:,.2f}"},
+    {'name': 'freeze', 'metric': 'freeze_minutes', 'op': '<=', 'threshold': 'freeze_horizon',
+     'message': "Temperature projected to freeze in {freeze_minutes:.0f} minutes! Internal Temp: {internal_temp:.2f}, Trend: {trend_per_hour:.2f} F/hour"},
+]
+
+#rule set name -> {'parameters': ..., 'rules': ...}. A set without rules uses the default rules
+#with its own parameters. More sets can be loaded from the JSON file named by APRS_RULES_PATH
+RULE_SETS = {'default': {'parameters': DEFAULT_PARAMETERS, 'rules': DEFAULT_RULES}}
+if os.environ.get('APRS_RULES_PATH'):
+    with open(os.environ['APRS_RULES_PATH']) as rules_file:
+        RULE_SETS.update(json.load(rules_file))
+    #endwith
+#endif
+
+#rules whose threshold is an upper bound clear below it, the others clear above it
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+UPPER_BOUNDS = {'>', '>='}
+
+class CompiledRule(NamedTuple):
+    name: str
+    metric: str
+    test: object
+    threshold: float
+    clear_threshold: float
+    cooldown: int
+    message: str
+#end CompiledRule
+
+#per rule state: active flag, the time of its last SMS, and whether its SMS is held by the cooldown
+class RuleState(NamedTuple):
+    active: bool
+    last_alert: int
+    pending: bool = False
+#end RuleState
+
+INACTIVE = RuleState(False, 0)
+
+#an evaluation plan compiled from one rule set
+class RulePlan:
+    def __init__(self, name, rule_set):
+        self.name = name
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.parameters.update(rule_set.get('parameters', {}))
+        self.rules = tuple(self._compile(rule) for rule in rule_set.get('rules') or DEFAULT_RULES)
+    #end __init__
+
+    def _value(self, value):
+        return float(self.parameters[value] if isinstance(value, str) else value)
+    #end _value
+
+    def _compile(self, rule):
+        threshold = self._value(rule['threshold'])
+        hysteresis = self._value(rule.get('hysteresis', 0))
+        clear_threshold = threshold - hysteresis if rule['op'] in UPPER_BOUNDS else threshold + hysteresis
+        return CompiledRule(rule['name'], rule['metric'], OPERATORS[rule['op']], threshold, clear_threshold,
+                            int(self._value(rule.get('cooldown', 'cooldown')) * 60), rule['message'])
+    #end _compile
+
+    #evaluates one site's metrics. A metric that is missing or None leaves its rules as they were
+    #states is rule name -> RuleState for the site
+    #returns (new states, first active rule or None, first rule that should send its SMS now or None)
+    def evaluate(self, metrics, states, now):
+        new_states = {}
+        active_rule = None
+        fired_rule = None
+        for rule in self.rules:
+            state = states.get(rule.name, INACTIVE)
+            value = metrics.get(rule.metric)
+            if value is not None:
+                #an active rule holds until the metric passes the clear threshold
+                active = rule.test(value, rule.clear_threshold if state.active else rule.threshold)
+                wants_alert = active and (state.pending or not state.active)
+                if wants_alert and fired_rule is None and now - state.last_alert >= rule.cooldown:
+                    fired_rule = rule
+                    state = RuleState(True, now)
+                else:
+                    #held by the cooldown, or covered by a higher rule's SMS this cycle
+                    state = RuleState(active, state.last_alert, wants_alert and fired_rule is None)
+                #endif
+            #endif
+            if state.active and active_rule is None:
+                active_rule = rule
+            #endif
+            #inactive rules are only remembered while their cooldown runs
+            if state.active or now - state.last_alert < rule.cooldown:
+                new_states[rule.name] = state
+            #endif
+        #endfor
+        return new_states, active_rule, fired_rule
+    #end evaluate
+
+    #formats a rule's message with the plan's parameters and a site's metrics
+    def message(self, rule, metrics):
+        return rule.message.format(**self.parameters, **metrics)
+    #end message
+#end RulePlan
+
+#rule set name -> compiled plan, for the life of the container
+_plans = {}
+_plans_lock = threading.Lock()
+
+#returns the compiled plan for a rule set. Unknown names get the default set
+def get_plan(name=None):
+    name = name or 'default'
+    plan = _plans.get(name)
+    if plan is None:
+        if name not in RULE_SETS:
+            logger.error("RULES:Unknown rule set " +name +", using default")
+            name = 'default'
+        #endif
+        with _plans_lock:
+            plan = _plans.get(name)
+            if plan is None:
+                plan = _plans[name] = RulePlan(name, RULE_SETS[name])
+            #endif
+        #endwith
+    #endif
+    return plan
+#end get_plan
+
+#parses the rule states stored in a tracker item's rules attribute: name=flag@last_alert|...
+#flag is 0 for inactive, 1 for active and 2 for active with its SMS held by the cooldown
+#items from before the rule engine only have alert_sent. An alert in flight then counts as every
+#rule active, so nothing is sent again until the rules that no longer hold have cleared
+def parse_rule_states(value, alert_sent=None, now=0):
+    if value is None:
+        if alert_sent == 'True':
+            return {rule['name']: RuleState(True, now) for rule in DEFAULT_RULES}
+        #endif
+        return {}
+    #endif
+    states = {}
+    for field in value.split("|"):
+        if field:
+            name, state = field.split("=")
+            flag, last_alert = state.split("@")
+            states[name] = RuleState(flag != "0", int(last_alert), flag == "2")
+        #endif
+    #endfor
+    return states
+#end parse_rule_states
+
+#formats rule states for the tracker item's rules attribute
+def format_rule_states(states):
+    return "|".join(name +"=" +("2" if state.pending else "1" if state.active else "0") +"@" +str(state.last_alert) for name, state in states.items())
+#end format_rule_states
+
+#eof
@@ -0,0 +1,458 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+from APRS_clients import get_client
+from APRS_concurrency import dependency_slot, run_concurrently
+from APRS_metrics import timer
+
+#setup logger
+logger = logging.getLogger()
+
+#SimpleDB domain holding the per site tracker state
+TRACKER_DOMAIN = 'APRS_tracker'
+#SimpleDB allows at most 20 comparisons in one select expression
+SELECT_CHUNK = 20
+#batch_put_attributes accepts at most 25 items per call
+BATCH_PUT_CHUNK = 25
+
+#backend selection. sdb in production, memory or sqlite for local load testing
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sdb')
+STATE_SQLITE_PATH = os.environ.get('STATE_SQLITE_PATH', '/tmp/APRS_state.sqlite3')
+
+#state store interface
+#load() reads many items in as few round trips as the backend allows, stage() collects updates,
+#and flush() writes them in chunks. Backends implement _read_chunk, _write_chunk, _scan, _create, _update_if and _delete
+class StateStore:
+    read_chunk = SELECT_CHUNK
+    write_chunk = BATCH_PUT_CHUNK
+
+    def __init__(self, domain=TRACKER_DOMAIN):
+        self.domain = domain
+        self._items = {}
+        self._staged = {}
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.writes_skipped = 0
+    #end __init__
+
+    #loads the named items into the store. Items not in the domain are remembered as missing
+    #returns a dictionary of item name -> attribute dictionary for the items found
+    def load(self, names):
+        names = [name for name in dict.fromkeys(names) if name not in self._items]
+        found = {}
+        for i in range(0, len(names), self.read_chunk):
+            chunk = names[i:i + self.read_chunk]
+            with timer('db'):
+                chunk_found = self._read_chunk(chunk)
+            #endwith
+            found.update(chunk_found)
+            with self._lock:
+                for name in chunk:
+                    self._items[name] = chunk_found.get(name)
+                #endfor
+            #endwith
+        #endfor
+        return found
+    #end load
+
+    #loads every item in the domain. Returns item name -> attribute dictionary
+    def scan(self):
+        with timer('db'):
+            found = self._scan()
+        #endwith
+        with self._lock:
+            self._items.update(found)
+        #endwith
+        return found
+    #end scan
+
+    #returns the attributes for a loaded item, or None if it has no record
+    def get(self, name):
+        if name not in self._items:
+            self.load([name])
+        #endif
+        return self._items[name]
+    #end get
+
+    #queues attribute updates for an item. Values are stored as strings
+    def stage(self, name, attributes):
+        with self._lock:
+            staged = self._staged.setdefault(name, {})
+            for attribute, value in attributes.items():
+                staged[attribute] = str(value)
+            #endfor
+        #endwith
+    #end stage
+
+    def _count_round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        #endwith
+    #end _count_round_trip
+
+    #records that an item was deliberately left unwritten this cycle
+    def skip(self, name):
+        with self._lock:
+            self.writes_skipped += 1
+        #endwith
+    #end skip
+
+    #writes every staged item, optionally several chunks at once
+    #returns item name -> error message for items that failed
+    def flush(self, workers=1):
+        with self._lock:
+            staged = list(self._staged.items())
+            self._staged = {}
+        #endwith
+        chunks = [staged[i:i + self.write_chunk] for i in range(0, len(staged), self.write_chunk)]
+        failed = {}
+        for chunk_failed in run_concurrently(self._flush_chunk, chunks, workers):
+            failed.update(chunk_failed)
+        #endfor
+        return failed
+    #end flush
+
+    def _flush_chunk(self, chunk):
+        try:
+            with timer('db'):
+                self._write_chunk(chunk)
+            #endwith
+        except Exception as err:
+            message = "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}")
+            logger.exception(message)
+            return {name: message for name, attributes in chunk}
+        #endtry
+        with self._lock:
+            for name, attributes in chunk:
+                current = self._items.get(name) or {}
+                current.update(attributes)
+                self._items[name] = current
+            #endfor
+        #endwith
+        return {}
+    #end _flush_chunk
+
+    #writes an item immediately, only if it does not already exist
+    #returns True if this call created it. Used to claim work across containers
+    def create(self, name, attributes):
+        attributes = {attribute: str(value) for attribute, value in attributes.items()}
+        with timer('db'):
+            created = self._create(name, attributes)
+        #endwith
+        with self._lock:
+            if created:
+                self._items[name] = dict(attributes)
+            else:
+                self._items.pop(name, None)
+            #endif
+        #endwith
+        return created
+    #end create
+
+    #writes attributes to an item immediately, only if the item's attribute still has the expected value
+    #with expected None the item must not exist yet. Returns True if the write happened
+    #used for compare and swap updates of counters shared between containers
+    def update_if(self, name, attributes, attribute, expected):
+        if expected is None:
+            return self.create(name, attributes)
+        #endif
+        attributes = {key: str(value) for key, value in attributes.items()}
+        with timer('db'):
+            updated = self._update_if(name, attributes, attribute, str(expected))
+        #endwith
+        with self._lock:
+            if updated:
+                current = self._items.get(name) or {}
+                current.update(attributes)
+                self._items[name] = current
+            else:
+                self._items.pop(name, None)
+            #endif
+        #endwith
+        return updated
+    #end update_if
+
+    #removes an item immediately
+    def delete(self, name):
+        with timer('db'):
+            self._delete(name)
+        #endwith
+        self._items[name] = None
+        self._staged.pop(name, None)
+    #end delete
+#end StateStore
+
+#state store backed by a SimpleDB domain
+class SimpleDBStateStore(StateStore):
+    def _read_chunk(self, names):
+        return self._select("select * from `" +self.domain +"` where itemName() in (" +",".join(_quote(name) for name in names) +")")
+    #end _read_chunk
+
+    def _scan(self):
+        return self._select("select * from `" +self.domain +"`")
+    #end _scan
+
+    #runs a select expression through every result page
+    def _select(self, expression):
+        found = {}
+        client = get_client('sdb')
+        next_token = None
+        while True:
+            arguments = {'SelectExpression': expression, 'ConsistentRead': True}
+            if next_token:
+                arguments['NextToken'] = next_token
+            #endif
+            with dependency_slot('sdb'):
+                response = client.select(**arguments)
+            #endwith
+            self._count_round_trip()
+            for item in response.get('Items', []):
+                found[item['Name']] = {attribute['Name']: attribute['Value'] for attribute in item['Attributes']}
+            #endfor
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+            #endif
+        #endwhile
+        return found
+    #end _select
+
+    def _write_chunk(self, chunk):
+        with dependency_slot('sdb'):
+            get_client('sdb').batch_put_attributes(
+                DomainName=self.domain,
+                Items=[
+                    {
+                        'Name': name,
+                        'Attributes': [{'Name': attribute, 'Value': value, 'Replace': True} for attribute, value in attributes.items()]
+                    }
+                    for name, attributes in chunk
+                ]
+            )
+        #endwith
+        self._count_round_trip()
+    #end _write_chunk
+
+    def _create(self, name, attributes):
+        try:
+            with dependency_slot('sdb'):
+                get_client('sdb').put_attributes(
+                    DomainName=self.domain,
+                    ItemName=name,
+                    Attributes=[{'Name': attribute, 'Value': value, 'Replace': True} for attribute, value in attributes.items()],
+                    Expected={'Name': next(iter(attributes)), 'Exists': False}
+                )
+            #endwith
+        except Exception as err:
+            #botocore is not imported here, so match the error code rather than the class
+            if getattr(err, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailed':
+                return False
+            #endif
+            raise
+        finally:
+            self._count_round_trip()
+        #endtry
+        return True
+    #end _create
+
+    def _update_if(self, name, attributes, attribute, expected):
+        try:
+            with dependency_slot('sdb'):
+                get_client('sdb').put_attributes(
+                    DomainName=self.domain,
+                    ItemName=name,
+                    Attributes=[{'Name': key, 'Value': value, 'Replace': True} for key, value in attributes.items()],
+                    Expected={'Name': attribute, 'Value': expected}
+                )
+            #endwith
+        except Exception as err:
+            if getattr(err, 'response', {}).get('Error', {}).get('Code') in ('ConditionalCheckFailed', 'AttributeDoesNotExist'):
+                return False
+            #endif
+            raise
+        finally:
+            self._count_round_trip()
+        #endtry
+        return True
+    #end _update_if
+
+    def _delete(self, name):
+        with dependency_slot('sdb'):
+            get_client('sdb').delete_attributes(DomainName=self.domain, ItemName=name)
+        #endwith
+        self._count_round_trip()
+    #end _delete
+#end SimpleDBStateStore
+
+#domain name -> item name -> attributes. Lives for the life of the process, like a table would
+_memory_domains = {}
+_memory_lock = threading.Lock()
+
+#state store backed by a process wide dictionary
+class MemoryStateStore(StateStore):
+    read_chunk = 1000
+    write_chunk = 1000
+
+    def __init__(self, domain=TRACKER_DOMAIN):
+        super().__init__(domain)
+        self._table = _memory_domains.setdefault(domain, {})
+    #end __init__
+
+    def _read_chunk(self, names):
+        self._count_round_trip()
+        table = self._table
+        return {name: dict(table[name]) for name in names if name in table}
+    #end _read_chunk
+
+    def _scan(self):
+        self._count_round_trip()
+        return {name: dict(attributes) for name, attributes in self._table.items()}
+    #end _scan
+
+    def _write_chunk(self, chunk):
+        self._count_round_trip()
+        table = self._table
+        for name, attributes in chunk:
+            table.setdefault(name, {}).update(attributes)
+        #endfor
+    #end _write_chunk
+
+    def _create(self, name, attributes):
+        self._count_round_trip()
+        with _memory_lock:
+            if name in self._table:
+                return False
+            #endif
+            self._table[name] = dict(attributes)
+        #endwith
+        return True
+    #end _create
+
+    def _update_if(self, name, attributes, attribute, expected):
+        self._count_round_trip()
+        with _memory_lock:
+            current = self._table.get(name)
+            if current is None or current.get(attribute) != expected:
+                return False
+            #endif
+            current.update(attributes)
+        #endwith
+        return True
+    #end _update_if
+
+    def _delete(self, name):
+        self._count_round_trip()
+        self._table.pop(name, None)
+    #end _delete
+#end MemoryStateStore
+
+#one sqlite connection per thread per database file
+_sqlite_local = threading.local()
+
+#table used by the sqlite state backend
+STATE_SCHEMA = "CREATE TABLE IF NOT EXISTS state_items (domain TEXT NOT NULL, name TEXT NOT NULL, attributes TEXT NOT NULL, PRIMARY KEY (domain, name))"
+
+#returns this thread's WAL mode connection to a sqlite file, running the schema on first use
+#shared with the other modules that keep local sqlite files
+def sqlite_connection(path, schema=STATE_SCHEMA):
+    connections = getattr(_sqlite_local, 'connections', None)
+    if connections is None:
+        connections = _sqlite_local.connections = {}
+    #endif
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(schema)
+        connections[path] = connection
+    #endif
+    return connection
+#end sqlite_connection
+
+#state store backed by a local sqlite file in WAL mode, so several processes can share it
+class SQLiteStateStore(StateStore):
+    #sqlite's default limit on bound parameters is 999
+    read_chunk = 900
+    write_chunk = 500
+
+    def __init__(self, domain=TRACKER_DOMAIN, path=None):
+        super().__init__(domain)
+        self.path = path or STATE_SQLITE_PATH
+    #end __init__
+
+    def _read_chunk(self, names):
+        connection = sqlite_connection(self.path)
+        rows = connection.execute(
+            "SELECT name, attributes FROM state_items WHERE domain = ? AND name IN (" +",".join("?" * len(names)) +")",
+            [self.domain] + list(names)
+        ).fetchall()
+        self._count_round_trip()
+        return {name: json.loads(attributes) for name, attributes in rows}
+    #end _read_chunk
+
+    def _scan(self):
+        rows = sqlite_connection(self.path).execute("SELECT name, attributes FROM state_items WHERE domain = ?", (self.domain,)).fetchall()
+        self._count_round_trip()
+        return {name: json.loads(attributes) for name, attributes in rows}
+    #end _scan
+
+    def _write_chunk(self, chunk):
+        connection = sqlite_connection(self.path)
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT INTO state_items (domain, name, attributes) VALUES (?, ?, ?) "
+                "ON CONFLICT (domain, name) DO UPDATE SET attributes = json_patch(state_items.attributes, excluded.attributes)",
+                [(self.domain, name, json.dumps(attributes)) for name, attributes in chunk]
+            )
+        #endwith
+        self._count_round_trip()
+    #end _write_chunk
+
+    def _create(self, name, attributes):
+        cursor = sqlite_connection(self.path).execute(
+            "INSERT OR IGNORE INTO state_items (domain, name, attributes) VALUES (?, ?, ?)",
+            (self.domain, name, json.dumps(attributes))
+        )
+        self._count_round_trip()
+        return cursor.rowcount == 1
+    #end _create
+
+    def _update_if(self, name, attributes, attribute, expected):
+        cursor = sqlite_connection(self.path).execute(
+            "UPDATE state_items SET attributes = json_patch(attributes, ?) WHERE domain = ? AND name = ? AND json_extract(attributes, ?) = ?",
+            (json.dumps(attributes), self.domain, name, '$."' +attribute +'"', expected)
+        )
+        self._count_round_trip()
+        return cursor.rowcount == 1
+    #end _update_if
+
+    def _delete(self, name):
+        sqlite_connection(self.path).execute("DELETE FROM state_items WHERE domain = ? AND name = ?", (self.domain, name))
+        self._count_round_trip()
+    #end _delete
+#end SQLiteStateStore
+
+#backend name -> state store class
+STATE_BACKENDS = {
+    'sdb': SimpleDBStateStore,
+    'memory': MemoryStateStore,
+    'sqlite': SQLiteStateStore,
+}
+
+#returns a new state store for the domain on the configured backend
+#each poll cycle or request should use its own store, the loaded items are a per cycle snapshot
+def get_state_store(domain=TRACKER_DOMAIN, backend=None):
+    return STATE_BACKENDS[backend or STATE_BACKEND](domain)
+#end get_state_store
+
+#quotes a value for a SimpleDB select expression
+def _quote(value):
+    return "'" +value.replace("'", "''") +"'"
+#end _quote
+
+#eof
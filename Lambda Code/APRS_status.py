@@ -0,0 +1,101 @@
+import os
+import time
+import calendar
+import logging
+
+from APRS_cache import TTLCache, MISSING
+from APRS_state import get_state_store
+from APRS_telemetry import parse_telemetry
+
+#setup logger
+logger = logging.getLogger()
+
+#per callsign status summary for STATUS replies
+#APRS_notify stages the summary attributes with every tracker write, and the subscription table
+#stages the monitor expiry, so a STATUS request is one lookup of the tracker item and no parsing.
+#Warm containers keep the summaries for one poll interval
+STATUS_CACHE_SECONDS = int(os.environ.get('STATUS_CACHE_SECONDS', '300'))
+
+#callsign -> summary dictionary, or None for a callsign with no record
+_summaries = TTLCache(maxsize=1024, ttl=STATUS_CACHE_SECONDS)
+
+#returns the summary attributes APRS_notify stages with the tracker state
+def status_attributes(internal_temp):
+    return {'internal_temp': "%.2f" %internal_temp}
+#end status_attributes
+
+#builds a summary from a tracker item: internal_temp, lasttime, alert_sent and expires
+#items written before the summary attributes existed fall back to parsing the stored comment,
+#and items from before epoch timestamps to parsing the report_time string
+def summarize(item):
+    if item is None:
+        return None
+    #endif
+    if "internal_temp" in item:
+        internal_temp = float(item["internal_temp"])
+    elif "comment" in item:
+        internal_temp = parse_telemetry(item["comment"]).internal_temp
+    else:
+        internal_temp = None
+    #endif
+    if "lasttime" in item:
+        lasttime = int(item["lasttime"])
+    elif "report_time" in item:
+        lasttime = calendar.timegm(time.strptime(item["report_time"], "%Y-%m-%dT%H:%M:%SZ%z"))
+    else:
+        lasttime = None
+    #endif
+    return {
+        'internal_temp': internal_temp,
+        'lasttime': lasttime,
+        'alert_sent': item.get("alert_sent", 'False'),
+        'expires': int(item["expires"]) if "expires" in item else None,
+    }
+#end summarize
+
+#read-through lookup of a callsign's summary. Returns None if there is no record
+def get_status(callsign):
+    summary = _summaries.get(callsign, MISSING)
+    if summary is MISSING:
+        summary = summarize(get_state_store().get(callsign))
+        _summaries.put(callsign, summary)
+    #endif
+    return summary
+#end get_status
+
+#stages the monitor expiry on the tracker item and refreshes the cached summary
+#called by the subscription table when a monitor is started, extended or stopped
+def set_monitor_expiry(callsign, expires):
+    store = get_state_store()
+    store.stage(callsign, {'expires': expires})
+    failed = store.flush()
+    if failed:
+        raise RuntimeError(failed[callsign])
+    #endif
+    summary = _summaries.get(callsign, MISSING)
+    if summary is not MISSING and summary is not None:
+        summary = dict(summary, expires=int(expires))
+        _summaries.put(callsign, summary)
+    else:
+        _summaries.pop(callsign)
+    #endif
+#end set_monitor_expiry
+
+#returns the human-readable STATUS reply for a summary
+def format_status(summary, now=None):
+    now = now or time.time()
+    if summary is None or summary['lasttime'] is None or summary['internal_temp'] is None:
+        return_value = "No record found for this callsign"
+    else:
+        return_value = ("Most recent report was: %.2f F at: %.0f minutes ago. Alert Status is: " %(summary['internal_temp'], (now - summary['lasttime']) / 60)) + summary['alert_sent']
+    #endif
+    if summary is not None and summary['expires'] is not None and summary['expires'] > now:
+        remaining_minutes = int(summary['expires'] - now) // 60
+        return_value += ". Monitoring stops in %dh %02dm" %(remaining_minutes // 60, remaining_minutes % 60)
+    else:
+        return_value += ". Monitoring is not active"
+    #endif
+    return return_value
+#end format_status
+
+#eof
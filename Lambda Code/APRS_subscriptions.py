@@ -0,0 +1,109 @@
+import os
+import time
+import zlib
+import logging
+
+from APRS_state import get_state_store
+from APRS_status import set_monitor_expiry
+
+#setup logger
+logger = logging.getLogger()
+
+#subscription table. One item per callsign: SMS_to, created and expires (epoch seconds)
+#replaces the per callsign EventBridge schedules. A single schedule ticks APRS_notify, which
+#reads the active subscriptions, drops the expired ones and shards the rest across workers
+SUBSCRIPTION_DOMAIN = 'APRS_subscriptions'
+
+#set application defaults
+default_schedule_expiration_hours = 4
+default_maximum_schedule_hours = 24
+
+#number of worker invocations the tick spreads the subscriptions over
+TICK_SHARDS = int(os.environ.get('TICK_SHARDS', '1'))
+
+#where position reports come from. 'poll' has the tick query aprs.fi for every subscription.
+#'aprsis' leaves them to APRS_is, and the tick only purges expired subscriptions and old records
+INGEST_MODE = os.environ.get('INGEST_MODE', 'poll').lower()
+if INGEST_MODE not in ('poll', 'aprsis'):
+    logger.warning("ING:Unknown INGEST_MODE " +INGEST_MODE +", polling aprs.fi")
+    INGEST_MODE = 'poll'
+#endif
+
+#starts monitoring, or extends an active monitor by another expiration window
+#a monitor cannot be extended past the maximum schedule time from when it was created
+#returns a human-readable status string
+def start_subscription(callsign, inbound_sms_number, now=None):
+    now = int(now or time.time())
+    store = get_state_store(SUBSCRIPTION_DOMAIN)
+    subscription = store.get(callsign)
+    expires = now + default_schedule_expiration_hours * 3600
+    if subscription is None or int(subscription['expires']) <= now:
+        store.stage(callsign, {'SMS_to': inbound_sms_number, 'created': now, 'expires': expires})
+        return_value = "APRS Monitor: Session started for site "+callsign +". Monitoring automatically stops in " +str(default_schedule_expiration_hours) +" hours. Text STOP to end. Text STATUS for status. Message & Data rates may apply."
+    elif now < int(subscription['created']) + default_maximum_schedule_hours * 3600:
+        #allow extension of the monitor
+        logger.info("Creation Requested for already running monitor in: " +callsign)
+        store.stage(callsign, {'SMS_to': inbound_sms_number, 'expires': expires})
+        return_value = "Monitoring active for: " +callsign +". Monitoring automatically stops in " +str(default_schedule_expiration_hours) +" hours. Data and Msg charges may apply. STOP to end."
+    else:
+        return "Extension Limit Reached. STOP to end."
+    #endif
+    failed = store.flush()
+    if failed:
+        raise RuntimeError(failed[callsign])
+    #endif
+    #keep the STATUS summary's remaining monitoring time current
+    set_monitor_expiry(callsign, expires)
+    return return_value
+#end start_subscription
+
+#stops monitoring. Only the number that started the monitor may stop it
+#returns a human-readable status string
+def stop_subscription(callsign, inbound_sms_number, now=None):
+    now = int(now or time.time())
+    store = get_state_store(SUBSCRIPTION_DOMAIN)
+    subscription = store.get(callsign)
+    if subscription is None or int(subscription['expires']) <= now:
+        return "No active monitoring for: " +callsign
+    elif subscription['SMS_to'] == str(inbound_sms_number):
+        store.delete(callsign)
+        set_monitor_expiry(callsign, now)
+        return "Monitoring stopped for: " +callsign
+    else:
+        return "You do not have permission to stop monitoring for: " +callsign
+    #endif
+#end stop_subscription
+
+#returns the active subscriptions as a list of (callsign, SMS_to, expires)
+#expired subscriptions are deleted on the way, so expiry is enforced by the tick
+def active_subscriptions(now=None, purge=True):
+    now = int(now or time.time())
+    store = get_state_store(SUBSCRIPTION_DOMAIN)
+    active = []
+    for callsign, subscription in sorted(store.scan().items()):
+        if int(subscription['expires']) > now:
+            active.append((callsign, subscription['SMS_to'], int(subscription['expires'])))
+        elif purge:
+            logger.info("SUB:monitoring expired for " +callsign)
+            store.delete(callsign)
+        #endif
+    #endfor
+    return active
+#end active_subscriptions
+
+#returns the shard a callsign belongs to. crc32 is stable across processes, unlike hash()
+def shard_for(callsign, shards):
+    return zlib.crc32(callsign.upper().encode("utf-8")) % shards
+#end shard_for
+
+#splits subscriptions into shard number -> list of subscriptions
+def shard_subscriptions(subscriptions, shards=None):
+    shards = shards or TICK_SHARDS
+    sharded = {}
+    for subscription in subscriptions:
+        sharded.setdefault(shard_for(subscription[0], shards), []).append(subscription)
+    #endfor
+    return sharded
+#end shard_subscriptions
+
+#eof
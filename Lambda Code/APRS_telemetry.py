@@ -0,0 +1,74 @@
+import re
+import logging
+from typing import NamedTuple
+
+#setup logger
+logger = logging.getLogger()
+
+#decoder for the telemetry frame the LightAPRS tracker writes into telemetry_buff
+#layout from updateTelemetry() in LightAPRS-tracker.ino:
+#   000/000/A=000000 TI 71.23 TB 70.12 hPa1013.25 V 4.12 Tx001 <comment>
+#   TI  internal DS18B20 temperature, dtostrf width 6, degrees F
+#   TB  BMP180 temperature, dtostrf width 6, degrees F
+#   hPa BMP180 pressure, dtostrf width 7
+#   V   battery voltage, dtostrf width 5
+#   Tx  transmission count, %03d
+#aprs.fi removes the course/speed/altitude extension before publishing the comment, so it is optional here
+#dtostrf pads with spaces and grows past its width for large values, so whitespace after each label is optional
+TELEMETRY_PATTERN = re.compile(
+    r'\s*(?:\d{3}/\d{3})?(?:/?A=-?\d{5,6})?\s*'
+    r'TI *(?P<internal_temp>-?\d+(?:\.\d+)?) +'
+    r'TB *(?P<bmp_temp>-?\d+(?:\.\d+)?) +'
+    r'hPa *(?P<pressure>-?\d+(?:\.\d+)?) +'
+    r'V *(?P<battery>-?\d+(?:\.\d+)?) +'
+    r'Tx *(?P<tx_count>\d+)'
+    r'(?: (?P<text>.*?))?\s*$',
+    re.S
+)
+
+#one decoded telemetry frame
+class Telemetry(NamedTuple):
+    internal_temp: float
+    bmp_temp: float
+    pressure: float
+    battery: float
+    tx_count: int
+    text: str
+#end Telemetry
+
+#raised when a comment is not a tracker telemetry frame
+class TelemetryError(ValueError):
+    pass
+#end TelemetryError
+
+#decodes one comment into a Telemetry record. Raises TelemetryError if the frame is malformed
+def parse_telemetry(comment, _match=TELEMETRY_PATTERN.match):
+    if not isinstance(comment, str):
+        raise TelemetryError("Telemetry comment is not a string: " +type(comment).__name__)
+    #endif
+    match = _match(comment)
+    if match is None:
+        raise TelemetryError("Malformed telemetry frame: " +repr(comment[:80]))
+    #endif
+    internal_temp, bmp_temp, pressure, battery, tx_count, text = match.groups()
+    return Telemetry(float(internal_temp), float(bmp_temp), float(pressure), float(battery), int(tx_count), text or '')
+#end parse_telemetry
+
+#decodes many comments in one pass. Malformed frames come back as None so one bad
+#tracker does not stop the rest of the batch
+def parse_many(comments, _match=TELEMETRY_PATTERN.match, _make=Telemetry._make):
+    records = []
+    append = records.append
+    for comment in comments:
+        match = _match(comment) if isinstance(comment, str) else None
+        if match is None:
+            append(None)
+            continue
+        #endif
+        internal_temp, bmp_temp, pressure, battery, tx_count, text = match.groups()
+        append(_make((float(internal_temp), float(bmp_temp), float(pressure), float(battery), int(tx_count), text or '')))
+    #endfor
+    return records
+#end parse_many
+
+#eof
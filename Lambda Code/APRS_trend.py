@@ -0,0 +1,178 @@
+import os
+import math
+import logging
+from typing import NamedTuple
+
+#setup logger
+logger = logging.getLogger()
+
+#incremental trend and anomaly statistics for the internal temperature
+#each site keeps a handful of numbers in its tracker item, updated once per new packet:
+#Holt's linear smoothing for the level and the slope in degrees per minute (readings arrive at
+#irregular times, so the slope is carried forward by the actual gap), the exponentially weighted
+#variance of the one step forecast error, and a decaying min/max envelope. Nothing rescans history.
+#backtest() replays stored history for many sites at once with numpy, which is imported only there
+
+#smoothing for the level and the slope. Higher follows the readings more closely
+TREND_ALPHA = float(os.environ.get('TREND_ALPHA', '0.3'))
+TREND_BETA = float(os.environ.get('TREND_BETA', '0.2'))
+#how fast the min/max envelope relaxes back toward the level, per reading
+TREND_ENVELOPE_DECAY = 0.05
+#readings needed before the trend is trusted for projections and anomalies
+TREND_MIN_SAMPLES = int(os.environ.get('TREND_MIN_SAMPLES', '4'))
+#raise a freeze projection when the minimum is this many minutes away or less
+TREND_HORIZON_MINUTES = int(os.environ.get('TREND_HORIZON_MINUTES', '90'))
+#a reading is anomalous when its forecast error exceeds this many standard deviations
+TREND_ANOMALY_Z = float(os.environ.get('TREND_ANOMALY_Z', '4'))
+#readings closer than this to the last update are ignored. Over a gap of seconds any difference
+#turns into a huge slope, and such a reading is a repeat of the last packet, like a digipeated copy
+TREND_MIN_SECONDS = int(os.environ.get('TREND_MIN_SECONDS', '30'))
+
+#per site trend state
+class TrendState(NamedTuple):
+    count: int
+    updated: int
+    level: float
+    slope: float
+    variance: float
+    minimum: float
+    maximum: float
+#end TrendState
+
+#parses the state stored in a tracker item's trend attribute. Returns None if there is none
+def parse_trend(value):
+    if not value:
+        return None
+    #endif
+    count, updated, level, slope, variance, minimum, maximum = value.split(",")
+    return TrendState(int(count), int(updated), float(level), float(slope), float(variance), float(minimum), float(maximum))
+#end parse_trend
+
+#formats a state for the tracker item's trend attribute
+def format_trend(state):
+    return "%d,%d,%.4f,%.6f,%.4f,%.2f,%.2f" %state
+#end format_trend
+
+#returns the level the trend expects at timestamp
+def forecast(state, timestamp):
+    return state.level + state.slope * max(0, timestamp - state.updated) / 60
+#end forecast
+
+#folds one reading into the state and returns the new state
+#readings less than TREND_MIN_SECONDS after the last update are ignored
+def update_trend(state, timestamp, value):
+    if state is None:
+        return TrendState(1, int(timestamp), value, 0.0, 0.0, value, value)
+    #endif
+    if timestamp < state.updated + TREND_MIN_SECONDS:
+        return state
+    #endif
+    minutes = (timestamp - state.updated) / 60
+    predicted = state.level + state.slope * minutes
+    error = value - predicted
+    level = predicted + TREND_ALPHA * error
+    slope = TREND_BETA * (level - state.level) / minutes + (1 - TREND_BETA) * state.slope
+    variance = (1 - TREND_ALPHA) * (state.variance + TREND_ALPHA * error * error)
+    minimum = min(value, state.minimum + (level - state.minimum) * TREND_ENVELOPE_DECAY)
+    maximum = max(value, state.maximum + (level - state.maximum) * TREND_ENVELOPE_DECAY)
+    return TrendState(state.count + 1, int(timestamp), level, slope, variance, minimum, maximum)
+#end update_trend
+
+#returns the minutes until the trend reaches threshold from above, or None if it is not heading there
+def minutes_until(state, threshold):
+    if state is None or state.count < TREND_MIN_SAMPLES or state.slope >= 0 or state.level <= threshold:
+        return None
+    #endif
+    return (state.level - threshold) / -state.slope
+#end minutes_until
+
+#returns True if value is further from the trend's forecast than the noise explains
+#floor is the smallest deviation that counts, whatever the variance
+def is_anomaly(state, timestamp, value, floor):
+    if state is None or state.count < TREND_MIN_SAMPLES:
+        return False
+    #endif
+    return abs(value - forecast(state, timestamp)) > max(floor, TREND_ANOMALY_Z * math.sqrt(state.variance))
+#end is_anomaly
+
+#replays readings for many sites at once and counts what the freeze projection would have done
+#readings is site -> list of (timestamp, internal temp), as returned by the history store query.
+#Readings are put on an interval grid, one row per site, and the trend update runs once per
+#column over every site at the same time. Gaps are carried forward like a missed beacon
+#returns site -> {'readings', 'alerts', 'freezes', 'warned', 'lead_minutes'}: projection alerts
+#raised, times the reading fell to the minimum, how many of those had an alert within the horizon
+#before them, and the mean warning they got
+def backtest(readings, minimum, horizon=None, alpha=None, beta=None, interval=300):
+    import numpy
+    horizon = TREND_HORIZON_MINUTES if horizon is None else horizon
+    alpha = TREND_ALPHA if alpha is None else alpha
+    beta = TREND_BETA if beta is None else beta
+    sites = sorted(readings)
+    start = min(record[0] for site in sites for record in readings[site][:1])
+    end = max(record[0] for site in sites for record in readings[site][-1:])
+    columns = (end - start) // interval + 1
+    grid = numpy.full((len(sites), columns), numpy.nan)
+    for row, site in enumerate(sites):
+        site_readings = numpy.asarray([(record[0], record[1]) for record in readings[site]], dtype=float)
+        grid[row, ((site_readings[:, 0] - start) // interval).astype(int)] = site_readings[:, 1]
+    #endfor
+
+    level = numpy.full(len(sites), numpy.nan)
+    slope = numpy.zeros(len(sites))
+    count = numpy.zeros(len(sites), dtype=int)
+    minutes = numpy.zeros(len(sites))
+    last_alert = numpy.full(len(sites), -numpy.inf)
+    episode_start = numpy.full(len(sites), -numpy.inf)
+    alerts = numpy.zeros(len(sites), dtype=int)
+    freezes = numpy.zeros(len(sites), dtype=int)
+    warned = numpy.zeros(len(sites), dtype=int)
+    lead_total = numpy.zeros(len(sites))
+    below = numpy.zeros(len(sites), dtype=bool)
+    for column in range(columns):
+        value = grid[:, column]
+        seen = ~numpy.isnan(value)
+        minutes += interval / 60
+        first = seen & (count == 0)
+        level[first] = value[first]
+        following = seen & (count > 0)
+        predicted = level + slope * minutes
+        new_level = numpy.where(following, predicted + alpha * (value - predicted), level)
+        slope = numpy.where(following, beta * (new_level - level) / minutes + (1 - beta) * slope, slope)
+        level = new_level
+        count += seen
+        minutes[seen] = 0
+
+        #the projection alert, as evaluate_site raises it
+        now = column * interval / 60
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            projected = (level - minimum) / -slope
+        #endwith
+        alerting = seen & (count >= TREND_MIN_SAMPLES) & (slope < 0) & (level > minimum) & (projected <= horizon)
+        #alerts closer together than the horizon are one warning, the SMS alert flag would hold the rest
+        new_episode = alerting & (now - last_alert > horizon)
+        alerts += new_episode
+        episode_start = numpy.where(new_episode, now, episode_start)
+        last_alert = numpy.where(alerting, now, last_alert)
+
+        #a freeze is the first reading at or under the minimum after being above it
+        frozen = seen & (value <= minimum)
+        freeze = frozen & ~below
+        below = numpy.where(seen, frozen, below)
+        freezes += freeze
+        in_time = freeze & (now - last_alert <= horizon)
+        warned += in_time
+        lead_total += numpy.where(in_time, now - episode_start, 0)
+    #endfor
+    return {
+        site: {
+            'readings': int(count[row]),
+            'alerts': int(alerts[row]),
+            'freezes': int(freezes[row]),
+            'warned': int(warned[row]),
+            'lead_minutes': float(lead_total[row] / warned[row]) if warned[row] else None,
+        }
+        for row, site in enumerate(sites)
+    }
+#end backtest
+
+#eof
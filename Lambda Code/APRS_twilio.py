@@ -0,0 +1,117 @@
+import os
+import json
+import base64
+import logging
+import threading
+import http.client
+import urllib.parse
+from collections import namedtuple
+
+#setup logger
+logger = logging.getLogger()
+
+#dependency free sender for the Twilio Messages endpoint
+#exposes the same client.messages.create(...) call the twilio package does, so the handlers
+#do not care which one they were given. Keeps one keep-alive HTTPS connection per thread
+TWILIO_API_URL = os.environ.get('TWILIO_API_URL', 'https://api.twilio.com')
+TWILIO_TIMEOUT = 10
+
+#the fields of the Twilio message resource the handlers use
+Message = namedtuple('Message', ['sid', 'status', 'to', 'body', 'error_code'])
+
+#raised when Twilio answers with a non 2xx status
+class TwilioRestError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(f"HTTP {status} error {code}: {message}")
+        self.status = status
+        self.code = code
+        self.msg = message
+    #end __init__
+#end TwilioRestError
+
+class TwilioRestClient:
+    def __init__(self, account_sid, auth_token, base_url=None):
+        self.account_sid = account_sid
+        self.messages = _Messages(self)
+        parsed = urllib.parse.urlsplit(base_url or TWILIO_API_URL)
+        self._scheme = parsed.scheme
+        self._netloc = parsed.netloc
+        self._prefix = parsed.path.rstrip('/')
+        credentials = base64.b64encode((account_sid + ":" + auth_token).encode("utf-8")).decode("ascii")
+        self._headers = {
+            'Authorization': "Basic " +credentials,
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+            'Connection': 'keep-alive',
+        }
+        self._local = threading.local()
+    #end __init__
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self._scheme == 'https':
+                connection = http.client.HTTPSConnection(self._netloc, timeout=TWILIO_TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(self._netloc, timeout=TWILIO_TIMEOUT)
+            #endif
+            self._local.connection = connection
+        #endif
+        return connection
+    #end _connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+        #endif
+    #end close
+
+    #posts a form to the account path. Returns (status, decoded json)
+    #a keep-alive connection the server already dropped is reopened once
+    def post(self, path, fields):
+        url = self._prefix + "/2010-04-01/Accounts/" +self.account_sid + path
+        body = urllib.parse.urlencode(fields)
+        for attempt in (1, 2):
+            connection = self._connection()
+            try:
+                connection.request('POST', url, body=body, headers=self._headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.CannotSendRequest):
+                self.close()
+                if attempt == 2:
+                    raise
+                #endif
+                logger.info("TWI:stale connection, reconnecting")
+            #endtry
+        #endfor
+        payload = json.loads(data) if data else {}
+        if not (200 <= response.status <= 299):
+            raise TwilioRestError(response.status, payload.get('code'), payload.get('message'))
+        #endif
+        return response.status, payload
+    #end post
+#end TwilioRestClient
+
+class _Messages:
+    def __init__(self, client):
+        self._client = client
+    #end __init__
+
+    def create(self, to, body, messaging_service_sid=None, from_=None):
+        fields = {'To': to, 'Body': body}
+        if messaging_service_sid:
+            fields['MessagingServiceSid'] = messaging_service_sid
+        #endif
+        if from_:
+            fields['From'] = from_
+        #endif
+        status, payload = self._client.post("/Messages.json", fields)
+        return Message(payload.get('sid'), payload.get('status'), payload.get('to'), payload.get('body'), payload.get('error_code'))
+    #end create
+#end _Messages
+
+#eof
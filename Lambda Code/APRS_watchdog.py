@@ -1,11 +1,17 @@
+import io
 import os
-import base64
-import boto3
+import re
 import json
-import logging
+import time
 import gzip
+import base64
+import logging
 
-from twilio.rest import Client
+from APRS_clients import with_client_stats
+from APRS_metrics import with_metrics, timer, count
+from APRS_state import get_state_store
+from APRS_outbox import enqueue_sms, deliver_pending, idempotency_key
+from APRS_subscriptions import SUBSCRIPTION_DOMAIN
 
 #setup logger
 logger = logging.getLogger()
@@ -16,62 +22,61 @@ TWILIO_ACCOUNT_SID = os.environ['TWILIO_ACCOUNT_SID']
 TWILIO_AUTH_TOKEN = os.environ['TWILIO_AUTH_TOKEN']
 MESSAGING_SERVICE_SID = os.environ['TWILIO_MSG_SERVICE_SID']
 
+#failures that name no site, or a site nobody subscribes to, go to the operator
+WATCHDOG_SMS_TO = os.environ.get('WATCHDOG_SMS_TO', "+18005551212")
+#a failure already reported inside this many seconds is counted, not sent again
+WATCHDOG_SUPPRESS_SECONDS = int(os.environ.get('WATCHDOG_SUPPRESS_SECONDS', '3600'))
+#at most this many distinct (code, site) groups are kept per log batch, the rest are only counted
+WATCHDOG_MAX_GROUPS = int(os.environ.get('WATCHDOG_MAX_GROUPS', '200'))
+#decompressed bytes read from the log batch at a time
+WATCHDOG_CHUNK_BYTES = 65536
+#longest failure text quoted in a summary
+WATCHDOG_MESSAGE_CHARS = 100
+
+#state store domain holding the last report time and suppressed count per (code, site)
+WATCHDOG_DOMAIN = 'APRS_watchdog'
+
+#error code of a failure line: "APRS:...", "TICK:..." or "Exception in SDB: ..."
+ERROR_CODE_PATTERN = re.compile(r'(?:Exception in (\w+):|([A-Z]+):)')
+#sites APRS_notify appends to its error lines, see site_tag there
+SITE_PATTERN = re.compile(r' site=([\w,\-]+)')
 
 #watchdog script
 #this lambda is called by CloudWatch when an error is logged by the temp logger
-#a text message is fired with the error text
+#the log batch is read as a stream, one log event at a time, so memory stays bounded for large
+#batches. Failures are grouped by error code and site, a group already reported inside the
+#suppression window is only counted, and each summary goes to the subscribers of its site
 #TODO: stop the monitoring process
 
+@with_client_stats
+@with_metrics
 def lambda_handler(event, context):
     #set up response items
     lambda_return = {'Status': '200', 'Message': '', 'Code':''}
-    outbound_message = "Alerting Stopped! Error: "
-    
-    #pick up event flags
-    SMS_to = "+18005551212"
-    
+
     #unpack AWS log
     try:
-        logger.info((f"Logging Event: {event}"))
-        cw_data = event['awslogs']['data']
-        
-        compressed_payload = base64.b64decode(cw_data)
-        uncompressed_payload = gzip.decompress(compressed_payload)
-        payload = json.loads(uncompressed_payload)
-        
-        print(json.dumps(payload))
-        log_entries = payload["logEvents"]
-        for log_event in log_entries:
-            #print(json.dumps(log_event))
-            #process the log event here into an SMS message
-            log_message = log_event["message"].split("\t")
-            log_message_content = log_message[3].split("\n")
-            logger.info((f"Failure event: {log_message_content[0]}"))
-            print(log_message_content[0])
-            outbound_message = outbound_message + log_message_content[0]
+        with timer('parse'):
+            groups, events, overflow = group_failures(iter_log_events(event['awslogs']['data']))
+        #endwith
+        count('log_events', events)
+        logger.info("WDG:" +str(events) +" failure events in " +str(len(groups)) +" groups, " +str(overflow) +" over the group limit")
+
+        #send a summary for every group outside its suppression window
+        summaries = summarize_groups(groups, overflow)
+        for sms_to, outbound_message, key, label in summaries:
+            logger.info((f"SMS content: {outbound_message}"))
+            enqueue_sms(sms_to, outbound_message, key, label)
         #endfor
-        
-        #truncate message to 2 message segments in the event we have multiple log entries
-        outbound_message = outbound_message[:300]
-        #we have an outbound message, send sms message
-        logger.info((f"SMS content: {outbound_message}"))
-        
-        
-        # insert Twilio Account SID into the REST API URL
-        client = Client(TWILIO_ACCOUNT_SID,TWILIO_AUTH_TOKEN)
-        message = client.messages.create(
-            messaging_service_sid=MESSAGING_SERVICE_SID,
-            to=SMS_to,
-            body= outbound_message
-        )
-        logger.info((f"SMS Sent: {message.sid}"))
-        lambda_return['Message'] = outbound_message
-        
+        stats = deliver_pending()
+        logger.info((f"SMS queued: {len(summaries)}, delivery: {stats}"))
+        lambda_return['Message'] = "Sent " +str(len(summaries)) +" summaries for " +str(events) +" failures"
+
     except Exception as err:
         lambda_return['Status'] = "500"
-        lambda_return['Message'] = "Exception in SDB: " +(f"{type(err).__name__} was raised: {err}")
+        lambda_return['Message'] = "Exception in WDG: " +(f"{type(err).__name__} was raised: {err}")
         lambda_return['Code'] = "WDG"
-        
+
         logger.exception(lambda_return['Message'])
     #endtry
     # Return to close the lambda
@@ -81,6 +86,178 @@ def lambda_handler(event, context):
     }
 #end lambda_handler
 
+#file-like reader that base64 decodes a string a piece at a time
+class Base64Reader(io.RawIOBase):
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+    #end __init__
+
+    def readable(self):
+        return True
+    #end readable
+
+    def readinto(self, buffer):
+        #4 base64 characters decode to 3 bytes
+        length = len(buffer) // 3 * 4
+        if length == 0 or self._position >= len(self._data):
+            return 0
+        #endif
+        decoded = base64.b64decode(self._data[self._position:self._position + length])
+        self._position += length
+        buffer[:len(decoded)] = decoded
+        return len(decoded)
+    #end readinto
+#end Base64Reader
+
+#yields the logEvents of a base64 encoded, gzipped CloudWatch Logs payload one at a time
+#only one read chunk and the event being decoded are held in memory
+def iter_log_events(data, chunk_bytes=WATCHDOG_CHUNK_BYTES):
+    stream = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BufferedReader(Base64Reader(data), chunk_bytes)), encoding='utf-8')
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    at_end = False
+
+    #reads another chunk. Returns False at the end of the stream
+    def fill():
+        nonlocal buffer, position, at_end
+        chunk = stream.read(chunk_bytes)
+        if not chunk:
+            at_end = True
+            return False
+        #endif
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+    #end fill
+
+    #find the start of the logEvents array
+    while True:
+        start = buffer.find('"logEvents"')
+        if start >= 0:
+            bracket = buffer.find('[', start)
+            if bracket >= 0:
+                position = bracket + 1
+                break
+            #endif
+        #endif
+        if not fill():
+            return
+        #endif
+    #endwhile
+
+    while True:
+        #skip to the next value
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        #endwhile
+        if position >= len(buffer):
+            if not fill():
+                raise ValueError("log batch ended inside logEvents")
+            #endif
+            continue
+        #endif
+        if buffer[position] == ']':
+            return
+        #endif
+        try:
+            log_event, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            #the event runs past the end of the buffer
+            if at_end or not fill():
+                raise
+            #endif
+            continue
+        #endtry
+        position = end
+        yield log_event
+    #endwhile
+#end iter_log_events
+
+#splits a Lambda log line, "[ERROR]\ttime\trequest id\tmessage\ntraceback", into (code, sites, text)
+def parse_failure(message):
+    fields = message.split("\t")
+    text = (fields[3] if len(fields) > 3 else message).split("\n")[0].strip()
+    match = ERROR_CODE_PATTERN.match(text)
+    code = (match.group(1) or match.group(2)) if match else "ERR"
+    site_match = SITE_PATTERN.search(text)
+    sites = site_match.group(1).split(",") if site_match else [None]
+    if site_match:
+        text = text[:site_match.start()] + text[site_match.end():]
+    #endif
+    return code, sites, text
+#end parse_failure
+
+#groups failure events by (code, site)
+#returns ((code, site) -> {'count', 'text', 'id'}, events read, events over the group limit)
+#text and id are those of the group's first event
+def group_failures(log_events):
+    groups = {}
+    events = 0
+    overflow = 0
+    for log_event in log_events:
+        events += 1
+        code, sites, text = parse_failure(log_event.get("message", ""))
+        for site in sites:
+            group = groups.get((code, site))
+            if group is None:
+                if len(groups) >= WATCHDOG_MAX_GROUPS:
+                    overflow += 1
+                    continue
+                #endif
+                group = groups[(code, site)] = {'count': 0, 'text': text, 'id': log_event.get("id", "")}
+            #endif
+            group['count'] += 1
+        #endfor
+    #endfor
+    return groups, events, overflow
+#end group_failures
+
+#decides which groups to report, and to whom
+#returns a list of (SMS_to, message, idempotency key, label). Suppressed groups are counted in the state store
+def summarize_groups(groups, overflow=0, now=None):
+    now = int(now or time.time())
+    names = {(code, site): code +":" +(site or "-") for code, site in groups}
+    watchdog_store = get_state_store(WATCHDOG_DOMAIN)
+    watchdog_store.load(names.values())
+    subscription_store = get_state_store(SUBSCRIPTION_DOMAIN)
+    subscription_store.load([site for code, site in groups if site])
+
+    summaries = []
+    for (code, site), group in groups.items():
+        name = names[(code, site)]
+        previous = watchdog_store.get(name)
+        if previous is not None and now - int(previous['last_sent']) < WATCHDOG_SUPPRESS_SECONDS:
+            watchdog_store.stage(name, {'suppressed': int(previous.get('suppressed', 0)) + group['count']})
+            continue
+        #endif
+        suppressed = int(previous.get('suppressed', 0)) if previous is not None else 0
+        outbound_message = "APRS Monitor error" +(" for " +site if site else "") +": " +code +" x" +str(group['count'])
+        if suppressed:
+            outbound_message += " (+" +str(suppressed) +" suppressed)"
+        #endif
+        outbound_message += ". " +group['text'][:WATCHDOG_MESSAGE_CHARS]
+        subscription = subscription_store.get(site) if site else None
+        if subscription is not None and int(subscription['expires']) > now:
+            sms_to = subscription['SMS_to']
+        else:
+            sms_to = WATCHDOG_SMS_TO
+        #endif
+        #keyed on the group's first event, so a redelivered log batch is not sent twice
+        summaries.append((sms_to, outbound_message, idempotency_key(name, group['id']), site))
+        watchdog_store.stage(name, {'last_sent': now, 'suppressed': 0})
+    #endfor
+    if overflow:
+        summaries.append((WATCHDOG_SMS_TO, "APRS Monitor error: " +str(overflow) +" more failures over the watchdog group limit", idempotency_key("overflow", now // WATCHDOG_SUPPRESS_SECONDS), None))
+    #endif
+    failed = watchdog_store.flush()
+    for name, message in failed.items():
+        logger.error(message)
+    #endfor
+    return summaries
+#end summarize_groups
+
 # This calls the handler. Use only when testing.
 #print(lambda_handler("a","b"))
 